@@ -1,5 +1,13 @@
 #!/usr/bin/env bash
 set -eu
+
+# Job ledger of the campaign, optional: the jobs write records to the
+# directory set as Ledger in submission_toys_local.jdl, which are
+# collected into the ledger (e.g.
+# /cephfs/user/s6crdeut/q0_toys/2022_02_07_combined/ledger.sqlite)
+ledger=""
+records="/cephfs/user/s6crdeut/q0_toys/2022_02_07_combined/ledger_records"
+
 for mass in 251 260 280 300 325 350 375 400 \
                 450 500 550 600 700 800 900 \
                 1000 1100 1200 1400 1600; do
@@ -8,8 +16,17 @@ for mass in 251 260 280 300 325 350 375 400 \
     echo "Creating output directory: ${outdir}"
     mkdir -p "${outdir}"
 
+    # Ledger of the JDL (appended, overrides the empty default)
+    ledger_option=()
+    if [[ -n "${ledger}" ]]; then
+        mkdir -p "${records}"
+        ../scripts/jobLedger.py "${ledger}" expect local --mass "${mass}" --unit 0-999
+        ledger_option=(-append "Ledger = ${records}")
+    fi
+
     echo "Submitting m=${mass} ($(date))..."
-    cluster=$(condor_submit Mass="${mass}" SeedOffset=0 submission_toys_local.jdl \
+    cluster=$(condor_submit Mass="${mass}" SeedOffset=0 ${ledger_option[@]+"${ledger_option[@]}"} \
+                  submission_toys_local.jdl \
                   | tail -n 1 \
                   | sed "s/^.*cluster //; s/.$//")
     echo "Submitted to cluster '${cluster}'"
@@ -19,18 +36,17 @@ for mass in 251 260 280 300 325 350 375 400 \
 
     sleep 60
 
-    # Merge csv files
-    echo "Merging toys..."
-    (
-        cd "${outdir}"
-
-        {
-            head -n 1 toy_0.csv
-            find -name "toy_*.csv" -exec awk "{if(NR>1)print}" {} \;
-        } > "toys_combined_${mass}.csv"
+    if [[ -n "${ledger}" ]]; then
+        ../scripts/jobLedger.py "${ledger}" collect local "${records}"
+        ../scripts/jobLedger.py "${ledger}" summary local
+    fi
 
-        rm toy_*.csv
-    )
+    # Ingest the job outputs into the toy database (files ingested
+    # before are skipped) and export the merged toys
+    echo "Merging toys..."
+    ../scripts/toyDatabase.py "${outdir}/toys.sqlite" ingest --mass "${mass}" "${outdir}/toy_*.csv"
+    ../scripts/toyDatabase.py "${outdir}/toys.sqlite" export "${outdir}/toys_combined_${mass}.csv"
+    rm "${outdir}"/toy_*.csv
 
     # Deleting logs
     rm logs/"out.${cluster}."*
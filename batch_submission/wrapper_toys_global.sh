@@ -1,15 +1,22 @@
 #!/usr/bin/env bash
 set -eu
-(( $# == 3 )) || { echo "Usage: wrapper_toys_global.sh indir outdir nToy"; exit 1; }
+(( $# >= 3 && $# <= 5 )) || { echo "Usage: wrapper_toys_global.sh indir outdir nToy [wsdir] [workers]"; exit 1; }
 
 echo "Start: $(date)"
 
 indir="$1"
 outdir="$2"
 nToy="$3"
+# Optional: directory with one prebuilt workspace per mass (<mass>.root).
+# The pseudo-data of the toy are then read from the histograms in
+# indir instead of building 20 workspaces per toy.
+wsdir="${4:-}"
+# Number of mass points fitted in parallel (match request_cpus)
+workers="${5:-1}"
 
 [[ -d "${indir}" ]] || { echo "Indir does not exist"; exit 1; }
 [[ -d "${outdir}" ]] || { echo "Outdir does not exist"; exit 1; }
+[[ -z "${wsdir}" || -d "${wsdir}" ]] || { echo "Wsdir does not exist"; exit 1; }
 
 mkdir -p /jwd/run
 mkdir -p /jwd/outputs
@@ -20,11 +27,12 @@ cd /jwd/run
 tar -xzf /cephfs/user/s6crdeut/bbtt_global_significance.tar.gz \
     || { echo "Cannot get bbtt_global_significance"; exit 1; }
 
-tar -xzf /cephfs/user/s6crdeut/WSMaker_code_compiled.tar.gz \
-    || { echo "Cannot get WSMaker code"; exit 1; }
-
-# Build workspaces
+# Build workspaces (unless prebuilt)
+if [[ -z "${wsdir}" ]]; then
 (
+    tar -xzf /cephfs/user/s6crdeut/WSMaker_code_compiled.tar.gz \
+        || { echo "Cannot get WSMaker code"; exit 1; }
+
     set +eu
     cd WSMaker_HH_bbtautau
     source setup.sh
@@ -52,6 +60,7 @@ tar -xzf /cephfs/user/s6crdeut/WSMaker_code_compiled.tar.gz \
             || { echo "Error building workspace"; exit 1; }
     done
 )
+fi
 
 # Get q0
 (
@@ -72,56 +81,45 @@ tar -xzf /cephfs/user/s6crdeut/WSMaker_code_compiled.tar.gz \
     script_dir="$(readlink -e bbtt_global_significance/scripts)"
     PATH="${script_dir}:${PATH}"
 
-    for mass in 251 260 280 300 325 350 375 400 450 500 550 \
-                    600 700 800 900 1000 1100 1200 1400 1600; do
-        ws_name="combined_inputs.combined_pseudodata${nToy}_m${mass}"
-
-        mu_range=""
-        case "${mass}" in
-            251)  mu_range="10.0"  ;;
-            260)  mu_range="18.0" ;;
-            280)  mu_range="18.0" ;;
-            300)  mu_range="14.0" ;;
-            325)  mu_range="13.0" ;;
-            350)  mu_range="8.0"  ;;
-            375)  mu_range="5.0"  ;;
-            400)  mu_range="4.0"  ;;
-            450)  mu_range="2.0"  ;;
-            500)  mu_range="2.0"  ;;
-            550)  mu_range="1.0"  ;;
-            600)  mu_range="0.8"  ;;
-            700)  mu_range="0.6"  ;;
-            800)  mu_range="0.6"  ;;
-            900)  mu_range="0.6"  ;;
-            1000) mu_range="0.6"  ;;
-            1100) mu_range="0.6"  ;;
-            1200) mu_range="0.6"  ;;
-            1400) mu_range="0.6"  ;;
-            1600) mu_range="0.6"  ;;
-            *) { echo "Unknown mass: '${mass}'"; exit 1; } ;;
-        esac
-
-        runDiscoveryTestStat.py \
-            "WSMaker_HH_bbtautau/output/${ws_name}/workspaces/combined/${mass}.root" \
-            -o /jwd/outputs/"toy_m${mass}.csv" \
-            -m "${mass}" \
-            -i "${nToy}" \
-            --mu-range "${mu_range}" \
-            --optimizer-strategy 1 \
-            --globs-tree "WSMaker_HH_bbtautau/inputs/combined_inputs/toy_globs_${mass}.root" \
-            --globs-index "${nToy}" \
-            2>&1 > /dev/null \
-            || { echo "Error fitting toys"; exit 1; }
-    done
-)
+    # Record the job for the ledger of the campaign (optional: record
+    # directory $BBTT_LEDGER)
+    ledger() {
+        [[ -z "${BBTT_LEDGER:-}" ]] \
+            || jobLedger.py "${BBTT_LEDGER}" "$1" global --unit "${nToy}" "${@:2}" \
+            || echo "Cannot update ledger"
+    }
+    ledger start
+    trap 'code=$?; ledger finish --exit-code "${code}" --results "/jwd/outputs/toys_${nToy}.csv"' EXIT
+
+    # All mass points are fitted in parallel (mu-range from the mass)
+    # and merged into toys_${nToy}.csv
+    if [[ -z "${wsdir}" ]]; then
+        workspace="WSMaker_HH_bbtautau/output/combined_inputs.combined_pseudodata{toy}_m{mass}/workspaces/combined/{mass}.root"
+        globs_tree="WSMaker_HH_bbtautau/inputs/combined_inputs/toy_globs_{mass}.root"
+        pseudo_data=()
+    else
+        workspace="${wsdir}/{mass}.root"
+        globs_tree="${indir}/toy_globs_{mass}.root"
+        pseudo_data=(
+            --pseudo-data "SpcTauHH=${indir}/13TeV_TauHH_2tag2pjet_0ptv_LL_OS_PNN{mass}.root"
+            --pseudo-data "SpcTauLH_.*LTT0=${indir}/13TeV_TauLH_2tag2pjet_0ptv_2HDM_PNN_{mass}.root"
+            --pseudo-data "SpcTauLH_.*LTT1=${indir}/13TeV_TauLHLTT_2tag2pjet_0ptv_2HDM_PNN_{mass}.root"
+            --pseudo-data "DZllbbCR=${indir}/13TeV_TwoLepton_2tag2pjet_0ptv_ZllbbCR_mLL.root"
+        )
+    fi
 
-# Merge CSV
-cd /jwd/outputs
-{
-    head -n 1 toy_m251.csv
-    find -name "toy_*.csv" -exec awk "{if(NR>1)print}" {} \;
-} > "toys_${nToy}.csv"
+    runGlobalToys.py \
+        "${workspace}" \
+        -t "${nToy}" \
+        -j "${workers}" \
+        -o /jwd/outputs \
+        --optimizer-strategy 1 \
+        --globs-tree "${globs_tree}" \
+        ${pseudo_data[@]+"${pseudo_data[@]}"} \
+        > /jwd/outputs/fit.log 2>&1 \
+        || { tail -n 20 /jwd/outputs/fit.log; echo "Error fitting toys"; exit 1; }
+)
 
-cp "toys_${nToy}.csv" "${outdir}/"
+cp /jwd/outputs/"toys_${nToy}.csv" "${outdir}/"
 
 echo "Finished: $(date)"
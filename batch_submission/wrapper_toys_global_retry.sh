@@ -72,131 +72,29 @@ tar -xzf /cephfs/user/s6crdeut/WSMaker_code_compiled.tar.gz \
 
     ws_name="combined_inputs.combined_pseudodata${nToy}_m${mass}"
 
-    mu_range=""
-    case "${mass}" in
-        251)  mu_range="10.0"  ;;
-        260)  mu_range="18.0" ;;
-        280)  mu_range="18.0" ;;
-        300)  mu_range="14.0" ;;
-        325)  mu_range="13.0" ;;
-        350)  mu_range="8.0"  ;;
-        375)  mu_range="5.0"  ;;
-        400)  mu_range="4.0"  ;;
-        450)  mu_range="2.0"  ;;
-        500)  mu_range="2.0"  ;;
-        550)  mu_range="1.0"  ;;
-        600)  mu_range="0.8"  ;;
-        700)  mu_range="0.6"  ;;
-        800)  mu_range="0.6"  ;;
-        900)  mu_range="0.6"  ;;
-        1000) mu_range="0.6"  ;;
-        1100) mu_range="0.6"  ;;
-        1200) mu_range="0.6"  ;;
-        1400) mu_range="0.6"  ;;
-        1600) mu_range="0.6"  ;;
-        *) { echo "Unknown mass: '${mass}'"; exit 1; } ;;
-    esac
-
-
     postfix="idx${nToy}_m${mass}.csv"
 
-    # Retry Minuit2 strategy 2
-    runDiscoveryTestStat.py \
-        "WSMaker_HH_bbtautau/output/${ws_name}/workspaces/combined/${mass}.root" \
-        -o /jwd/outputs/"retry_minuit2strat2_${postfix}" \
-        -m "${mass}" \
-        -i "${nToy}" \
-        --mu-range "${mu_range}" \
-        --optimizer-strategy 2 \
-        --globs-tree "WSMaker_HH_bbtautau/inputs/combined_inputs/toy_globs_${mass}.root" \
-        --globs-index "${nToy}" \
-        2>&1 > /dev/null \
-        || { echo "Error fitting toys"; exit 1; }
-
-    # Retry Minuit strategy 1
-    runDiscoveryTestStat.py \
-        "WSMaker_HH_bbtautau/output/${ws_name}/workspaces/combined/${mass}.root" \
-        -o /jwd/outputs/"retry_minuitstrat1_${postfix}" \
-        -m "${mass}" \
-        -i "${nToy}" \
-        --mu-range "${mu_range}" \
-        --optimizer Minuit \
-        --optimizer-strategy 1 \
-        --globs-tree "WSMaker_HH_bbtautau/inputs/combined_inputs/toy_globs_${mass}.root" \
-        --globs-index "${nToy}" \
-        2>&1 > /dev/null \
-        || { echo "Error fitting toys"; exit 1; }
-
-    # Retry Minuit strategy 2
-    runDiscoveryTestStat.py \
-        "WSMaker_HH_bbtautau/output/${ws_name}/workspaces/combined/${mass}.root" \
-        -o /jwd/outputs/"retry_minuitstrat2_${postfix}" \
-        -m "${mass}" \
-        -i "${nToy}" \
-        --mu-range "${mu_range}" \
-        --optimizer Minuit \
-        --optimizer-strategy 2 \
-        --globs-tree "WSMaker_HH_bbtautau/inputs/combined_inputs/toy_globs_${mass}.root" \
-        --globs-index "${nToy}" \
-        2>&1 > /dev/null \
-        || { echo "Error fitting toys"; exit 1; }
-
-
-    # Try with mu range altered
-    mu_range_doubled=$(bc <<< "2.0 * ${mu_range}")
-    mu_range_halfed=$(bc <<< "0.5 * ${mu_range}")
-
-    # Retry Minuit2 strategy 1 doubled mu-range
-    runDiscoveryTestStat.py \
-        "WSMaker_HH_bbtautau/output/${ws_name}/workspaces/combined/${mass}.root" \
-        -o /jwd/outputs/"retry_minuit2strat1mu2_${postfix}" \
-        -m "${mass}" \
-        -i "${nToy}" \
-        --mu-range "${mu_range_doubled}" \
-        --optimizer Minuit2 \
-        --optimizer-strategy 1 \
-        --globs-tree "WSMaker_HH_bbtautau/inputs/combined_inputs/toy_globs_${mass}.root" \
-        --globs-index "${nToy}" \
-        2>&1 > /dev/null \
-        || { echo "Error fitting toys"; exit 1; }
-
-    # Retry Minuit2 strategy 1 halfed mu-range
-    runDiscoveryTestStat.py \
-        "WSMaker_HH_bbtautau/output/${ws_name}/workspaces/combined/${mass}.root" \
-        -o /jwd/outputs/"retry_minuit2strat1mu0p5_${postfix}" \
-        -m "${mass}" \
-        -i "${nToy}" \
-        --mu-range "${mu_range_halfed}" \
-        --optimizer Minuit2 \
-        --optimizer-strategy 1 \
-        --globs-tree "WSMaker_HH_bbtautau/inputs/combined_inputs/toy_globs_${mass}.root" \
-        --globs-index "${nToy}" \
-        2>&1 > /dev/null \
-        || { echo "Error fitting toys"; exit 1; }
-
-    # Retry Minuit strategy 1 doubled mu-range
-    runDiscoveryTestStat.py \
-        "WSMaker_HH_bbtautau/output/${ws_name}/workspaces/combined/${mass}.root" \
-        -o /jwd/outputs/"retry_minuitstrat1mu2_${postfix}" \
-        -m "${mass}" \
-        -i "${nToy}" \
-        --mu-range "${mu_range_doubled}" \
-        --optimizer Minuit \
-        --optimizer-strategy 1 \
-        --globs-tree "WSMaker_HH_bbtautau/inputs/combined_inputs/toy_globs_${mass}.root" \
-        --globs-index "${nToy}" \
-        2>&1 > /dev/null \
-        || { echo "Error fitting toys"; exit 1; }
-
-    # Retry Minuit strategy 1 halfed mu-range
+    # Record the job for the ledger of the campaign (optional: record
+    # directory $BBTT_LEDGER)
+    ledger() {
+        [[ -z "${BBTT_LEDGER:-}" ]] \
+            || jobLedger.py "${BBTT_LEDGER}" "$1" retry --mass "${mass}" --unit "${nToy}" "${@:2}" \
+            || echo "Cannot update ledger"
+    }
+    ledger start
+    trap 'code=$?; ledger finish --exit-code "${code}" --results "/jwd/outputs/retry_${postfix}"' EXIT
+
+    # Retry ladder: Minuit2 strategy 2, Minuit2 strategy 1 with doubled /
+    # halved mu-range, Minuit strategy 2 / 1, Minuit strategy 1 with
+    # doubled / halved mu-range. It stops once three fits are good (the
+    # cross-check in evaluateRetries.py), otherwise all methods run.
     runDiscoveryTestStat.py \
         "WSMaker_HH_bbtautau/output/${ws_name}/workspaces/combined/${mass}.root" \
-        -o /jwd/outputs/"retry_minuitstrat1mu0p5_${postfix}" \
+        -o /jwd/outputs/"retry_${postfix}" \
         -m "${mass}" \
         -i "${nToy}" \
-        --mu-range "${mu_range_halfed}" \
-        --optimizer Minuit \
-        --optimizer-strategy 1 \
+        --retry \
+        --retry-min-good 3 \
         --globs-tree "WSMaker_HH_bbtautau/inputs/combined_inputs/toy_globs_${mass}.root" \
         --globs-index "${nToy}" \
         2>&1 > /dev/null \
@@ -1,6 +1,6 @@
 #!/usr/bin/env bash
 set -eu
-(($# == 4)) || { echo "wrapper_toys_local.sh infile outdir ntoys seed"; exit 1; }
+(($# == 4 || $# == 5)) || { echo "wrapper_toys_local.sh infile outdir ntoys seed [workers]"; exit 1; }
 
 echo "Start: $(date)"
 
@@ -8,6 +8,9 @@ infile="${1}"
 outdir="${2}"
 ntoys="${3}"
 seed="${4}"
+# One worker reproduces the toys of older campaigns, more workers seed
+# every toy separately (see runDiscoveryTestStatToys.py --workers)
+workers="${5:-1}"
 
 [[ -f "${infile}" ]] || { echo "Infile ${infile} does not exist"; exit 1; }
 [[ -d "${outdir}" ]]  || { echo "Outdir does not exist"; exit 1; }
@@ -65,6 +68,17 @@ script_dir="$(readlink -e bbtt_global_significance/scripts)"
 PATH="${script_dir}:${PATH}"
 
 outfile="${outdir}/toy_${seed}.csv"
+
+# Record the job for the ledger of the campaign (optional: record
+# directory $BBTT_LEDGER)
+ledger() {
+    [[ -z "${BBTT_LEDGER:-}" ]] \
+        || jobLedger.py "${BBTT_LEDGER}" "$1" local --mass "${mass}" --unit "${seed}" "${@:2}" \
+        || echo "Cannot update ledger"
+}
+ledger start
+trap 'code=$?; ledger finish --exit-code "${code}" --results "${outfile}"' EXIT
+
 runDiscoveryTestStatToys.py \
     "${infile}" \
     -s "${seed}" \
@@ -72,6 +86,7 @@ runDiscoveryTestStatToys.py \
     -o "${outfile}" \
     --mu-range "${mu_range}" \
     --optimizer-strategy 1 \
+    --workers "${workers}" \
     2>&1
 
 echo "Finished: $(date)"
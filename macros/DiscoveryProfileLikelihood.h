@@ -0,0 +1,397 @@
+#ifndef DISCOVERY_PROFILE_LIKELIHOOD_H
+#define DISCOVERY_PROFILE_LIKELIHOOD_H
+
+#include "RooAbsData.h"
+#include "RooAbsPdf.h"
+#include "RooAbsReal.h"
+#include "RooArgSet.h"
+#include "RooCmdArg.h"
+#include "RooFitResult.h"
+#include "RooMinimizer.h"
+#include "RooMsgService.h"
+#include "RooRealVar.h"
+#include "TMath.h"
+#include "TStopwatch.h"
+#include "TString.h"
+#include "Math/MinimizerOptions.h"
+
+#include "RooStats/DetailedOutputAggregator.h"
+#include "RooStats/RooStatsUtils.h"
+#include "RooStats/TestStatistic.h"
+
+#include "PhaseTimer.h"
+
+#include <iostream>
+#include <memory>
+
+
+// Cost of the minimisation of one fit. Counts and times include
+// repeated attempts (e.g. a failed warm-started fit), the EDM and the
+// strategy are the ones of the last attempt.
+struct DiscoveryFitStats {
+  int nllEvals = 0;
+  // RooMinimizer::minimize calls including re-scans and retries
+  int minuitCalls = 0;
+  int strategy = 0;
+  double edm = TMath::QuietNaN();
+  double realTime = 0.0;
+  double cpuTime = 0.0;
+
+  void Add(const DiscoveryFitStats &other) {
+    nllEvals += other.nllEvals;
+    minuitCalls += other.minuitCalls;
+    strategy = other.strategy;
+    edm = other.edm;
+    realTime += other.realTime;
+    cpuTime += other.cpuTime;
+  }
+};
+
+
+// Profile likelihood ratio used as the discovery test statistic.
+//
+// The fits follow RooStats::ProfileLikelihoodTestStat (two-sided, the
+// conditional fit always runs, same minimisation and retry sequence,
+// NLL reused between datasets, -1 for failed fits), but the
+// minimisation is done here so that the starting point of the fits is
+// under control and the number of NLL evaluations per fit is known.
+//
+// Cold start (default): the unconditional fit starts from the parameter
+// values set by the caller (the prefit values), the conditional fit
+// from the unconditional best fit with the POI set to the null value.
+//
+// Warm start: like the cold start, but the unconditional fit starts
+// from the post-fit nuisance parameters of the previous evaluation
+// (e.g. the previous toy). If a warm-started fit fails, the evaluation
+// is repeated with a cold start.
+//
+// The NLL can be evaluated in parallel processes (NumCPU) and in
+// RooFit's vectorised batch mode. The parallel NLL does not support
+// exchanging the dataset, so it is rebuilt for every dataset.
+//
+// Besides the fit results the detailed output contains the cost of
+// both fits (see DiscoveryFitStats): fitUncond_/fitCond_ nllEvals,
+// minuitCalls, strategy, edm, time and cpuTime.
+class DiscoveryProfileLikelihood : public RooStats::TestStatistic {
+public:
+  explicit DiscoveryProfileLikelihood(RooAbsPdf &pdf)
+      : fPdf(&pdf),
+        fMinimizer(ROOT::Math::MinimizerOptions::DefaultMinimizerType().c_str()),
+        fStrategy(ROOT::Math::MinimizerOptions::DefaultStrategy()),
+        fTolerance(TMath::Max(1., ROOT::Math::MinimizerOptions::DefaultTolerance())),
+        fNumCPU(DefaultNumCPU()),
+        fBatchMode(DefaultBatchMode()) {}
+
+  // Likelihood evaluation of new instances (cf. MinimizerOptions)
+  static void SetDefaultNumCPU(int numCPU) { DefaultNumCPU() = numCPU; }
+  static void SetDefaultBatchMode(bool batchMode) { DefaultBatchMode() = batchMode; }
+
+  void SetPrintLevel(int printLevel) { fPrintLevel = printLevel; }
+  void SetMinimizer(const char *minimizer) { fMinimizer = minimizer; }
+  void SetStrategy(int strategy) { fStrategy = strategy; }
+  void SetTolerance(double tolerance) { fTolerance = tolerance; }
+
+  void SetNumCPU(int numCPU) {
+    fNumCPU = numCPU;
+    fNll.reset();
+  }
+  void SetBatchMode(bool batchMode) {
+    fBatchMode = batchMode;
+    fNll.reset();
+  }
+
+  void EnableDetailedOutput(bool withErrorsAndPulls = false) {
+    fDetailedOutputEnabled = true;
+    fDetailedOutputWithErrorsAndPulls = withErrorsAndPulls;
+  }
+
+  void SetWarmStart(bool warmStart) { fWarmStart = warmStart; }
+  bool GetWarmStart() const { return fWarmStart; }
+
+  Double_t Evaluate(RooAbsData &data, RooArgSet &nullPOI) override;
+
+  const RooArgSet *GetDetailedOutput() const override { return fDetailedOutput.get(); }
+  const TString GetVarName() const override { return "Profile Likelihood Ratio"; }
+
+private:
+  static int &DefaultNumCPU() {
+    static int numCPU = 1;
+    return numCPU;
+  }
+  static bool &DefaultBatchMode() {
+    static bool batchMode = false;
+    return batchMode;
+  }
+
+  double EvaluateFits(RooArgSet &attached, const RooArgSet &nullPOI,
+                      DiscoveryFitStats &uncondStats, DiscoveryFitStats &condStats);
+  RooFitResult *Minimize(DiscoveryFitStats &stats);
+  void AddDetails(RooFitResult *result, const char *prefix);
+  void AddDetails(const DiscoveryFitStats &stats, const char *prefix);
+  void AddDetail(const char *name, double value);
+
+  RooAbsPdf *fPdf;
+  std::unique_ptr<RooAbsReal> fNll;
+
+  TString fMinimizer;
+  int fStrategy;
+  double fTolerance;
+  int fPrintLevel = 1;
+  int fNumCPU;
+  bool fBatchMode;
+
+  bool fDetailedOutputEnabled = false;
+  bool fDetailedOutputWithErrorsAndPulls = false;
+  std::unique_ptr<RooArgSet> fDetailedOutput;
+
+  // Both fits of the last call of EvaluateFits converged
+  bool fFitsConverged = false;
+  // Post-fit nuisance parameters of the unconditional fit
+  std::unique_ptr<RooArgSet> fUncondValues;
+
+  bool fWarmStart = false;
+  // Starting point of the next warm-started evaluation
+  std::unique_ptr<RooArgSet> fWarmValues;
+};
+
+
+inline Double_t DiscoveryProfileLikelihood::Evaluate(RooAbsData &data, RooArgSet &nullPOI) {
+  const auto msglevel = RooMsgService::instance().globalKillBelow();
+  if (fPrintLevel < 3) {
+    RooMsgService::instance().setGlobalKillBelow(RooFit::FATAL);
+  }
+
+  if (!fNll || fNumCPU > 1) {
+    PhaseTimer::Scope phase("nll_build");
+    std::unique_ptr<RooArgSet> allParams(fPdf->getParameters(data));
+    RooStats::RemoveConstantParameters(allParams.get());
+    fNll.reset();
+    fNll.reset(fPdf->createNLL(data, RooFit::CloneData(false),
+                               RooFit::Constrain(*allParams),
+                               RooFit::Offset(RooStats::IsNLLOffset()),
+                               fNumCPU > 1 ? RooFit::NumCPU(fNumCPU) : RooCmdArg::none(),
+                               fBatchMode ? RooFit::BatchMode(true) : RooCmdArg::none()));
+  } else {
+    fNll->setData(data, false);
+  }
+
+  std::unique_ptr<RooArgSet> attached(fNll->getVariables());
+  *attached = nullPOI;
+  std::unique_ptr<RooArgSet> start((RooArgSet *)attached->snapshot());
+
+  const bool warm = fWarmStart && fWarmValues;
+  if (warm) {
+    attached->assignValueOnly(*fWarmValues);
+  }
+
+  PhaseTimer::Scope phase("fits");
+
+  // Costs include a failed warm-started attempt
+  DiscoveryFitStats uncondStats;
+  DiscoveryFitStats condStats;
+  double ts = EvaluateFits(*attached, nullPOI, uncondStats, condStats);
+
+  bool warmUsed = warm;
+  if (warm && !fFitsConverged) {
+    Info("DiscoveryProfileLikelihood", "Warm-started fit failed, retrying with cold start");
+    *attached = *start;
+    ts = EvaluateFits(*attached, nullPOI, uncondStats, condStats);
+    warmUsed = false;
+  }
+  phase.Stop();
+
+  if (fDetailedOutput) {
+    AddDetails(uncondStats, "fitUncond_");
+    AddDetails(condStats, "fitCond_");
+    AddDetail("warmStart", warmUsed);
+  }
+
+  // Next evaluation starts cold if this one did not converge
+  fWarmValues.reset();
+  if (fFitsConverged && fUncondValues) {
+    RooArgSet nuisance;
+    for (const auto param : *fUncondValues) {
+      if (!nullPOI.find(param->GetName())) {
+        nuisance.add(*param);
+      }
+    }
+    fWarmValues.reset((RooArgSet *)nuisance.snapshot());
+  }
+
+  *attached = *start;
+
+  RooMsgService::instance().setGlobalKillBelow(msglevel);
+
+  return ts;
+}
+
+
+inline double DiscoveryProfileLikelihood::EvaluateFits(
+    RooArgSet &attached, const RooArgSet &nullPOI,
+    DiscoveryFitStats &uncondStats, DiscoveryFitStats &condStats) {
+  fFitsConverged = false;
+  fUncondValues.reset();
+  fDetailedOutput.reset();
+  if (fDetailedOutputEnabled) {
+    fDetailedOutput = std::make_unique<RooArgSet>();
+  }
+
+  // Unconditional fit
+  DiscoveryFitStats stats;
+  fNll->clearEvalErrorLog();
+  std::unique_ptr<RooFitResult> uncond(Minimize(stats));
+  uncondStats.Add(stats);
+  if (!uncond) {
+    return TMath::SignalingNaN();
+  }
+
+  const double uncondML = uncond->minNll();
+  const int statusD = uncond->status();
+  fUncondValues.reset((RooArgSet *)uncond->floatParsFinal().snapshot());
+  AddDetails(uncond.get(), "fitUncond_");
+
+  // Conditional fit starting from the unconditional best fit with the
+  // POI fixed to the null value
+  attached = nullPOI;
+  for (const auto poi : nullPOI) {
+    if (const auto param = dynamic_cast<RooRealVar *>(attached.find(poi->GetName()))) {
+      param->setConstant();
+    }
+  }
+
+  RooArgSet floating(attached);
+  RooStats::RemoveConstantParameters(&floating);
+
+  double condML = 0.0;
+  int statusN = 0;
+  if (floating.getSize() == 0) {
+    condML = fNll->getVal();
+  } else {
+    fNll->clearEvalErrorLog();
+    stats = DiscoveryFitStats();
+    std::unique_ptr<RooFitResult> cond(Minimize(stats));
+    condStats.Add(stats);
+    if (!cond) {
+      return TMath::SignalingNaN();
+    }
+
+    condML = cond->minNll();
+    statusN = cond->status();
+    AddDetails(cond.get(), "fitCond_");
+  }
+
+  const double pll = condML - uncondML;
+  fFitsConverged = (statusD == 0 && statusN == 0);
+
+  if (fPrintLevel > 0) {
+    std::cout << "DiscoveryProfileLikelihood - uncond ML = " << uncondML
+              << " cond ML = " << condML << " pll = " << pll
+              << " status = " << statusD << ", " << statusN
+              << " NLL evals = " << uncondStats.nllEvals << ", " << condStats.nllEvals
+              << " time = " << uncondStats.realTime << ", " << condStats.realTime
+              << " s" << std::endl;
+  }
+
+  // Indicates a failed fit as in ProfileLikelihoodTestStat
+  if (!fFitsConverged) {
+    return -1;
+  }
+
+  return pll;
+}
+
+
+inline RooFitResult *DiscoveryProfileLikelihood::Minimize(DiscoveryFitStats &stats) {
+  TStopwatch timer;
+
+  RooMinimizer minim(*fNll);
+  minim.setStrategy(fStrategy);
+  // RooMinimizer::setPrintLevel has an offset of +1
+  minim.setPrintLevel(fPrintLevel == 0 ? -1 : fPrintLevel - 2);
+  minim.setEps(fTolerance);
+  minim.optimizeConst(2);
+
+  TString minimizer = fMinimizer;
+  TString algorithm = ROOT::Math::MinimizerOptions::DefaultMinimizerAlgo();
+  if (algorithm == "Migrad") {
+    algorithm = "Minimize";
+  }
+
+  int strategy = fStrategy;
+  int status = 0;
+  for (int tries = 1, maxtries = 4; tries <= maxtries; ++tries) {
+    status = minim.minimize(minimizer, algorithm);
+    ++stats.minuitCalls;
+    // Ignore errors from Improve
+    if (status % 1000 == 0) {
+      break;
+    }
+
+    if (tries < maxtries) {
+      std::cout << "    ----> Doing a re-scan first" << std::endl;
+      minim.minimize(minimizer, "Scan");
+      ++stats.minuitCalls;
+      if (tries == 2) {
+        if (fStrategy == 0) {
+          std::cout << "    ----> trying with strategy = 1" << std::endl;
+          strategy = 1;
+          minim.setStrategy(strategy);
+        } else {
+          // Skip this trial if strategy is already 1
+          ++tries;
+        }
+      }
+      if (tries == 3) {
+        std::cout << "    ----> trying with improve" << std::endl;
+        minimizer = "Minuit";
+        algorithm = "migradimproved";
+      }
+    }
+  }
+
+  stats.nllEvals = minim.evalCounter();
+  stats.strategy = strategy;
+
+  // The result is also saved if Migrad failed, its status marks the fit
+  // as failed (test statistic -1 as in ProfileLikelihoodTestStat) and
+  // the details of the failed fit are kept
+  RooFitResult *result = minim.save();
+  stats.edm = result->edm();
+  stats.realTime = timer.RealTime();
+  stats.cpuTime = timer.CpuTime();
+
+  return result;
+}
+
+
+inline void DiscoveryProfileLikelihood::AddDetails(RooFitResult *result, const char *prefix) {
+  if (!fDetailedOutput) {
+    return;
+  }
+
+  // GetAsArgSet only owns the clones of the parameters if the errors
+  // and pulls are added, otherwise they would leak with every fit
+  std::unique_ptr<RooArgSet> details(RooStats::DetailedOutputAggregator::GetAsArgSet(
+      result, prefix, fDetailedOutputWithErrorsAndPulls));
+  details->takeOwnership();
+  fDetailedOutput->addClone(*details);
+}
+
+
+inline void DiscoveryProfileLikelihood::AddDetails(const DiscoveryFitStats &stats,
+                                                   const char *prefix) {
+  const TString name(prefix);
+  AddDetail(name + "nllEvals", stats.nllEvals);
+  AddDetail(name + "minuitCalls", stats.minuitCalls);
+  AddDetail(name + "strategy", stats.strategy);
+  AddDetail(name + "edm", stats.edm);
+  AddDetail(name + "time", stats.realTime);
+  AddDetail(name + "cpuTime", stats.cpuTime);
+}
+
+
+inline void DiscoveryProfileLikelihood::AddDetail(const char *name, double value) {
+  fDetailedOutput->addClone(RooRealVar(name, name, value));
+}
+
+#endif
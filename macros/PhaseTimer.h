@@ -0,0 +1,120 @@
+#ifndef PHASE_TIMER_H
+#define PHASE_TIMER_H
+
+#include "TSystem.h"
+
+#include <chrono>
+#include <string>
+#include <vector>
+
+
+// Wall time, CPU time and resident memory of the phases of a job (e.g.
+// workspace loading, NLL construction, fits) for the --profile mode of
+// the fit scripts. Phases with the same name are accumulated, phases
+// can be nested. The macros report to the global timer, which is
+// disabled by default.
+class PhaseTimer {
+public:
+  static PhaseTimer &Global() {
+    static PhaseTimer timer;
+    return timer;
+  }
+
+  // Phase of the global timer that ends with Stop() or at the end of
+  // the scope
+  class Scope {
+  public:
+    explicit Scope(const char *name) { Global().Start(name); }
+    ~Scope() { Stop(); }
+
+    void Stop() {
+      if (fRunning) {
+        Global().Stop();
+        fRunning = false;
+      }
+    }
+
+  private:
+    bool fRunning = true;
+  };
+
+  void SetEnabled(bool enabled) { fEnabled = enabled; }
+  bool IsEnabled() const { return fEnabled; }
+
+  void Start(const char *name);
+  // Stops the most recently started phase
+  void Stop();
+
+  int GetNPhases() const { return fPhases.size(); }
+  const std::string &GetName(int i) const { return fPhases[i].name; }
+  int GetCount(int i) const { return fPhases[i].count; }
+  double GetRealTime(int i) const { return fPhases[i].realTime; }
+  double GetCpuTime(int i) const { return fPhases[i].cpuTime; }
+  // Resident memory at the end of the last call of the phase
+  double GetResidentMB(int i) const { return fPhases[i].residentMB; }
+
+private:
+  struct Phase {
+    std::string name;
+    int count = 0;
+    double realTime = 0.0;
+    double cpuTime = 0.0;
+    double residentMB = 0.0;
+  };
+
+  struct Running {
+    int index;
+    std::chrono::steady_clock::time_point start;
+    double cpuStart;
+  };
+
+  static double CpuTime(ProcInfo_t &info) {
+    gSystem->GetProcInfo(&info);
+    return info.fCpuUser + info.fCpuSys;
+  }
+
+  bool fEnabled = false;
+  std::vector<Phase> fPhases;
+  std::vector<Running> fRunning;
+};
+
+
+inline void PhaseTimer::Start(const char *name) {
+  if (!fEnabled) {
+    return;
+  }
+
+  int index = 0;
+  while (index < GetNPhases() && fPhases[index].name != name) {
+    ++index;
+  }
+  if (index == GetNPhases()) {
+    fPhases.emplace_back();
+    fPhases.back().name = name;
+  }
+
+  ProcInfo_t info;
+  fRunning.push_back({index, std::chrono::steady_clock::now(), CpuTime(info)});
+}
+
+
+inline void PhaseTimer::Stop() {
+  if (fRunning.empty()) {
+    return;
+  }
+
+  const Running running = fRunning.back();
+  fRunning.pop_back();
+
+  ProcInfo_t info;
+  const double cpu = CpuTime(info);
+  const std::chrono::duration<double> real = std::chrono::steady_clock::now() - running.start;
+
+  Phase &phase = fPhases[running.index];
+  ++phase.count;
+  phase.realTime += real.count();
+  phase.cpuTime += cpu - running.cpuStart;
+  phase.residentMB = info.fMemResident / 1024.;
+}
+
+#endif
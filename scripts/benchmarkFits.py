@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+import argparse
+import csv
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from common import mu_ranges, parse_toys
+
+parser = argparse.ArgumentParser(
+    description="Benchmarks the fits of runDiscoveryTestStat.py (global toys) and "
+    "runDiscoveryTestStatToys.py (toys of the test statistic) on fixed workspaces and seeds "
+    "for a sweep of optimizer settings and mu ranges. Records the fit throughput, latency, "
+    "failure rate, peak memory and the agreement of q0 with the reference settings.")
+parser.add_argument("workspace", help="Workspace file, '{mass}' is replaced by the mass")
+parser.add_argument("-m", "--masses", default="300,500,1000",
+                    help="Comma-separated mass points (default: %(default)s)")
+parser.add_argument("--paths", default="fits,toys",
+                    help="Benchmarked scripts: 'fits' (runDiscoveryTestStat.py --jobs) and / or "
+                    "'toys' (runDiscoveryTestStatToys.py) (default: %(default)s)")
+
+parser.add_argument("-t", "--toys", default="0-19",
+                    help="Global toys fitted by 'fits', used as globs index (default: %(default)s)")
+parser.add_argument("--globs-tree", default="",
+                    help="Tree containing the global observables ('{mass}' is replaced)")
+parser.add_argument("-s", "--seed", type=int, default=1234,
+                    help="Seed of 'toys' (default: %(default)s)")
+parser.add_argument("-n", "--ntoys", type=int, default=20,
+                    help="Number of toys of 'toys' (default: %(default)s)")
+
+parser.add_argument("--optimizers", default="Minuit2,Minuit",
+                    help="Comma-separated optimizers (default: %(default)s)")
+parser.add_argument("--strategies", default="1,0,2",
+                    help="Comma-separated optimizer strategies (default: %(default)s)")
+parser.add_argument("--mu-range-scales", default="1",
+                    help="Comma-separated factors applied to the mu range of the mass point "
+                    "(mu_ranges in common.py) (default: %(default)s)")
+parser.add_argument("--tolerance", type=float, default=0.01,
+                    help="Maximum absolute difference of q0 to the reference (default: %(default)s)")
+
+parser.add_argument("--tag", default="",
+                    help="Label of this benchmark (e.g. the version) stored in the output")
+parser.add_argument("-o", "--outdir", default="benchmark",
+                    help="Directory for the fit outputs, benchmark.json and benchmark.csv")
+args = parser.parse_args()
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Phase of the profile containing the fits
+fit_phases = {"fits": "fit", "toys": "generate"}
+
+fieldnames = [
+    "path", "mass", "optimizer", "strategy", "mu_range_scale", "mu_range",
+    "fits", "failed", "failure_rate", "fits_per_s",
+    "latency_p50", "latency_p95", "latency_max",
+    "peak_rss_mb", "max_dq0", "agree_fraction", "reference",
+]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=script_dir,
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def command(path, mass, optimizer, strategy, mu_range, outfile, profilefile, jobsfile):
+    cmd = [sys.executable]
+    if path == "fits":
+        cmd += [os.path.join(script_dir, "runDiscoveryTestStat.py"),
+                args.workspace.format(mass=mass), "-m", str(mass), "--jobs", jobsfile]
+        if args.globs_tree:
+            cmd += ["--globs-tree", args.globs_tree.format(mass=mass)]
+    else:
+        cmd += [os.path.join(script_dir, "runDiscoveryTestStatToys.py"),
+                args.workspace.format(mass=mass), "-s", str(args.seed), "-n", str(args.ntoys)]
+
+    return cmd + ["-o", outfile, "--profile", profilefile, "--mu-range", str(mu_range),
+                  "--optimizer", optimizer, "--optimizer-strategy", str(strategy)]
+
+
+# Runs one setting, returns the rows by toy index and the profile of
+# the job (None if the job failed)
+def run(path, mass, optimizer, strategy, scale, jobsfile):
+    name = "{}_m{}_{}_s{}_mu{}".format(path, mass, optimizer, strategy, scale)
+    outfile = os.path.join(args.outdir, name + ".csv")
+    profilefile = os.path.join(args.outdir, name + ".json")
+    logfile = os.path.join(args.outdir, name + ".log")
+    mu_range = scale * mu_ranges.get(mass, 15.)
+
+    cmd = command(path, mass, optimizer, strategy, mu_range, outfile, profilefile, jobsfile)
+    with open(logfile, "w") as log:
+        ret = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT)
+
+    if ret != 0:
+        print("{} failed (see {})".format(name, logfile))
+        return None, None, mu_range
+
+    with open(outfile) as f:
+        rows = dict((int(row["index"]), row) for row in csv.DictReader(f))
+    with open(profilefile) as f:
+        profile = json.load(f)
+
+    return rows, profile, mu_range
+
+
+def failed(row):
+    return float(row["uncond_status"]) != 0 or float(row["cond_status"]) != 0
+
+
+def summarize(path, rows, profile, reference):
+    fit_wall = sum(phase["wall"] for phase in profile["phases"]
+                   if phase["name"] == fit_phases[path])
+    latency = np.array([float(row["uncond_time"]) + float(row["cond_time"])
+                        for row in rows.values()])
+    nfailed = sum(failed(row) for row in rows.values())
+
+    result = {
+        "fits": len(rows),
+        "failed": nfailed,
+        "failure_rate": float(nfailed) / max(len(rows), 1),
+        "fits_per_s": len(rows) / fit_wall if fit_wall > 0 else None,
+        "latency_p50": np.percentile(latency, 50) if len(latency) else None,
+        "latency_p95": np.percentile(latency, 95) if len(latency) else None,
+        "latency_max": latency.max() if len(latency) else None,
+        "peak_rss_mb": profile["total"]["peak_rss_mb"],
+        "max_dq0": None,
+        "agree_fraction": None,
+    }
+
+    # Agreement of q0 for the toys converging with both settings
+    if reference is not None:
+        dq0 = [abs(float(row["q0"]) - float(reference[index]["q0"]))
+               for index, row in rows.items()
+               if index in reference and not failed(row) and not failed(reference[index])]
+        if dq0:
+            result["max_dq0"] = max(dq0)
+            result["agree_fraction"] = np.mean(np.array(dq0) <= args.tolerance)
+
+    return result
+
+
+def fmt(result, key, spec):
+    value = result.get(key)
+    return "-" if value is None else spec.format(value)
+
+
+if not os.path.isdir(args.outdir):
+    os.makedirs(args.outdir)
+
+jobsfile = os.path.join(args.outdir, "jobs.csv")
+with open(jobsfile, "w") as f:
+    for toy in parse_toys(args.toys):
+        f.write("{},{}\n".format(toy, toy))
+
+# The first optimizer, strategy and scale are the reference settings
+settings = list(itertools.product(
+    args.optimizers.split(","),
+    [int(strategy) for strategy in args.strategies.split(",")],
+    [float(scale) for scale in args.mu_range_scales.split(",")]))
+
+start_time = time.time()
+results = []
+for path in args.paths.split(","):
+    if path not in fit_phases:
+        sys.exit("Unknown path: {}".format(path))
+
+    for mass in [int(mass) for mass in args.masses.split(",")]:
+        reference = None
+        for optimizer, strategy, scale in settings:
+            rows, profile, mu_range = run(path, mass, optimizer, strategy, scale, jobsfile)
+
+            result = {"path": path, "mass": mass, "optimizer": optimizer,
+                      "strategy": strategy, "mu_range_scale": scale, "mu_range": mu_range,
+                      "reference": reference is None}
+            if rows is not None:
+                result.update(summarize(path, rows, profile, reference))
+                if reference is None:
+                    reference = rows
+            results.append(result)
+
+            print("{:<5} {:>5} {:<7} s{} mu x{:<4} {:>7} fits/s  p50 {:>7} s  p95 {:>7} s  "
+                  "failed {:>6}  rss {:>6} MB  max |dq0| {}".format(
+                      path, mass, optimizer, strategy, scale,
+                      fmt(result, "fits_per_s", "{:.2f}"),
+                      fmt(result, "latency_p50", "{:.3f}"),
+                      fmt(result, "latency_p95", "{:.3f}"),
+                      fmt(result, "failure_rate", "{:.1%}"),
+                      fmt(result, "peak_rss_mb", "{:.0f}"),
+                      fmt(result, "max_dq0", "{:.2e}")))
+
+# numpy scalars are not JSON serialisable
+results = [dict((key, value.item() if isinstance(value, np.generic) else value)
+                for key, value in result.items()) for result in results]
+
+benchmark = {
+    "tag": args.tag,
+    "revision": git_revision(),
+    "host": socket.gethostname(),
+    "argv": sys.argv,
+    "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+    "wall": time.time() - start_time,
+    "results": results,
+}
+
+with open(os.path.join(args.outdir, "benchmark.json"), "w") as f:
+    json.dump(benchmark, f, indent=2)
+
+with open(os.path.join(args.outdir, "benchmark.csv"), "w") as f:
+    writer = csv.DictWriter(f, fieldnames=fieldnames)
+    writer.writeheader()
+    writer.writerows(results)
+
+print("Results written to {}".format(os.path.join(args.outdir, "benchmark.{json,csv}")))
@@ -0,0 +1,212 @@
+import os
+import re
+import subprocess
+import time
+
+from ledger import JobLedger
+
+
+# Scheduling of the units of a toy campaign on a backend. All units are
+# queued at once and at most max_jobs of them run at the same time.
+# Units that fail (exit code or invalid output) are resubmitted up to
+# max_attempts times. Progress is recorded in the job ledger, units
+# that are done in the ledger are skipped, so an interrupted campaign
+# continues where it stopped.
+#
+# A backend implements submit(name, command) -> handle, poll(handle)
+# -> exit code (None while running) and cancel(handle).
+
+
+class Unit(object):
+    def __init__(self, mass, unit, command, outfile):
+        self.mass = mass
+        self.unit = unit
+        self.command = command
+        self.outfile = outfile
+        self.attempts = 0
+        self.handle = None
+
+    @property
+    def name(self):
+        return "m{}_{}".format(self.mass, self.unit)
+
+
+# Runs the units as processes on this machine
+class LocalBackend(object):
+    poll_interval = 1.
+
+    def __init__(self, logdir):
+        self.logdir = logdir
+
+    def submit(self, name, command):
+        with open(os.path.join(self.logdir, name + ".log"), "a") as log:
+            return subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+
+    def poll(self, handle):
+        return handle.poll()
+
+    def cancel(self, handle):
+        handle.terminate()
+        handle.wait()
+
+    # Host for the ledger (None: this host)
+    def host(self, handle):
+        return None
+
+
+# Argument of the new syntax of the Arguments command of HTCondor: in
+# single quotes, embedded single and double quotes are doubled
+def condor_argument(arg):
+    if "\n" in arg:
+        raise ValueError("Newline in HTCondor argument: {!r}".format(arg))
+
+    return "'{}'".format(arg.replace("'", "''").replace('"', '""'))
+
+
+# Submits every unit as a cluster of one job to HTCondor. The exit code
+# is taken from the user log of the job. options are additional lines
+# of the submit description (e.g. requirements, Request_memory).
+class CondorBackend(object):
+    poll_interval = 30.
+
+    terminated = re.compile(r"\(1\) Normal termination \(return value (\d+)\)")
+
+    def __init__(self, logdir, options=()):
+        self.logdir = logdir
+        self.options = list(options)
+
+    def submit(self, name, command):
+        log = os.path.join(self.logdir, name)
+        if os.path.exists(log + ".log"):
+            os.remove(log + ".log")
+
+        description = "\n".join(self.options + [
+            "Universe = vanilla",
+            "Executable = {}".format(command[0]),
+            "Arguments = \"{}\"".format(" ".join(condor_argument(arg) for arg in command[1:])),
+            "Transfer_executable = True",
+            "Output = {}.out".format(log),
+            "Error = {}.err".format(log),
+            "Log = {}.log".format(log),
+            "Queue",
+        ]) + "\n"
+
+        proc = subprocess.Popen(["condor_submit", "-terse"], stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, universal_newlines=True)
+        out, _ = proc.communicate(description)
+        if proc.returncode != 0:
+            raise RuntimeError("condor_submit failed for {}".format(name))
+
+        # Output: '<cluster>.0 - <cluster>.0'
+        return out.split(".")[0].strip(), log + ".log"
+
+    def poll(self, handle):
+        _, log = handle
+        if not os.path.exists(log):
+            return None
+
+        with open(log) as f:
+            content = f.read()
+
+        m = self.terminated.search(content)
+        if m:
+            return int(m.group(1))
+        if "Job was aborted" in content or "Abnormal termination" in content:
+            return -1
+
+        return None
+
+    def cancel(self, handle):
+        subprocess.call(["condor_rm", handle[0]])
+
+    def host(self, handle):
+        return "condor:{}".format(handle[0])
+
+
+backends = {"local": LocalBackend, "condor": CondorBackend}
+
+
+class Campaign(object):
+    # validate(unit) checks the output of a finished unit (default: the
+    # output exists)
+    def __init__(self, backend, ledger_path, kind="local", max_jobs=1, max_attempts=3,
+                 validate=None):
+        self.backend = backend
+        self.ledger = JobLedger(ledger_path)
+        self.kind = kind
+        self.max_jobs = max_jobs
+        self.max_attempts = max_attempts
+        self.validate = validate or (lambda unit: os.path.exists(unit.outfile))
+
+    def _submit(self, unit):
+        unit.attempts += 1
+        unit.handle = self.backend.submit(unit.name, unit.command)
+        self.ledger.start(self.kind, [unit.mass], unit.unit, self.backend.host(unit.handle))
+
+    def _finish(self, unit, exit_code):
+        try:
+            failed = exit_code != 0 or not self.validate(unit)
+        except Exception as e:
+            print("Invalid output of {}: {}".format(unit.name, e))
+            failed = True
+
+        self.ledger.finish(self.kind, [unit.mass], unit.unit, failed=failed)
+        unit.handle = None
+
+        return failed
+
+    # Runs all units that are not done in the ledger. Returns the units
+    # that failed in all attempts.
+    def run(self, units):
+        done = set((row["mass"], row["unit"]) for row in self.ledger.query(self.kind, "all")
+                   if row["status"] == "done")
+        for mass in sorted(set(unit.mass for unit in units)):
+            self.ledger.expect(self.kind, [mass],
+                               [unit.unit for unit in units if unit.mass == mass])
+
+        queue = [unit for unit in units if (unit.mass, unit.unit) not in done]
+        queue.reverse()
+        running = []
+        failed = []
+        num_done = len(units) - len(queue)
+        start = time.time()
+
+        print("{} units, {} done before".format(len(units), num_done))
+
+        try:
+            while queue or running:
+                while queue and len(running) < self.max_jobs:
+                    unit = queue.pop()
+                    self._submit(unit)
+                    running.append(unit)
+
+                time.sleep(self.backend.poll_interval)
+
+                for unit in list(running):
+                    exit_code = self.backend.poll(unit.handle)
+                    if exit_code is None:
+                        continue
+
+                    running.remove(unit)
+                    if not self._finish(unit, exit_code):
+                        num_done += 1
+                    elif unit.attempts < self.max_attempts:
+                        print("Unit {} failed (exit code {}), resubmitting".format(
+                            unit.name, exit_code))
+                        queue.append(unit)
+                    else:
+                        print("Unit {} failed {} times".format(unit.name, unit.attempts))
+                        failed.append(unit)
+
+                    print("[{:.0f} s] {}/{} done, {} running, {} queued, {} failed".format(
+                        time.time() - start, num_done, len(units), len(running), len(queue),
+                        len(failed)))
+        except KeyboardInterrupt:
+            print("Interrupted, cancelling {} running units".format(len(running)))
+            for unit in running:
+                self.backend.cancel(unit.handle)
+            raise
+        finally:
+            self.ledger.close()
+
+        return failed
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+import argparse
+import csv
+import sys
+import time
+
+import numpy as np
+
+from common import load_macro, mu_ranges, resident_mb
+
+parser = argparse.ArgumentParser(
+    description="Calls an entry point of the fit macros many times in one process and reports "
+    "the resident memory per iteration. Fails (exit code 1) if the memory grows by more than "
+    "--max-growth-mb after the warm-up.")
+parser.add_argument("infile")
+parser.add_argument("--entry", choices=["fit", "fitter", "toys", "generator"], default="fit",
+                    help="fit: DiscoveryTestStat() (new fitter per call), fitter: Fit() of one "
+                    "DiscoveryTestStatFitter, toys: DiscoveryTestStatToys() (new generator per "
+                    "call), generator: Generate() of one DiscoveryTestStatToysGenerator "
+                    "(default: %(default)s)")
+parser.add_argument("-n", "--iterations", type=int, default=200)
+parser.add_argument("--warmup", type=int, default=20,
+                    help="Iterations before the reference memory is taken (default: %(default)s)")
+parser.add_argument("--max-growth-mb", type=float, default=20.,
+                    help="Maximum growth of the resident memory after the warm-up "
+                    "(default: %(default)s)")
+parser.add_argument("-o", "--outfile", default=None,
+                    help="Write the memory per iteration to a CSV file")
+parser.add_argument("--report-every", type=int, default=10)
+
+parser.add_argument("-m", "--mass", type=int, default=None)
+parser.add_argument("--mu-range", type=float, default=None,
+                    help="Range of the POI (default: from the mass point, otherwise 15)")
+parser.add_argument("--globs-tree", default="",
+                    help="Tree containing the global observables (fit / fitter)")
+parser.add_argument("--globs-entries", type=int, default=1,
+                    help="Iteration i uses the globs index i modulo N (default: %(default)s)")
+
+parser.add_argument("--workspace-name", default="combined")
+parser.add_argument("--model-config", default="ModelConfig")
+parser.add_argument("--data-name", default="obsData")
+args = parser.parse_args()
+
+if args.iterations <= args.warmup:
+    parser.error("--iterations must be larger than --warmup")
+
+mu_range = args.mu_range
+if mu_range is None:
+    mu_range = mu_ranges.get(args.mass, 15.)
+
+import ROOT as R
+R.gROOT.SetBatch(True)
+load_macro("DiscoveryTestStatToys.C" if args.entry in ("toys", "generator")
+           else "DiscoveryTestStat.C")
+
+
+def make_iteration():
+    if args.entry == "fit":
+        def iteration(i):
+            R.DiscoveryTestStat(args.infile, args.workspace_name, args.model_config,
+                                args.data_name, mu_range, args.globs_tree,
+                                i % args.globs_entries)
+        return iteration
+
+    if args.entry == "toys":
+        def iteration(i):
+            details = R.DiscoveryTestStatToys(args.infile, args.workspace_name,
+                                              args.model_config, args.data_name, 1, mu_range)
+            R.SetOwnership(details, True)
+        return iteration
+
+    if args.entry == "fitter":
+        fitter = R.DiscoveryTestStatFitter(args.infile, args.workspace_name, args.model_config,
+                                           args.data_name, False)
+        if not fitter.IsValid():
+            sys.exit("Cannot set up fit for {}".format(args.infile))
+        fitter.SetMuRange(mu_range)
+
+        def iteration(i):
+            fitter.SetGlobs(args.globs_tree, i % args.globs_entries)
+            fitter.Fit()
+        return iteration
+
+    generator = R.DiscoveryTestStatToysGenerator(args.infile, args.workspace_name,
+                                                 args.model_config, args.data_name, mu_range)
+    if not generator.IsValid():
+        sys.exit("Cannot set up toys for {}".format(args.infile))
+
+    def iteration(i):
+        details = generator.Generate(1)
+        R.SetOwnership(details, True)
+    return iteration
+
+
+iteration = make_iteration()
+
+rows = []
+start_time = time.time()
+for i in range(args.iterations):
+    iteration(i)
+    rows.append({"iteration": i, "rss_mb": resident_mb(), "time": time.time() - start_time})
+
+    if (i + 1) % args.report_every == 0:
+        reference = rows[min(i, args.warmup)]["rss_mb"]
+        print("Iteration {}: {:.1f} MB ({:+.1f} MB since warm-up)".format(
+            i + 1, rows[-1]["rss_mb"], rows[-1]["rss_mb"] - reference))
+
+if args.outfile:
+    with open(args.outfile, "w") as f:
+        writer = csv.DictWriter(f, fieldnames=["iteration", "rss_mb", "time"])
+        writer.writeheader()
+        writer.writerows(rows)
+
+# Growth after the warm-up: difference of the memory at the end and
+# the start (medians of 5 iterations against fluctuations) and the
+# slope of a linear fit
+rss = np.array([row["rss_mb"] for row in rows[args.warmup:]])
+growth = np.median(rss[-5:]) - np.median(rss[:5])
+slope = np.polyfit(np.arange(len(rss)), rss, 1)[0]
+
+print("Memory after warm-up: {:.1f} MB, at the end: {:.1f} MB".format(rss[0], rss[-1]))
+print("Growth: {:.1f} MB in {} iterations ({:.3f} MB per iteration)".format(
+    growth, len(rss), slope))
+
+if growth > args.max_growth_mb:
+    sys.exit("Memory grows by {:.1f} MB (maximum {:.1f} MB)".format(growth, args.max_growth_mb))
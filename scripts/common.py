@@ -0,0 +1,339 @@
+import contextlib
+import errno
+import fcntl
+import getpass
+import hashlib
+import json
+import os
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+
+# Directory containing the ROOT macros
+macro_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "macros"))
+
+
+def macro_cache_dir():
+    default = os.path.join(tempfile.gettempdir(),
+                           "bbtt_macro_cache_{}".format(getpass.getuser()))
+    return os.environ.get("BBTT_MACRO_CACHE", default)
+
+
+def macro_cache_key(R):
+    # Any change to the macros, ROOT or the compiler requires a rebuild
+    key = hashlib.sha256()
+    for fn in sorted(os.listdir(macro_path)):
+        if not fn.endswith((".C", ".h")):
+            continue
+
+        key.update(fn.encode("utf-8"))
+        with open(os.path.join(macro_path, fn), "rb") as f:
+            key.update(f.read())
+
+    key.update(R.gROOT.GetVersion().encode("utf-8"))
+    key.update(R.gSystem.GetBuildCompiler().encode("utf-8"))
+    key.update(R.gSystem.GetBuildCompilerVersion().encode("utf-8"))
+    key.update(R.gSystem.GetBuildArch().encode("utf-8"))
+
+    return key.hexdigest()[:16]
+
+
+# Loads a macro from the macro directory compiled with ACLiC.
+#
+# The macros are copied to a content-addressed directory in the macro
+# cache (BBTT_MACRO_CACHE, default in the temp. directory) and
+# compiled there. Later jobs on the same node load the existing
+# library instead of running ACLiC again.
+def load_macro(name):
+    import ROOT as R
+
+    start_time = time.time()
+
+    build_dir = os.path.join(macro_cache_dir(), macro_cache_key(R))
+    libname = os.path.splitext(name)[0] + "_C." + R.gSystem.GetSoExt()
+    cached = False
+
+    try:
+        if not os.path.isdir(build_dir):
+            os.makedirs(build_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            print("Cannot create macro cache {}: {}".format(build_dir, e))
+            build_dir = None
+
+    if build_dir is None:
+        # No cache available: compile next to the sources
+        ok = R.gSystem.CompileMacro(os.path.join(macro_path, name), "k")
+    else:
+        # Only one process per node compiles, the others wait and load
+        with open(os.path.join(build_dir, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            cached = os.path.exists(os.path.join(build_dir, libname))
+
+            for fn in os.listdir(macro_path):
+                dest = os.path.join(build_dir, fn)
+                if fn.endswith((".C", ".h")) and not os.path.exists(dest):
+                    shutil.copy(os.path.join(macro_path, fn), dest + ".tmp")
+                    os.rename(dest + ".tmp", dest)
+
+            ok = R.gSystem.CompileMacro(os.path.join(build_dir, name), "k")
+
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    if not ok:
+        raise RuntimeError("Cannot compile macro {}".format(name))
+
+    print("Loaded {} in {:.2f} s ({})".format(
+        name, time.time() - start_time, "cached" if cached else "compiled"))
+
+
+# Resident memory of this process in MB
+def resident_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024.**2
+    except (IOError, OSError):
+        return float("nan")
+
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+# Profile of the phases of a job (--profile): wall time, CPU time and
+# resident memory of the python phases and of the phases recorded by
+# the macros (PhaseTimer), written to one JSON file per job. Optionally
+# the job runs in cProfile (stats written to <outfile>.prof) and RooTrace
+# object counts are printed at the end. All methods do nothing if
+# outfile is None.
+class PhaseProfile(object):
+    def __init__(self, outfile, cprofile=False):
+        self.outfile = outfile
+        self.phases = []
+        self.start_wall = time.time()
+        self.start_cpu = cpu_time()
+        self.info = {}
+        self.root_trace = False
+
+        self.cprofile = None
+        if outfile and cprofile:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.outfile:
+            yield
+            return
+
+        wall = time.time()
+        cpu = cpu_time()
+        try:
+            yield
+        finally:
+            for phase in self.phases:
+                if phase["name"] == name:
+                    break
+            else:
+                phase = {"name": name, "count": 0, "wall": 0., "cpu": 0.}
+                self.phases.append(phase)
+
+            phase["count"] += 1
+            phase["wall"] += time.time() - wall
+            phase["cpu"] += cpu_time() - cpu
+            phase["rss_mb"] = resident_mb()
+
+    # Enables the phases of the macros and RooTrace (after loading them)
+    def enable_root(self, root_trace=False):
+        if not self.outfile:
+            return
+
+        import ROOT as R
+        R.PhaseTimer.Global().SetEnabled(True)
+        if root_trace:
+            R.RooTrace.active(True)
+            self.root_trace = True
+
+    def write(self):
+        if not self.outfile:
+            return
+
+        if self.cprofile:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.outfile + ".prof")
+
+        root_phases = []
+        if "ROOT" in sys.modules and hasattr(sys.modules["ROOT"], "PhaseTimer"):
+            timer = sys.modules["ROOT"].PhaseTimer.Global()
+            for i in range(timer.GetNPhases()):
+                root_phases.append({
+                    "name": str(timer.GetName(i)),
+                    "count": timer.GetCount(i),
+                    "wall": timer.GetRealTime(i),
+                    "cpu": timer.GetCpuTime(i),
+                    "rss_mb": timer.GetResidentMB(i),
+                })
+
+        if self.root_trace:
+            sys.modules["ROOT"].RooTrace.printObjectCounts()
+
+        profile = {
+            "host": socket.gethostname(),
+            "argv": sys.argv,
+            "info": self.info,
+            "phases": self.phases,
+            "root_phases": root_phases,
+            "total": {
+                "wall": time.time() - self.start_wall,
+                "cpu": cpu_time() - self.start_cpu,
+                "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+            },
+        }
+
+        with open(self.outfile, "w") as f:
+            json.dump(profile, f, indent=2)
+
+
+# Mass points of the global significance
+masses = [251, 260, 280, 300, 325, 350, 375, 400, 450, 500, 550,
+          600, 700, 800, 900, 1000, 1100, 1200, 1400, 1600]
+
+# Range of the POI per mass point for better fit convergence
+mu_ranges = {
+    251: 10.0,
+    260: 18.0,
+    280: 18.0,
+    300: 14.0,
+    325: 13.0,
+    350: 8.0,
+    375: 5.0,
+    400: 4.0,
+    450: 2.0,
+    500: 2.0,
+    550: 1.0,
+    600: 0.8,
+    700: 0.6,
+    800: 0.6,
+    900: 0.6,
+    1000: 0.6,
+    1100: 0.6,
+    1200: 0.6,
+    1400: 0.6,
+    1600: 0.6,
+}
+
+
+# Toy indices from 'N' or an inclusive range 'A-B'
+def parse_toys(toys):
+    first, _, last = toys.partition("-")
+    return list(range(int(first), int(last or first) + 1))
+
+
+# Columns of the fit results of DiscoveryTestStat
+fit_fieldnames = [
+    "index", "mass", "q0", "muhat",
+    "muhat_pull",
+    "uncond_status", "uncond_minNLL",
+    "cond_status", "cond_minNLL",
+    "cond_zhf", "uncond_zhf",
+    "cond_ttbar", "uncond_ttbar",
+    "mu_range",
+    "uncond_covQual", "cond_covQual",
+    "uncond_nllEvals", "cond_nllEvals", "warm_start",
+    "retry_method",
+    "uncond_time", "cond_time",
+    "uncond_edm", "cond_edm",
+    "uncond_minuitCalls", "cond_minuitCalls",
+    "uncond_strategy", "cond_strategy",
+]
+
+
+def print_fit_result(ret):
+    # Warning: test statistic is the likelihood ratio and not q0: q0 = 2 * LLR
+    print("Likelihood-ratio: {:.5f}".format(ret.ts))
+    print("q0: {:.5f}".format(2 * ret.ts))
+    print("muhat: {:.5f}".format(ret.muhat))
+    print("muhat pull: {:.5f}".format(ret.muhat_pull))
+    print("uncond_status: {}".format(ret.uncond_status))
+    print("uncond_minNLL: {}".format(ret.uncond_minNLL))
+    print("cond_status: {}".format(ret.cond_status))
+    print("cond_minNLL: {}".format(ret.cond_minNLL))
+    print("cond_zhf: {}".format(ret.cond_zhf))
+    print("uncond_zhf: {}".format(ret.uncond_zhf))
+    print("cond_ttbar: {}".format(ret.cond_ttbar))
+    print("uncond_ttbar: {}".format(ret.uncond_ttbar))
+    print("cond_covQual: {}".format(ret.cond_covQual))
+    print("uncond_covQual: {}".format(ret.uncond_covQual))
+    print("uncond_nllEvals: {}".format(ret.uncond_nllEvals))
+    print("cond_nllEvals: {}".format(ret.cond_nllEvals))
+    print("warm_start: {}".format(ret.warm_start))
+    print("uncond_time: {:.3f} s".format(ret.uncond_time))
+    print("cond_time: {:.3f} s".format(ret.cond_time))
+    print("uncond_edm: {}".format(ret.uncond_edm))
+    print("cond_edm: {}".format(ret.cond_edm))
+    print("uncond_minuitCalls: {}".format(ret.uncond_minuitCalls))
+    print("cond_minuitCalls: {}".format(ret.cond_minuitCalls))
+    print("uncond_strategy: {}".format(ret.uncond_strategy))
+    print("cond_strategy: {}".format(ret.cond_strategy))
+
+
+def make_fit_row(ret, index, mass, mu_range, retry_method=""):
+    return {
+        "index": index,
+        "mass": mass,
+        "q0": 2 * ret.ts,
+        "muhat": ret.muhat,
+        "muhat_pull": ret.muhat_pull,
+        "uncond_status": ret.uncond_status,
+        "uncond_minNLL": ret.uncond_minNLL,
+        "cond_status": ret.cond_status,
+        "cond_minNLL": ret.cond_minNLL,
+        "cond_zhf": ret.cond_zhf,
+        "uncond_zhf": ret.uncond_zhf,
+        "cond_ttbar": ret.cond_ttbar,
+        "uncond_ttbar": ret.uncond_ttbar,
+        "mu_range": mu_range,
+        "uncond_covQual": ret.uncond_covQual,
+        "cond_covQual": ret.cond_covQual,
+        "uncond_nllEvals": ret.uncond_nllEvals,
+        "cond_nllEvals": ret.cond_nllEvals,
+        "warm_start": ret.warm_start,
+        "retry_method": retry_method,
+        "uncond_time": ret.uncond_time,
+        "cond_time": ret.cond_time,
+        "uncond_edm": ret.uncond_edm,
+        "cond_edm": ret.cond_edm,
+        "uncond_minuitCalls": ret.uncond_minuitCalls,
+        "cond_minuitCalls": ret.cond_minuitCalls,
+        "uncond_strategy": ret.uncond_strategy,
+        "cond_strategy": ret.cond_strategy,
+    }
+
+
+# Rows of all fits attempted by the retry ladder
+def make_retry_rows(results, index, mass):
+    rows = []
+    for ret in results:
+        print("Retry method: {}".format(ret.retry_method))
+        print_fit_result(ret)
+        rows.append(make_fit_row(ret, index, mass, ret.mu_range, str(ret.retry_method)))
+
+    return rows
+
+
+# Adds the pseudo-data sources ('[CHANNEL=]FILE') to a
+# DiscoveryTestStatFitter. Returns False if a file cannot be read.
+def add_pseudo_data_sources(fitter, sources):
+    for source in sources:
+        channel, _, filename = source.rpartition("=")
+        if not fitter.AddPseudoDataSource(channel or ".*", filename):
+            return False
+
+    return True
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+import argparse
+import csv
+import json
+import os
+import subprocess
+import sys
+
+from common import masses, parse_toys
+
+parser = argparse.ArgumentParser(
+    description="Compares the likelihood evaluation modes (--num-cpu, --batch-mode) of "
+    "runDiscoveryTestStat.py: checks that q0 agrees with the default evaluation and "
+    "reports the speedup per mass point")
+parser.add_argument("workspace", help="Workspace file, '{mass}' is replaced by the mass")
+parser.add_argument("-m", "--masses", default=",".join(str(m) for m in masses),
+                    help="Comma-separated mass points (default: all)")
+parser.add_argument("-t", "--toys", default="0-4",
+                    help="Toy indices 'N' or inclusive range 'A-B', used as globs index "
+                    "(default: %(default)s)")
+parser.add_argument("--globs-tree", default="",
+                    help="Tree containing the global observables ('{mass}' is replaced)")
+parser.add_argument("--modes", default="batch,cpu2,cpu4,batch+cpu4",
+                    help="Comma-separated modes compared to the default evaluation: 'batch', "
+                    "'cpuN' or combinations joined by '+' (default: %(default)s)")
+parser.add_argument("--tolerance", type=float, default=0.01,
+                    help="Maximum absolute difference of q0 (default: %(default)s)")
+parser.add_argument("--optimizer-strategy", type=int, default=1)
+parser.add_argument("--optimizer", choices=["Minuit2", "Minuit"], default="Minuit2")
+parser.add_argument("-o", "--outdir", default="likelihood_modes",
+                    help="Directory for the fit results and summary.csv")
+args = parser.parse_args()
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "runDiscoveryTestStat.py")
+
+
+# Command line options of runDiscoveryTestStat.py for a mode
+def mode_options(mode):
+    options = []
+    for part in mode.split("+"):
+        if part == "default":
+            continue
+        elif part == "batch":
+            options.append("--batch-mode")
+        elif part.startswith("cpu") and part[3:].isdigit():
+            options += ["--num-cpu", part[3:]]
+        else:
+            sys.exit("Unknown likelihood mode: {}".format(part))
+
+    return options
+
+
+# Fits all toys of a mass point in one process, returns the rows by
+# toy index and the wall time of the fits. The time is taken from the
+# phase profile of the job since it has to include the construction of
+# the NLL, which is repeated for every toy with NumCPU.
+def run_mode(mode, mass, jobsfile):
+    outfile = os.path.join(args.outdir, "{}_m{}.csv".format(mode, mass))
+    logfile = os.path.join(args.outdir, "{}_m{}.log".format(mode, mass))
+    profilefile = os.path.join(args.outdir, "{}_m{}.json".format(mode, mass))
+
+    cmd = [sys.executable, script, args.workspace.format(mass=mass),
+           "-m", str(mass), "-o", outfile, "--jobs", jobsfile,
+           "--optimizer", args.optimizer,
+           "--optimizer-strategy", str(args.optimizer_strategy),
+           "--profile", profilefile]
+    if args.globs_tree:
+        cmd += ["--globs-tree", args.globs_tree.format(mass=mass)]
+    cmd += mode_options(mode)
+
+    with open(logfile, "w") as log:
+        ret = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT)
+
+    if ret != 0:
+        print("Mode {} failed for mass {} (see {})".format(mode, mass, logfile))
+        return None, None
+
+    with open(outfile) as f:
+        rows = dict((int(row["index"]), row) for row in csv.DictReader(f))
+
+    with open(profilefile) as f:
+        phases = json.load(f)["phases"]
+
+    return rows, sum(phase["wall"] for phase in phases if phase["name"] == "fit")
+
+
+def converged(row):
+    return float(row["uncond_status"]) == 0 and float(row["cond_status"]) == 0
+
+
+modes = ["default"] + [mode for mode in args.modes.split(",") if mode and mode != "default"]
+for mode in modes:
+    mode_options(mode)
+
+if not os.path.isdir(args.outdir):
+    os.makedirs(args.outdir)
+
+jobsfile = os.path.join(args.outdir, "jobs.csv")
+with open(jobsfile, "w") as f:
+    for toy in parse_toys(args.toys):
+        f.write("{},{}\n".format(toy, toy))
+
+summary = []
+for mass in [int(mass) for mass in args.masses.split(",")]:
+    reference = None
+    for mode in modes:
+        rows, fit_time = run_mode(mode, mass, jobsfile)
+        result = {"mass": mass, "mode": mode, "fit_time": fit_time, "speedup": None,
+                  "max_dq0": None, "failed_fits": None, "agree": False}
+        summary.append(result)
+
+        if rows is None:
+            continue
+
+        result["failed_fits"] = sum(not converged(row) for row in rows.values())
+
+        if mode == "default":
+            reference = rows
+            reference_time = fit_time
+            result["speedup"] = 1.
+            result["max_dq0"] = 0.
+            result["agree"] = True
+            continue
+
+        if reference is None:
+            continue
+
+        # Toys failing in only one of the modes count as disagreement
+        dq0 = [abs(float(rows[index]["q0"]) - float(ref["q0"]))
+               for index, ref in reference.items() if index in rows]
+        same_status = all(index in rows and converged(rows[index]) == converged(ref)
+                          for index, ref in reference.items())
+
+        result["speedup"] = reference_time / max(fit_time, 1e-9)
+        result["max_dq0"] = max(dq0) if dq0 else None
+        result["agree"] = same_status and bool(dq0) and max(dq0) <= args.tolerance
+
+    print("Mass {}:".format(mass))
+    for result in summary:
+        if result["mass"] != mass or result["fit_time"] is None:
+            continue
+        print("  {:<12} fit time {:8.2f} s  speedup {:5.2f}  max |dq0| {:.2e}  {}".format(
+            result["mode"], result["fit_time"], result["speedup"] or 0.,
+            result["max_dq0"] if result["max_dq0"] is not None else float("nan"),
+            "ok" if result["agree"] else "DISAGREES"))
+
+    safe = [result for result in summary if result["mass"] == mass and result["agree"]]
+    if safe:
+        best = max(safe, key=lambda result: result["speedup"])
+        print("  fastest agreeing mode: {}".format(best["mode"]))
+
+summaryfile = os.path.join(args.outdir, "summary.csv")
+with open(summaryfile, "w") as f:
+    writer = csv.DictWriter(f, fieldnames=["mass", "mode", "fit_time", "speedup",
+                                           "max_dq0", "failed_fits", "agree"])
+    writer.writeheader()
+    writer.writerows(summary)
+
+print("Summary written to {}".format(summaryfile))
+
+disagreeing = sorted(set(result["mode"] for result in summary if not result["agree"]))
+if disagreeing:
+    sys.exit("Modes disagreeing with the default evaluation: {}".format(", ".join(disagreeing)))
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+import argparse
+import csv
+import sys
+
+from toystore import ToyStore, is_store, read_rows, remove
+
+parser = argparse.ArgumentParser(
+    description="Converts toy results between CSV files and toy stores (directories with one "
+    "typed .npy column per file, see toystore.py). All inputs are concatenated.")
+parser.add_argument("outfile", help="Output: CSV file if it ends with .csv, otherwise toy store")
+parser.add_argument("infiles", nargs="+", help="CSV files or toy stores")
+parser.add_argument("--columns", default=None,
+                    help="Comma-separated columns to write (default: columns of the first input)")
+parser.add_argument("--append", action="store_true",
+                    help="Append to an existing toy store")
+args = parser.parse_args()
+
+
+def input_columns(fn):
+    if is_store(fn):
+        return ToyStore(fn).columns
+
+    with open(fn) as f:
+        return next(csv.reader(f))
+
+
+columns = args.columns.split(",") if args.columns else input_columns(args.infiles[0])
+
+if args.outfile.endswith(".csv"):
+    with open(args.outfile, "w") as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        for fn in args.infiles:
+            writer.writerows(read_rows(fn))
+    sys.exit(0)
+
+if args.append and is_store(args.outfile):
+    store = ToyStore(args.outfile)
+else:
+    remove(args.outfile)
+    store = ToyStore.create(args.outfile, columns)
+
+for fn in args.infiles:
+    if is_store(fn):
+        source = ToyStore(fn)
+        store.append_columns(source.read([column for column in store.columns
+                                          if column in source.columns]))
+    else:
+        with open(fn) as f:
+            store.append(list(csv.DictReader(f)))
+
+print("{} rows in {}".format(store.nrows, args.outfile))
@@ -1,3 +1,5 @@
+import os
+import sys
 import warnings
 
 import numpy as np
@@ -8,17 +10,47 @@ from scipy import stats
 warnings.simplefilter(action='ignore', category=FutureWarning)
 from statsmodels.distributions.empirical_distribution import ECDF
 
+# The toy store is shared with the fit scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from toydb import ToyDatabase, is_database
+from toystore import ToyStore, is_store
 
-def load_toys(fn):
-    df = pd.read_csv(fn, low_memory=False)
 
-    # Convert to proper dtypes
-    df = df.astype({
-        "uncond_status": "int64",
-        "cond_status": "int64",
-        "uncond_covQual": "int64",
-        "cond_covQual": "int64",
-    })
+# Toys from a CSV file, a toy store directory or a toy database (best
+# fits). usecols selects the columns (callable), only these are
+# read from a store or database. Store columns
+# keep their types, the masses are decoded.
+def read_toys(fn, usecols=None):
+    if is_store(fn):
+        store = ToyStore(fn)
+        columns = [column for column in store.columns if usecols is None or usecols(column)]
+        return pd.DataFrame(store.read(columns), columns=columns)
+
+    # Best fit per toy and mass from a toy database
+    if is_database(fn):
+        db = ToyDatabase(fn)
+        columns = [column for column in db.columns if usecols is None or usecols(column)]
+        columns, rows = db.read("best", columns)
+        db.close()
+        return pd.DataFrame.from_records(rows, columns=columns)
+
+    return pd.read_csv(fn, low_memory=False, usecols=usecols)
+
+
+def load_toys(fn, dense=False):
+    # Only the columns of the matrices are needed for the dense toys
+    usecols = None
+    if dense:
+        usecols = lambda column: column in ToyMatrix.columns or column == "index"
+
+    df = read_toys(fn, usecols)
+
+    # Convert to proper dtypes (CSV columns are read as float, the toy
+    # store has them as integers already)
+    df = df.astype(dict(
+        (column, "int64")
+        for column in ["uncond_status", "cond_status", "uncond_covQual", "cond_covQual"]
+        if column in df.columns and df[column].dtype.kind == "f"))
 
     # Rename 'index' to 'toyindex' to avoid confusion with the index of
     # the dataframe
@@ -28,12 +60,15 @@ def load_toys(fn):
     # Check that there are no duplicates
     assert not df.duplicated(["toyindex", "mass"]).any()
 
-    # Add failed fit column
-    df["failed_fit"] = (df["uncond_status"] != 0) | (df["cond_status"] != 0)
-
     # Transform q0 to one-sided discovery test statistic
     df.loc[df["muhat"] <= 0, "q0"] = 0.0
 
+    if dense:
+        return ToyMatrix.from_frame(df)
+
+    # Add failed fit column
+    df["failed_fit"] = (df["uncond_status"] != 0) | (df["cond_status"] != 0)
+
     # Add flag indiciating whether all fits for a given experiment
     # were successful
     df["good_toy"] = ~df.groupby("toyindex")["failed_fit"].transform(np.any)
@@ -41,25 +76,159 @@ def load_toys(fn):
     return df
 
 
+# Fits of the global toys as matrices indexed by (toy, mass) with the
+# toy indices and masses along the axes. Missing fits are flagged in
+# 'missing' (NaN in q0 / muhat, -1 in the status matrices).
+class ToyMatrix(object):
+    columns = ["toyindex", "mass", "q0", "muhat", "uncond_status", "cond_status"]
+
+    def __init__(self, toyindex, masses, q0, muhat, uncond_status, cond_status, missing):
+        self.toyindex = toyindex
+        self.masses = masses
+        self.q0 = q0
+        self.muhat = muhat
+        self.uncond_status = uncond_status
+        self.cond_status = cond_status
+        self.missing = missing
+
+        self.failed = ~self.missing & ((uncond_status != 0) | (cond_status != 0))
+
+    @classmethod
+    def from_frame(cls, df):
+        toyindex, toy_codes = np.unique(df["toyindex"].values, return_inverse=True)
+        masses, mass_codes = np.unique(df["mass"].values, return_inverse=True)
+
+        def matrix(column, fill_value, dtype):
+            values = np.full((len(toyindex), len(masses)), fill_value, dtype=dtype)
+            values[toy_codes, mass_codes] = df[column].values
+            return values
+
+        missing = np.ones((len(toyindex), len(masses)), dtype=bool)
+        missing[toy_codes, mass_codes] = False
+
+        # Duplicated fits would overwrite each other
+        assert np.count_nonzero(~missing) == len(df)
+
+        return cls(toyindex, masses,
+                   matrix("q0", np.nan, np.float64),
+                   matrix("muhat", np.nan, np.float64),
+                   matrix("uncond_status", -1, np.int64),
+                   matrix("cond_status", -1, np.int64),
+                   missing)
+
+    # Toys without failed fits
+    @property
+    def good_toy(self):
+        return ~self.failed.any(axis=1)
+
+    # Toys with a fit for every mass
+    @property
+    def complete(self):
+        return ~self.missing.any(axis=1)
+
+    def select(self, toys):
+        return ToyMatrix(self.toyindex[toys], self.masses, self.q0[toys], self.muhat[toys],
+                         self.uncond_status[toys], self.cond_status[toys],
+                         self.missing[toys])
+
+
+# p-values from the q0 sampling distributions of all mass points.
+#
+# The distributions are kept as one array sorted by (mass code, q0)
+# with the offsets of the masses, so that the p-values of all (mass,
+# q0) pairs come from one batched searchsorted instead of one ECDF and
+# boolean mask per mass. Values are compared via their rank among all
+# unique q0 values, which makes the result identical to the ECDF of
+# statsmodels (incl. its y = r_[0, linspace(1/n, 1, n)] steps).
 class ToyPvalueCalculator(object):
     def __init__(self):
         self.q0_toys = {}
-        self.q0_ecdf = {}
+        self._index = None
 
     def add_q0_distribution(self, mass, arr):
-        q0 = np.array(arr).flatten()
+        q0 = np.array(arr, dtype=np.float64).flatten()
 
         self.q0_toys[mass] = q0
-        self.q0_ecdf[mass] = ECDF(q0)
+        self._index = None
+
+    def _build_index(self):
+        masses = np.array(sorted(self.q0_toys))
+        sorted_q0 = [np.sort(self.q0_toys[m]) for m in masses]
+        sizes = np.array([len(q0) for q0 in sorted_q0])
+
+        offsets = np.zeros(len(masses) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(sizes)
+
+        # Keys sorted by mass code first and q0 rank second
+        flat = np.concatenate(sorted_q0)
+        unique_q0 = np.unique(flat)
+        nranks = len(unique_q0) + 1
+        codes = np.repeat(np.arange(len(masses)), sizes)
+        keys = codes * nranks + np.searchsorted(unique_q0, flat, side="right")
+
+        # ECDF steps of every mass, n + 1 values per mass
+        ecdf_y = np.concatenate([np.r_[0, np.linspace(1. / n, 1, n)] for n in sizes])
+
+        self._index = {
+            "masses": masses,
+            "offsets": offsets,
+            "unique_q0": unique_q0,
+            "nranks": nranks,
+            "keys": keys,
+            "ecdf_y": ecdf_y,
+        }
+
+    def mass_codes(self, mass):
+        if self._index is None:
+            self._build_index()
+
+        masses = self._index["masses"]
+        mass = np.asarray(mass)
+        codes = np.minimum(np.searchsorted(masses, mass), len(masses) - 1)
+
+        unknown = masses[codes] != mass
+        if np.any(unknown):
+            raise KeyError("No q0 distribution for mass {}".format(np.unique(mass[unknown])))
+
+        return codes
+
+    # Mass codes and number of toys with q0_toy <= q0 of the (mass, q0)
+    # pairs (flattened)
+    def locate(self, mass, q0):
+        codes = self.mass_codes(mass).ravel()
+        index = self._index
+
+        # The queries are searched in sorted order, which is faster for
+        # large arrays
+        ranks = np.searchsorted(index["unique_q0"], np.ravel(q0), side="right")
+        keys = codes * index["nranks"] + ranks
+        order = np.argsort(keys)
+        counts = np.empty_like(keys)
+        counts[order] = np.searchsorted(index["keys"], keys[order], side="right")
+        counts -= index["offsets"][codes]
+
+        return codes, counts
+
+    def pval_from_counts(self, codes, counts):
+        index = self._index
+        return 1 - index["ecdf_y"][index["offsets"][codes] + codes + counts]
 
     def get_pval(self, mass, q0):
+        mass = np.array(mass)
+        q0 = np.array(q0, dtype=np.float64)
+        assert mass.shape == q0.shape
+
+        return self.pval_from_counts(*self.locate(mass, q0)).reshape(q0.shape)
+
+    # Reference implementation with one statsmodels ECDF per mass
+    def get_pval_ecdf(self, mass, q0):
         mass = np.array(mass)
         q0 = np.array(q0)
         assert mass.shape == q0.shape
 
         pval = np.zeros_like(q0)
         for m in np.unique(mass):
-            pval[mass == m] = 1 - self.q0_ecdf[m](q0[mass == m])
+            pval[mass == m] = 1 - ECDF(self.q0_toys[m])(q0[mass == m])
 
         return pval
 
@@ -74,6 +243,104 @@ class ToyPvalueCalculator(object):
         return bootstrapped
 
 
+# Bootstrap of the global significance from toys (dense toy x mass q0
+# matrix, NaN for missing fits) and the q0 sampling distributions.
+#
+# Resampling a distribution only changes the multiplicities of its
+# sorted toys, so the number of resampled toys with q0_toy <= q0 is a
+# cumulative sum of the multiplicities evaluated at the position found
+# once by ToyPvalueCalculator.locate. The replicas of a block are
+# reduced to the maximum over the masses in NumPy and the inverse
+# normal CDF is only applied to the maximum of every toy. The random
+# numbers are drawn as in ToyPvalueCalculator.bootstrap, the results
+# are identical for the same generator.
+class GlobalSignificanceBootstrap(object):
+    def __init__(self, pval_calc, masses, q0, obs_mass, obs_q0):
+        self.pval_calc = pval_calc
+        self.q0 = np.array(q0, dtype=np.float64)
+        self.present = ~np.isnan(self.q0)
+        assert self.q0.shape == (self.q0.shape[0], len(masses))
+
+        # Toys of the global significance and the observed q0 as last
+        # query
+        query_mass = np.append(np.broadcast_to(masses, self.q0.shape), obs_mass)
+        query_q0 = np.append(self.q0, obs_q0)
+        self.codes, self.counts = pval_calc.locate(query_mass, query_q0)
+
+        index = pval_calc._index
+        self.first = index["offsets"][self.codes]
+        self.total = index["offsets"][-1]
+
+        # Position of every toy of the distributions in the sorted array
+        # of all masses (in the order used by ToyPvalueCalculator.bootstrap)
+        self.sorted_positions = []
+        for mass in pval_calc.q0_toys:
+            q0_toys = pval_calc.q0_toys[mass]
+            positions = np.empty(len(q0_toys), dtype=np.int64)
+            positions[np.argsort(q0_toys)] = np.arange(len(q0_toys))
+            positions += index["offsets"][pval_calc.mass_codes(mass)]
+            self.sorted_positions.append(positions)
+
+        # Toys with p-value 0 or 1 (infinite significance) get sqrt(q0)
+        with np.errstate(invalid="ignore"):
+            self.sqrt_q0 = np.sqrt(self.q0)
+
+    def cdf_values(self, counts):
+        return 1 - self.pval_calc.pval_from_counts(self.codes, counts)
+
+    # 1 - p-value of the toys (toys, masses) and of the observed q0
+    # without resampling
+    def nominal_cdf_values(self):
+        cdf = self.cdf_values(self.counts)
+        return cdf[:-1].reshape(self.q0.shape), cdf[-1]
+
+    # Maximum local significance of every toy from 1 - p-value of the
+    # toys (..., toys, masses)
+    def max_significance(self, cdf_toys):
+        finite = (cdf_toys > 0) & (cdf_toys < 1) & self.present
+        infinite = ~finite & self.present
+
+        with np.errstate(invalid="ignore"):
+            return np.fmax(
+                stats.norm.ppf(np.where(finite, cdf_toys, -1).max(axis=-1)),
+                np.where(infinite, self.sqrt_q0, -np.inf).max(axis=-1))
+
+    # Global significance from 1 - p-value of the toys (..., toys,
+    # masses) and the observed q0 (...)
+    def global_significance(self, cdf_toys, cdf_obs):
+        max_sig = self.max_significance(cdf_toys)
+
+        obs_z0 = stats.norm.ppf(cdf_obs)
+        num_exceeding = (max_sig > obs_z0[..., np.newaxis]).sum(axis=-1)
+        global_pval = num_exceeding / float(max_sig.shape[-1])
+
+        return stats.norm.ppf(1 - global_pval)
+
+    # Number of resampled toys with q0_toy <= q0 of the queries for a
+    # block of replicas (replicas, queries)
+    def resampled_counts(self, rng, block_size):
+        multiplicities = np.zeros((block_size, self.total + 1), dtype=np.int64)
+        for i in range(block_size):
+            # rng.choice(q0, size=n) draws the same indices
+            positions = [p[rng.choice(len(p), size=len(p))] for p in self.sorted_positions]
+            multiplicities[i, 1:] = np.bincount(np.concatenate(positions),
+                                                minlength=self.total)
+
+        cumulative = np.cumsum(multiplicities, axis=1, out=multiplicities)
+        return cumulative[:, self.first + self.counts] - cumulative[:, self.first]
+
+    def run(self, rng, num_bootstraps, block_size=16):
+        zglobal_bootstraps = np.empty(num_bootstraps)
+
+        for start in range(0, num_bootstraps, block_size):
+            size = min(block_size, num_bootstraps - start)
+            cdf = self.cdf_values(self.resampled_counts(rng, size))
+            zglobal_bootstraps[start:start + size] = self.global_significance(
+                cdf[:, :-1].reshape((size,) + self.q0.shape), cdf[:, -1])
+
+        return zglobal_bootstraps
+
+
 def binom_mle_interval(k, n, bracket=(0.01, 0.1)):
     llh = lambda p, k, n: k * np.log(p) + (n - k) * np.log(1 - p)
     delta_llh = lambda p: llh(p, k, n) - llh(k / n, k, n)
@@ -23,42 +23,44 @@ R.gROOT.SetStyle("ATLAS")
 obs_z0 = 3.012651697087006
 obs_pval = 1.0 - stats.norm.cdf(obs_z0)
 
-df = load_toys(args.infile)
+toys = load_toys(args.infile, dense=True)
 
 
 # Print out statistics
-total_toys = len(np.unique(df["toyindex"]))
-num_failed = df["failed_fit"].sum()
-frac_failed = num_failed / len(df)
+total_toys = len(toys.toyindex)
+num_fits = np.count_nonzero(~toys.missing)
+num_failed = toys.failed.sum()
+frac_failed = num_failed / num_fits
 print(f"Total number of toys: {total_toys}")
 print(f"Failed fits: {num_failed} ({100 * frac_failed:.1f} %)")
 print("Fraction of good toys: {:.1f} %".format(
-    100 * df["good_toy"].sum() / len(df)))
+    100 * np.count_nonzero(toys.good_toy[:, np.newaxis] & ~toys.missing) / num_fits))
 
+good_toy = toys.good_toy
 if args.replace_failures:
     print("Replacing failed fits with q0 = 0...")
-    df.loc[df["failed_fit"], "q0"] = 0.0
-    df["good_toy"] = True
+    toys.q0[toys.failed] = 0.0
+    good_toy[:] = True
 
-df_good = df.loc[df["good_toy"]].copy()
+toys_good = toys.select(good_toy)
 
 
 # Set negative q0 to 0
-df_good.loc[df_good["q0"] < 0, "q0"] = 0.0
-assert len(df_good.loc[df_good["q0"] < 0]) == 0
+toys_good.q0[toys_good.q0 < 0] = 0.0
+assert not np.any(toys_good.q0 < 0)
 
 
 # Calculate *local* significance
-df_good["sig"] = np.sqrt(df_good["q0"])
+sig = np.sqrt(toys_good.q0)
 
 
-# Maximum local significance
-df_zmax = df_good.groupby("toyindex")["sig"].max().to_frame("max_sig")
+# Maximum local significance (missing fits are NaN)
+max_sig = np.fmax.reduce(sig, axis=1)
 
 
 # Calculate global p-value / significance
-num_exceeding = (df_zmax["max_sig"] > obs_z0).sum()
-num_toys = len(df_zmax)
+num_exceeding = (max_sig > obs_z0).sum()
+num_toys = len(max_sig)
 global_pval = num_exceeding / num_toys
 global_sig = stats.norm.ppf(1 - global_pval)
 
@@ -78,7 +80,7 @@ print("68% CL interval on sig-global: "
 
 
 # Fit the trial factor
-trial_factor = fit_trial_factor(df_zmax["max_sig"])
+trial_factor = fit_trial_factor(max_sig)
 tf_global_sig = stats.norm.ppf(1 - (1 - (1 - obs_pval)**trial_factor))
 print(f"Trial factor: {trial_factor:.1f}")
 print(f"Global significance (trial factor): {tf_global_sig:.2f}")
@@ -91,14 +93,14 @@ def tf_pdf(x, n):
 
 
 x_tf = np.linspace(0, 5, 200)
-norm = (5 / 100.) * len(df_zmax)  # Bin width * number of toys
+norm = (5 / 100.) * len(max_sig)  # Bin width * number of toys
 y_tf = norm * tf_pdf(x_tf, trial_factor)
 g_tf = R.TGraph(len(x_tf), x_tf, y_tf)
 
 
 # Plot
 h_zmax = R.TH1F("h_zmax", "", 100, 0, 5)
-h_zmax.FillN(len(df_zmax), df_zmax["max_sig"].values, R.nullptr)
+h_zmax.FillN(len(max_sig), max_sig, R.nullptr)
 
 h_zmax.GetXaxis().SetTitle("Maximum local significance [#sigma]")
 h_zmax.GetYaxis().SetTitle("Toy experiments")
@@ -120,7 +122,7 @@ h_zmax.Draw("HIST,E0")
 g_tf.Draw("C,SAME")
 
 # Labels
-latex.DrawLatex(0.54, 0.85, f"Number of toys: {len(df_zmax)}")
+latex.DrawLatex(0.54, 0.85, f"Number of toys: {len(max_sig)}")
 latex.DrawLatex(0.54, 0.80,
                 "Toys with Z_{0}^{max} > Z_{0}^{max,obs}: "
                 f"{num_exceeding}")
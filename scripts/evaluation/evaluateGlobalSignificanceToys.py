@@ -16,7 +16,7 @@ R.gROOT.SetBatch(True)
 R.gROOT.SetStyle("ATLAS")
 
 from common import load_toys, binom_mle_interval, fit_trial_factor
-from common import ToyPvalueCalculator
+from common import ToyPvalueCalculator, GlobalSignificanceBootstrap
 
 
 parser = argparse.ArgumentParser()
@@ -24,29 +24,35 @@ parser.add_argument("toys")
 parser.add_argument("--q0-sampling-distributions", nargs="+", required=True)
 parser.add_argument("--replace-failures", action="store_true",
                     help="Replacing failing fits with q0 = 0")
+parser.add_argument("--bootstraps", type=int, default=100000,
+                    help="Number of bootstrap replicas, split over 8 jobs "
+                    "(default: %(default)s)")
+parser.add_argument("--block-size", type=int, default=16,
+                    help="Bootstrap replicas evaluated at once per job (default: %(default)s)")
 args = parser.parse_args()
 
 
 # Load toy experiments (global significance)
-df = load_toys(args.toys)
+toys = load_toys(args.toys, dense=True)
 
-total_toys = len(np.unique(df["toyindex"]))
-total_failed = df["failed_fit"].sum()
+total_toys = len(toys.toyindex)
+total_failed = toys.failed.sum()
 
+good_toy = toys.good_toy
 if args.replace_failures:
     print("Replacing failed fits with q0 = 0...")
-    df.loc[df["failed_fit"], "q0"] = 0.0
-    df["good_toy"] = True
+    toys.q0[toys.failed] = 0.0
+    good_toy[:] = True
 
-df_good = df.loc[df["good_toy"]].copy()
-total_good = len(np.unique(df_good["toyindex"]))
-df_good.loc[df_good["q0"] < 0, "q0"] = 0.0
+toys_good = toys.select(good_toy)
+total_good = len(toys_good.toyindex)
+toys_good.q0[toys_good.q0 < 0] = 0.0
 
 print(f"Total number of toys: {total_toys}")
 print(f"Failed fits: {total_failed}")
 print(f"Good toys: {total_good}")
 
-num_neg_q0 = np.count_nonzero(df_good["q0"] < 0)
+num_neg_q0 = np.count_nonzero(toys_good.q0 < 0)
 if num_neg_q0 > 0:
     print(f"Warning: Encountered {num_neg_q0} fits with negative q0")
 
@@ -78,23 +84,23 @@ print(f"Obs. significance: {obs_z0:.4f}")
 
 
 # Nominal result
-df_good["pval"] = toy_pval_calc.get_pval(df_good["mass"], df_good["q0"])
-df_good["sig"] = stats.norm.ppf(1 - df_good["pval"])
+bootstrap = GlobalSignificanceBootstrap(toy_pval_calc, toys_good.masses, toys_good.q0,
+                                        1000, obs_q0)
+cdf_toys, _ = bootstrap.nominal_cdf_values()
 
 # Check for infinities
-mask_inf = np.isinf(df_good["sig"])
-num_inf = np.count_nonzero(mask_inf)
-if num_inf > 0:
-    print(f"Encountered infinities for mass: {mass} "
-          "-- Setting to sqrt(q0)")
-    df_good.loc[mask_inf, "sig"] = np.sqrt(df_good.loc[mask_inf, "q0"])
+mask_inf = np.isinf(stats.norm.ppf(cdf_toys)) & ~toys_good.missing
+if np.any(mask_inf):
+    print("Encountered infinities for mass: {} "
+          "-- Setting to sqrt(q0)".format(
+              ", ".join(str(mass) for mass in toys_good.masses[mask_inf.any(axis=0)])))
 
 
 # Calculate global significance
-df_zmax = df_good.groupby("toyindex")["sig"].max().to_frame("max_sig")
+max_sig = bootstrap.max_significance(cdf_toys)
 
-num_exceeding = (df_zmax["max_sig"] > obs_z0).sum()
-num_toys = len(df_zmax)
+num_exceeding = (max_sig > obs_z0).sum()
+num_toys = len(max_sig)
 global_pval = num_exceeding / num_toys
 global_sig = stats.norm.ppf(1 - global_pval)
 
@@ -112,7 +118,7 @@ print(f"68% CL interval on sig-global: "
 
 
 # Trial factor
-trial_factor = fit_trial_factor(df_zmax["max_sig"])
+trial_factor = fit_trial_factor(max_sig)
 tf_global_sig = stats.norm.ppf(1 - (1 - (1 - obs_pval)**trial_factor))
 print(f"Trial factor: {trial_factor:.1f}")
 print(f"Global significance (trial factor): {tf_global_sig:.2f}")
@@ -124,14 +130,14 @@ def tf_pdf(x, n):
 
 
 x_tf = np.linspace(0, 5, 200)
-norm = (5 / 100.) * len(df_zmax)  # Bin width * number of toys
+norm = (5 / 100.) * len(max_sig)  # Bin width * number of toys
 y_tf = norm * tf_pdf(x_tf, trial_factor)
 g_tf = R.TGraph(len(x_tf), x_tf, y_tf)
 
 
 # Plot
 h_zmax = R.TH1F("h_zmax", "", 100, 0, 5)
-h_zmax.FillN(len(df_zmax), df_zmax["max_sig"].values, R.nullptr)
+h_zmax.FillN(len(max_sig), max_sig, R.nullptr)
 
 h_zmax.GetXaxis().SetTitle("Maximum local significance [#sigma]")
 h_zmax.GetYaxis().SetTitle("Toy experiments")
@@ -152,7 +158,7 @@ c = R.TCanvas("c", "", 800, 600)
 h_zmax.Draw("HIST,E0")
 # g_tf.Draw("C,SAME")
 
-latex.DrawLatex(0.54, 0.85, f"Number of toys: {len(df_zmax)}")
+latex.DrawLatex(0.54, 0.85, f"Number of toys: {len(max_sig)}")
 latex.DrawLatex(0.54, 0.80, "Toys with Z_{0}^{max} > Z_{0}^{max,obs}: "
                 f"{num_exceeding}")
 latex.DrawLatex(0.54, 0.72,
@@ -185,47 +191,15 @@ del c
 
 
 # Bootstrapping
-def bootstrap(rng, num_bootstraps):
-    zglobal_bootstraps = []
-
-    for i in range(num_bootstraps):
-        # Resample q0 values in p value calculator
-        toy_pval_calc_resampled = toy_pval_calc.bootstrap(rng)
-
-        # Recalculate global significance
-
-        # Observed results (needs to be recalculated since q0 toys changed)
-        obs_pval = toy_pval_calc_resampled.get_pval(1000, obs_q0)
-        obs_z0 = stats.norm.ppf(1 - obs_pval)
-
-        df_good["pval"] = \
-            toy_pval_calc_resampled.get_pval(df_good["mass"], df_good["q0"])
-        df_good["sig"] = stats.norm.ppf(1 - df_good["pval"])
-
-        # Check for infinities
-        mask_inf = np.isinf(df_good["sig"])
-        num_inf = np.count_nonzero(mask_inf)
-        if num_inf > 0:
-            df_good.loc[mask_inf, "sig"] = np.sqrt(df_good.loc[mask_inf, "q0"])
-
-        # Calculate global significance
-        df_zmax = df_good.groupby("toyindex")["sig"].max().to_frame("max_sig")
-
-        num_exceeding = (df_zmax["max_sig"] > obs_z0).sum()
-        num_toys = len(df_zmax)
-        global_pval = num_exceeding / num_toys
-        global_sig = stats.norm.ppf(1 - global_pval)
-
-        zglobal_bootstraps.append(global_sig)
-
-    return zglobal_bootstraps
-
-
+# One random number stream per job, the results do not depend on the
+# block size
 seed_seq = np.random.SeedSequence(202596828575806468932732570400374383977)
 child_seq = seed_seq.spawn(8)
 
 zglobal_bootstraps = Parallel(n_jobs=8, verbose=10)(
-    delayed(bootstrap)(np.random.default_rng(seq), 12500) for seq in child_seq)
+    delayed(bootstrap.run)(np.random.default_rng(seq), args.bootstraps // len(child_seq),
+                           args.block_size)
+    for seq in child_seq)
 
 zglobal_bootstraps = np.array(zglobal_bootstraps)
 zglobal_bootstraps = zglobal_bootstraps.ravel()
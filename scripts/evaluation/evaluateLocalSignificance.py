@@ -8,7 +8,8 @@ from scipy.stats import norm
 from statsmodels.distributions.empirical_distribution import ECDF
 from tqdm import tqdm
 import numpy as np
-import pandas as pd
+
+from common import read_toys
 
 
 parser = argparse.ArgumentParser()
@@ -26,7 +27,7 @@ R.gROOT.SetStyle("ATLAS")
 
 
 # Read local significance toys
-df = pd.read_csv(args.infile)
+df = read_toys(args.infile)
 
 # Convert to proper dtypes
 df = df.astype({
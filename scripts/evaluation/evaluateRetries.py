@@ -11,10 +11,16 @@ import tarfile
 parser = argparse.ArgumentParser()
 parser.add_argument("indir")
 parser.add_argument("-o", "--outfile", default=None)
+parser.add_argument("--reference", default=None,
+                    help="Directory with retries of the same toys running all retry methods "
+                    "(cross-check of the retry ladder stopping after --retry-min-good good "
+                    "fits)")
 args = parser.parse_args()
 
 
-pattern = re.compile(r"^retry_(.*)_idx\d+_m\d+.csv$")
+# One file per retry method (retry_<method>_idx<n>_m<mass>.csv) or one
+# file from the retry ladder with a retry_method column
+pattern = re.compile(r"^retry_(?:(.*)_)?idx\d+_m\d+.csv$")
 
 
 def get_retry_df(fn):
@@ -28,7 +34,8 @@ def get_retry_df(fn):
             retry_method, = m.groups()
 
             df = pd.read_csv(tar.extractfile(name))
-            df["retry_method"] = retry_method
+            if retry_method is not None:
+                df["retry_method"] = retry_method
             dfs.append(df)
 
     return pd.concat(dfs)
@@ -47,18 +54,6 @@ def print_toy(df, index, mass):
           .sort_values("retry_priority"))
 
 
-dfs = []
-for fn in glob(os.path.join(args.indir, "retry_*.tar.gz")):
-    df = get_retry_df(fn)
-    dfs.append(df)
-
-# Number of retried toys
-num_retried = len(dfs)
-print(f"Number of retried toys: {num_retried}")
-
-# Make joint dataframe
-df = pd.concat(dfs)
-
 # Highest (0) to lowest (6)
 priority = {
     "minuit2strat2": 0,
@@ -70,34 +65,64 @@ priority = {
     "minuitstrat1mu0p5": 6,
 }
 
-df["retry_priority"] = df["retry_method"].map(priority)
 
+# Number of retried toys and joint dataframe of all retries in indir
+def read_retries(indir):
+    dfs = []
+    for fn in glob(os.path.join(indir, "retry_*.tar.gz")):
+        df = get_retry_df(fn)
+        dfs.append(df)
+
+    df = pd.concat(dfs)
+    df["retry_priority"] = df["retry_method"].map(priority)
+
+    # Convert to proper dtypes
+    df = df.astype({
+        "uncond_status": "int64",
+        "cond_status": "int64",
+        "uncond_covQual": "int64",
+        "cond_covQual": "int64",
+    })
+
+    # Rename 'index' to 'toyindex' to avoid confusion with the index of
+    # the dataframe
+    df.rename(columns={"index": "toyindex"}, inplace=True)
+
+    # Filter out bad fits
+    df["failed_fit"] = (df["uncond_status"] != 0) | (df["cond_status"] != 0)
+    df["neg_q0"] = (df["q0"] < -1e-1)
+
+    return len(dfs), df
 
-# Convert to proper dtypes
-df = df.astype({
-    "uncond_status": "int64",
-    "cond_status": "int64",
-    "uncond_covQual": "int64",
-    "cond_covQual": "int64",
-})
 
-# Rename 'index' to 'toyindex' to avoid confusion with the index of
-# the dataframe
-df.rename(columns={"index": "toyindex"}, inplace=True)
+# Good fits of the toys with at least three good alternative fits
+def select_good(df):
+    sel_good = (~df["failed_fit"]) & (~df["neg_q0"])
+    df_good = df.loc[sel_good].copy()
 
-# Filter out bad fits
-df["failed_fit"] = (df["uncond_status"] != 0) | (df["cond_status"] != 0)
-df["neg_q0"] = (df["q0"] < -1e-1)
+    # Count number of successful fits
+    df_good["good_count"] = df_good.groupby(["toyindex", "mass"])["failed_fit"] \
+                                   .transform("count")
 
-sel_good = (~df["failed_fit"]) & (~df["neg_q0"])
-df_good = df.loc[sel_good].copy()
+    # Require at least three good alternative fits
+    return df_good.loc[df_good["good_count"] >= 3].copy()
 
-# Count number of successful fits
-df_good["good_count"] = df_good.groupby(["toyindex", "mass"])["failed_fit"] \
-                               .transform("count")
 
-# Require at least three good alternative fits
-df_good = df_good.loc[df_good["good_count"] >= 3].copy()
+# Good fit of the highest priority per toy
+def select_best(df_good):
+    # Sort by priority
+    df_best = df_good.sort_values("retry_priority")
+
+    # Remove duplicates (keep first -> highest priority)
+    return df_best.drop_duplicates(["toyindex", "mass"], keep="first")
+
+
+num_retried, df = read_retries(args.indir)
+
+# Number of retried toys
+print(f"Number of retried toys: {num_retried}")
+
+df_good = select_good(df)
 
 
 # === Sanity check ===
@@ -127,11 +152,7 @@ with pd.option_context("display.max_rows", None,
 
 # === End of sanity check ===
 
-# Sort by priority
-df_good.sort_values("retry_priority", inplace=True)
-
-# Remove duplicates (keep first -> highest priority)
-df_good.drop_duplicates(["toyindex", "mass"], keep="first", inplace=True)
+df_good = select_best(df_good)
 
 # Good fits after retry
 num_good = len(df_good)
@@ -144,6 +165,31 @@ if args.outfile is not None:
     df_good.to_csv(args.outfile, index=False)
 
 
+# Cross-check with the retries running all methods: the ladder stops
+# once it has the good fits required here, so the same toys should be
+# kept with the same fit
+if args.reference is not None:
+    _, df_ref = read_retries(args.reference)
+    df_ref_good = select_best(select_good(df_ref))
+
+    df_cmp = df_good.merge(df_ref_good,
+                           on=["toyindex", "mass"],
+                           how="outer",
+                           suffixes=("", "_ref"),
+                           indicator=True)
+    both = df_cmp["_merge"] == "both"
+    diff_method = both & (df_cmp["retry_method"] != df_cmp["retry_method_ref"])
+    diff_q0 = (df_cmp["q0"] - df_cmp["q0_ref"]).abs()
+
+    print("Cross-check with reference:")
+    print(f"  Good toys only in {args.indir}: {(df_cmp['_merge'] == 'left_only').sum()}")
+    print(f"  Good toys only in {args.reference}: {(df_cmp['_merge'] == 'right_only').sum()}")
+    print(f"  Different retry method: {diff_method.sum()}")
+    print(f"  Max. difference of q0: {diff_q0.loc[both].max():.3g}")
+    print(df_cmp.loc[(df_cmp["_merge"] != "both") | diff_method,
+                     ["toyindex", "mass", "retry_method", "retry_method_ref", "q0", "q0_ref"]])
+
+
 df_bad = df.merge(df_good,
                   on=["toyindex", "mass"],
                   how="outer",
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 import argparse
 import sys
-import pandas as pd
+
+from common import read_toys
 
 
 parser = argparse.ArgumentParser()
@@ -11,7 +12,7 @@ args = parser.parse_args()
 
 
 # Read global significance toys
-df = pd.read_csv(args.infile)
+df = read_toys(args.infile)
 
 # Convert to proper dtypes
 df = df.astype({
@@ -4,6 +4,8 @@ import argparse
 import numpy as np
 import pandas as pd
 
+from common import ToyMatrix, read_toys
+
 parser = argparse.ArgumentParser()
 parser.add_argument("outfile")
 parser.add_argument("toys")
@@ -12,7 +14,7 @@ args = parser.parse_args()
 
 
 # Toys before retrying
-df = pd.read_csv(args.toys)
+df = read_toys(args.toys)
 
 # Convert to proper dtypes
 df = df.astype({
@@ -33,7 +35,7 @@ assert not df.duplicated(["toyindex", "mass"]).any()
 df["failed_fit"] = (df["uncond_status"] != 0) | (df["cond_status"] != 0)
 
 # Load retries and merge with original toys
-df_retried = pd.read_csv(args.retries)
+df_retried = read_toys(args.retries)
 
 # Check that there are no duplicates
 assert not df_retried.duplicated(["toyindex", "mass"]).any()
@@ -44,7 +46,8 @@ df_merged.sort_values("failed_fit", inplace=True)
 df_merged.drop_duplicates(["toyindex", "mass"], keep="first", inplace=True)
 
 # Ensure that all toys have 20 fits
-assert np.all(df_merged.groupby("toyindex")["q0"].count() == 20)
+toys = ToyMatrix.from_frame(df_merged)
+assert len(toys.masses) == 20 and np.all(toys.complete)
 
 # Store that puppy
 df_merged.to_csv(args.outfile, index=False)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+import argparse
+import os
+
+from common import masses
+from ledger import JobLedger, kinds, parse_range, statuses, write_record
+from toydb import is_failed
+from toystore import read_rows
+
+parser = argparse.ArgumentParser(
+    description="Job ledger of a toy campaign (SQLite database, see ledger.py). Units are "
+    "(mass, seed) for the toys of the q0 sampling distributions (local) and (toyindex, mass) for "
+    "the global toys and their retries (global, retry). The batch jobs write record files to a "
+    "directory instead of the database, collect adds them to the database.")
+parser.add_argument("ledger", help="SQLite database (created if it does not exist), for start / "
+                    "finish also a directory of job records")
+parser.add_argument("command",
+                    choices=["expect", "start", "finish", "collect", "list", "export", "summary"],
+                    help="expect: add expected units, start / finish: record a job (from the "
+                    "batch job), collect: add the job records of a directory (all kinds), list: print units, "
+                    "export: write a resubmission list, summary: units per mass and status")
+parser.add_argument("kind", choices=sorted(kinds))
+parser.add_argument("path", nargs="?", default=None,
+                    help="Output of export, record directory of collect")
+parser.add_argument("--mass", default=",".join(str(mass) for mass in masses),
+                    help="Comma-separated masses (default: all mass points)")
+parser.add_argument("--unit", default=None,
+                    help="Seed / toy index, expect accepts lists and ranges (e.g. 0-999)")
+parser.add_argument("--host", default=None, help="Host of start (default: this host)")
+parser.add_argument("--exit-code", type=int, default=0, help="Exit code of the job (finish)")
+parser.add_argument("--results", default=None,
+                    help="Output of the job (finish). Masses without converged fits in the "
+                    "output count as failed.")
+parser.add_argument("--select", choices=["all", "missing", "failed", "running", "slow"],
+                    default="missing", help="Units to list / export")
+parser.add_argument("--slow-seconds", type=float, default=4 * 3600,
+                    help="Runtime of slow units")
+args = parser.parse_args()
+
+unit_name = kinds[args.kind][0]
+job_masses = [int(mass) for mass in args.mass.split(",")]
+
+if args.command in ["expect", "start", "finish"] and args.unit is None:
+    parser.error("--unit is required")
+if args.command in ["collect", "export"] and args.path is None:
+    parser.error("{} requires a path".format(args.command))
+
+# Batch jobs only write a record (collected later)
+records = args.command in ["start", "finish"] and os.path.isdir(args.ledger)
+ledger = None if records else JobLedger(args.ledger)
+
+if args.command == "expect":
+    units = parse_range(args.unit)
+    ledger.expect(args.kind, job_masses, units)
+    print("Expecting {} units".format(len(job_masses) * len(units)))
+elif args.command == "start":
+    if records:
+        write_record(args.ledger, {"kind": args.kind, "unit": int(args.unit), "event": "start",
+                                   "masses": job_masses, "host": args.host})
+    else:
+        ledger.start(args.kind, job_masses, int(args.unit), args.host)
+elif args.command == "finish":
+    failed_masses = set(job_masses) if args.exit_code != 0 else set()
+    if args.results is not None:
+        rows = read_rows(args.results) if os.path.exists(args.results) else []
+        if args.kind == "local":
+            # A job of the local toys is one unit
+            failed_masses = set(job_masses) if args.exit_code != 0 or not rows else set()
+        else:
+            good_masses = set(int(float(row["mass"])) for row in rows if not is_failed(row))
+            failed_masses = set(job_masses) - good_masses
+
+    done_masses = sorted(set(job_masses) - failed_masses)
+    if records:
+        write_record(args.ledger, {"kind": args.kind, "unit": int(args.unit), "event": "finish",
+                                   "done": done_masses, "failed": sorted(failed_masses)})
+    else:
+        ledger.finish(args.kind, done_masses, int(args.unit))
+        ledger.finish(args.kind, sorted(failed_masses), int(args.unit), failed=True)
+elif args.command == "collect":
+    print("Collected {} records".format(ledger.collect(args.path)))
+elif args.command == "list":
+    print("{:>6} {:>8} {:>8} {:>8} {:>9}  {}".format("mass", unit_name, "status", "attempts",
+                                                      "runtime", "host"))
+    for unit in ledger.query(args.kind, args.select, args.slow_seconds):
+        print("{:>6} {:>8} {:>8} {:>8} {:>9}  {}".format(
+            unit["mass"], unit["unit"], unit["status"], unit["attempts"],
+            "" if unit["runtime"] is None else "{:.0f}".format(unit["runtime"]),
+            unit["host"] or ""))
+elif args.command == "export":
+    num_units = ledger.export(args.path, args.kind, args.select, args.slow_seconds)
+    print("Wrote {} units ({}) to {}".format(num_units, ",".join(
+        name if name == "mass" else unit_name for name in kinds[args.kind][1]), args.path))
+elif args.command == "summary":
+    print("{:>6} ".format("mass") + " ".join("{:>8}".format(status) for status in statuses))
+    for mass, counts in sorted(ledger.counts(args.kind).items()):
+        print("{:>6} ".format(mass) + " ".join("{:>8}".format(counts[status])
+                                               for status in statuses))
+
+if ledger is not None:
+    ledger.close()
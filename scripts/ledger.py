@@ -0,0 +1,194 @@
+import json
+import os
+import socket
+import sqlite3
+import time
+
+
+# Ledger of the units of a toy campaign in an SQLite database. A unit is
+# (kind, mass, unit) with the seed of a job of the q0 sampling
+# distributions ('local') or the toy index of a global toy ('global',
+# 'retry') as unit. Every unit is expected first and then updated by
+# the batch jobs when they start and finish:
+#
+# expected -> running -> done / failed
+#
+# Every start counts as an attempt and records the host, every finish
+# the runtime. Missing units (not done), failed units and slow units
+# are selected by simple queries on the table and can be exported as
+# the resubmission lists of the JDLs.
+#
+# Batch jobs do not write to the database: SQLite relies on file locks,
+# which are not reliable on network file systems (CephFS) with
+# thousands of concurrent jobs. Every job writes its start and finish
+# as a record file (JSON) to a directory instead, and the records are
+# collected into the database by a single process. Collected records
+# are remembered, so collecting is idempotent.
+
+statuses = ["expected", "running", "done", "failed"]
+
+# Name of the unit and columns of the resubmission lists per kind
+# ('Queue Mass, Seed from missing_jobs.csv' / 'Queue nToy, mass from
+# failed_fits.csv')
+kinds = {
+    "local": ("seed", ["mass", "unit"]),
+    "global": ("toyindex", ["unit", "mass"]),
+    "retry": ("toyindex", ["unit", "mass"]),
+}
+
+lock_timeout = 300
+
+schema = """
+CREATE TABLE IF NOT EXISTS units (
+    kind TEXT NOT NULL,
+    mass INTEGER NOT NULL,
+    unit INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'expected',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    host TEXT,
+    started REAL,
+    finished REAL,
+    runtime REAL,
+    PRIMARY KEY (kind, mass, unit)
+);
+
+CREATE INDEX IF NOT EXISTS units_status ON units (kind, status);
+
+CREATE TABLE IF NOT EXISTS records (
+    name TEXT PRIMARY KEY
+);
+"""
+
+
+# Integers from a comma-separated list with ranges (e.g. '0-99,120')
+def parse_range(text):
+    values = []
+    for part in text.split(","):
+        if "-" in part.strip("-"):
+            first, last = part.rsplit("-", 1)
+            values += range(int(first), int(last) + 1)
+        else:
+            values.append(int(part))
+
+    return values
+
+
+# Writes a record of a batch job (start or finish) to directory. The
+# record is renamed into place, so collect never reads a partial one.
+def write_record(directory, record):
+    record = dict(record, time=record.get("time") or time.time(),
+                  host=record.get("host") or socket.gethostname())
+    name = "{kind}_{unit}_{event}_{time:.6f}_{host}_{pid}.json".format(pid=os.getpid(),
+                                                                       **record)
+    fn = os.path.join(directory, name)
+    with open(fn + ".tmp", "w") as f:
+        json.dump(record, f)
+    os.rename(fn + ".tmp", fn)
+
+
+class JobLedger(object):
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=lock_timeout)
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    def expect(self, kind, masses, units):
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO units (kind, mass, unit) VALUES (?, ?, ?)",
+                [(kind, mass, unit) for mass in masses for unit in units])
+
+    # Marks the unit as running on this host (new attempt). Units that
+    # were not expected are added.
+    def start(self, kind, masses, unit, host=None, now=None):
+        host = host or socket.gethostname()
+        now = now or time.time()
+        with self.db:
+            for mass in masses:
+                self.db.execute("INSERT OR IGNORE INTO units (kind, mass, unit) VALUES (?, ?, ?)",
+                                (kind, mass, unit))
+                self.db.execute(
+                    "UPDATE units SET status = 'running', attempts = attempts + 1, host = ?, "
+                    "started = ?, finished = NULL, runtime = NULL "
+                    "WHERE kind = ? AND mass = ? AND unit = ?",
+                    (host, now, kind, mass, unit))
+
+    # Marks the unit as done or failed, the runtime is measured from the
+    # last start
+    def finish(self, kind, masses, unit, failed=False, now=None):
+        now = now or time.time()
+        with self.db:
+            for mass in masses:
+                self.db.execute("INSERT OR IGNORE INTO units (kind, mass, unit) VALUES (?, ?, ?)",
+                                (kind, mass, unit))
+                self.db.execute(
+                    "UPDATE units SET status = ?, finished = ?, runtime = ? - started "
+                    "WHERE kind = ? AND mass = ? AND unit = ?",
+                    ("failed" if failed else "done", now, now, kind, mass, unit))
+
+    # Applies the new records of the batch jobs in directory in the order
+    # of their time. Returns the number of new records.
+    def collect(self, directory):
+        collected = set(name for name, in self.db.execute("SELECT name FROM records"))
+        records = []
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(".json") or name in collected:
+                continue
+            with open(os.path.join(directory, name)) as f:
+                records.append(dict(json.load(f), name=name))
+
+        for record in sorted(records, key=lambda record: record["time"]):
+            kind, unit, now = record["kind"], record["unit"], record["time"]
+            if record["event"] == "start":
+                self.start(kind, record["masses"], unit, record["host"], now)
+            else:
+                self.finish(kind, record["done"], unit, now=now)
+                self.finish(kind, record["failed"], unit, failed=True, now=now)
+            with self.db:
+                self.db.execute("INSERT INTO records (name) VALUES (?)", (record["name"],))
+
+        return len(records)
+
+    # Units of a kind (rows of the table as dictionaries):
+    # - missing: not done (expected, running or failed)
+    # - failed: failed in the last attempt
+    # - slow: runtime (or time since the start if running) above
+    #   slow_seconds
+    def query(self, kind, select="missing", slow_seconds=None):
+        conditions = {
+            "all": "1",
+            "missing": "status != 'done'",
+            "failed": "status = 'failed'",
+            "running": "status = 'running'",
+            "slow": "COALESCE(runtime, CASE WHEN status = 'running' THEN ? - started END) > ?",
+        }
+        parameters = (kind,) + ((time.time(), slow_seconds) if select == "slow" else ())
+
+        cursor = self.db.execute(
+            "SELECT * FROM units WHERE kind = ? AND {} ORDER BY mass, unit".format(
+                conditions[select]), parameters)
+        names = [description[0] for description in cursor.description]
+
+        return [dict(zip(names, row)) for row in cursor]
+
+    # Number of units per mass and status
+    def counts(self, kind):
+        counts = {}
+        for mass, status, count in self.db.execute(
+                "SELECT mass, status, COUNT(*) FROM units WHERE kind = ? GROUP BY mass, status",
+                (kind,)):
+            counts.setdefault(mass, dict((status, 0) for status in statuses))[status] = count
+
+        return counts
+
+    # Writes the resubmission list of the selected units (no header)
+    def export(self, outfile, kind, select="missing", slow_seconds=None):
+        units = self.query(kind, select, slow_seconds)
+        with open(outfile, "w") as f:
+            for unit in units:
+                f.write(",".join(str(unit[name]) for name in kinds[kind][1]) + "\n")
+
+        return len(units)
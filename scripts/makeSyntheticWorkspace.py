@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+import argparse
+import array
+import math
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+parser = argparse.ArgumentParser(
+    description="Builds synthetic HistFactory workspaces with the structure and naming of the "
+    "analysis workspaces (channels, gamma_stat_*, ATLAS_norm_Zhf / ATLAS_norm_ttbar, "
+    "ModelConfig, obsData) and matching toy_globs_<mass>.root trees for offline tests and "
+    "benchmarks")
+parser.add_argument("-o", "--outdir", default="synthetic_ws")
+parser.add_argument("-m", "--masses", default="500",
+                    help="Comma-separated mass points (default: %(default)s)")
+parser.add_argument("--bins", type=int, default=10,
+                    help="Number of bins of the signal regions (default: %(default)s)")
+parser.add_argument("--cr-bins", type=int, default=4,
+                    help="Number of bins of the Z+hf control region (default: %(default)s)")
+parser.add_argument("--nps", type=int, default=20,
+                    help="Number of systematic NPs (alpha_*), every third has a shape "
+                    "component (default: %(default)s)")
+parser.add_argument("--toys", type=int, default=100,
+                    help="Number of entries of the globs trees (default: %(default)s)")
+parser.add_argument("--pseudo-data", type=int, default=0, metavar="N",
+                    help="Also write N pseudo-data histograms per channel "
+                    "(pseudodata_<mass>_<channel>.root, see --pseudo-data of the fit scripts)")
+parser.add_argument("--bkg-yield", type=float, default=500.,
+                    help="Background events per channel (default: %(default)s)")
+parser.add_argument("--signal-yield", type=float, default=10.,
+                    help="Signal events per signal region for mu = 1 (default: %(default)s)")
+parser.add_argument("--inject-mu", type=float, default=0.,
+                    help="Signal strength of the observed data (default: %(default)s)")
+parser.add_argument("--stat-threshold", type=float, default=0.,
+                    help="Relative MC stat. uncertainty below which no gamma is created "
+                    "(default: %(default)s)")
+parser.add_argument("--seed", type=int, default=1)
+args = parser.parse_args()
+
+import ROOT as R
+R.gROOT.SetBatch(True)
+R.TH1.AddDirectory(False)
+R.RooMsgService.instance().setGlobalKillBelow(R.RooFit.WARNING)
+
+HistFactory = R.RooStats.HistFactory
+
+# Channels of the analysis: (short name used in the output files,
+# channel name, signal region). The short names are the patterns the
+# globs trees are matched with (see GlobsIndex in DiscoveryTestStat.C).
+channels = [
+    ("SpcTauHH", "Region_BMin0_T2_SpcTauHH_Y2015_distPNN_J2", True),
+    ("LTT0", "Region_BMin0_T2_SpcTauLH_Y2015_LTT0_distPNN_J2", True),
+    ("LTT1", "Region_BMin0_T2_SpcTauLH_Y2015_LTT1_distPNN_J2", True),
+    ("DZllbbCR", "Region_BMin0_T2_Y2015_DZllbbCR_distmLL_J2", False),
+]
+
+# Trees of the gamma globs per channel
+globs_trees = {
+    "SpcTauHH": "globs_hadhad",
+    "LTT0": "globs_slt",
+    "LTT1": "globs_ltt",
+    "DZllbbCR": "globs_ZCR",
+}
+
+# Background composition of the signal regions / the control region
+bkg_fractions = {
+    True: {"Zhf": 0.2, "ttbar": 0.6, "other": 0.2},
+    False: {"Zhf": 0.8, "ttbar": 0.1, "other": 0.1},
+}
+
+
+# HistFactory deletes some of the histograms it is given, so they are
+# not owned by python
+def make_hist(name, values, rel_errors):
+    hist = R.TH1F(name, name, len(values), 0, len(values))
+    R.SetOwnership(hist, False)
+    for i, (value, rel_error) in enumerate(zip(values, rel_errors)):
+        hist.SetBinContent(i + 1, value)
+        hist.SetBinError(i + 1, value * rel_error)
+    return hist
+
+
+# Falling distribution of the PNN score / mLL with the given yield
+def bkg_shape(nbins, slope, total):
+    shape = np.exp(-np.arange(nbins) / (slope * nbins))
+    return total * shape / shape.sum()
+
+
+# Signal peaking at a bin moving with the mass (log scale between the
+# lowest and highest mass of the analysis)
+def signal_shape(nbins, mass, total):
+    pos = (math.log(mass) - math.log(251.)) / (math.log(1600.) - math.log(251.))
+    centre = 0.3 * nbins + 0.6 * nbins * min(max(pos, 0.), 1.)
+    shape = np.exp(-0.5 * ((np.arange(nbins) + 0.5 - centre) / (0.1 * nbins + 0.5))**2)
+    return total * shape / shape.sum()
+
+
+# Effect of the NPs on the samples, the same for all masses: relative
+# size of the normalisation effect per (np, channel, sample), shape
+# effect for every third NP
+def make_systematics(rng):
+    systematics = []
+    for inp in range(args.nps):
+        effects = {}
+        for short, _, _ in channels:
+            for sample in ["signal", "Zhf", "ttbar", "other"]:
+                effects[short, sample] = rng.uniform(0.005, 0.08)
+        systematics.append(("SysNP{:03d}".format(inp), effects, inp % 3 == 2))
+    return systematics
+
+
+def build_workspace(mass, systematics, rng, tmpdir, expected_data):
+    meas = HistFactory.Measurement("meas", "meas")
+    meas.SetOutputFilePrefix(os.path.join(tmpdir, "hf"))
+    meas.SetPOI("SigXsecOverSM")
+    meas.SetLumi(1.0)
+    meas.SetLumiRelErr(0.017)
+    meas.AddConstantParam("Lumi")
+
+    for short, channel_name, signal_region in channels:
+        nbins = args.bins if signal_region else args.cr_bins
+        channel = HistFactory.Channel(channel_name)
+        channel.SetStatErrorConfig(args.stat_threshold, "Poisson")
+
+        samples = {}
+        for sample, fraction in bkg_fractions[signal_region].items():
+            slope = {"Zhf": 0.5, "ttbar": 0.3, "other": 0.8}[sample]
+            samples[sample] = bkg_shape(nbins, slope, fraction * args.bkg_yield)
+        if signal_region:
+            samples["signal"] = signal_shape(nbins, mass, args.signal_yield)
+
+        bkg = sum(values for sample, values in samples.items() if sample != "signal")
+        expected = bkg + args.inject_mu * samples.get("signal", 0.)
+        data = rng.poisson(expected).astype(float)
+        hist = make_hist("{}_data".format(channel_name), data, np.zeros(nbins))
+        channel.SetData(hist)
+
+        for sample in ["signal", "Zhf", "ttbar", "other"]:
+            if sample not in samples:
+                continue
+
+            values = samples[sample]
+            # MC statistical uncertainty grows towards the tails
+            rel_errors = rng.uniform(0.02, 0.06, nbins) * (1. + np.arange(nbins) / float(nbins))
+            hist = make_hist("{}_{}".format(channel_name, sample), values, rel_errors)
+    
+            s = HistFactory.Sample(sample)
+            s.SetHisto(hist)
+            s.SetNormalizeByTheory(sample in ("signal", "other"))
+
+            if sample == "signal":
+                s.AddNormFactor("SigXsecOverSM", 0., -40., 40.)
+            else:
+                s.ActivateStatError()
+                if sample in ("Zhf", "ttbar"):
+                    s.AddNormFactor("ATLAS_norm_" + sample, 1., 0., 5.)
+
+            for name, effects, shape in systematics:
+                size = effects[short, sample]
+                s.AddOverallSys(name, 1. - size, 1. + size)
+
+                if shape:
+                    tilt = size * np.linspace(-1., 1., nbins)
+                    up = make_hist("{}_{}_{}_up".format(channel_name, sample, name),
+                                   values * (1. + tilt), np.zeros(nbins))
+                    down = make_hist("{}_{}_{}_down".format(channel_name, sample, name),
+                                     values * (1. - tilt), np.zeros(nbins))
+
+                    hs = HistFactory.HistoSys()
+                    hs.SetName(name)
+                    hs.SetHistoHigh(up)
+                    hs.SetHistoLow(down)
+                    s.AddHistoSys(hs)
+
+            channel.AddSample(s)
+
+        expected_data[short] = expected
+        meas.AddChannel(channel)
+
+    ws = HistFactory.MakeModelAndMeasurementFast(meas)
+    ws.SetName("combined")
+    return ws
+
+
+# Toys of the global observables: alphas from a unit Gaussian, gammas
+# Poisson distributed around tau (the nominal value of nom_gamma_stat_*)
+def write_globs(fn, ws, rng):
+    model = ws.obj("ModelConfig")
+    names = [glob.GetName() for glob in model.GetGlobalObservables()]
+
+    fout = R.TFile(fn, "RECREATE")
+
+    alphas = [name for name in names if name.startswith("nom_alpha_")]
+    tree = R.TTree("globs_alphas", "globs_alphas")
+    buffers = [array.array("f", [0.]) for _ in alphas]
+    for name, buf in zip(alphas, buffers):
+        tree.Branch(name, buf, name + "/F")
+    for _ in range(args.toys):
+        for buf, value in zip(buffers, rng.normal(size=len(alphas))):
+            buf[0] = value
+        tree.Fill()
+    tree.Write()
+
+    for short, channel_name, signal_region in channels:
+        nbins = args.bins if signal_region else args.cr_bins
+
+        taus = np.zeros(nbins)
+        for ibin in range(nbins):
+            tau = ws.obj("gamma_stat_{}_bin_{}_tau".format(channel_name, ibin))
+            taus[ibin] = tau.getVal() if tau else 1.
+
+        tree = R.TTree(globs_trees[short], globs_trees[short])
+        buf = array.array("f", [0.] * nbins)
+        tree.Branch("globs", buf, "globs[{}]/F".format(nbins))
+        for _ in range(args.toys):
+            for ibin, value in enumerate(rng.poisson(taus)):
+                buf[ibin] = value
+            tree.Fill()
+        tree.Write()
+
+    fout.Close()
+
+
+def write_pseudo_data(mass, expected, rng):
+    for short, channel_name, _ in channels:
+        fn = os.path.join(args.outdir, "pseudodata_{}_{}.root".format(mass, short))
+        fout = R.TFile(fn, "RECREATE")
+        nbins = len(expected[short])
+        for index in range(args.pseudo_data):
+            hist = make_hist("pseudodata_{}".format(index),
+                             rng.poisson(expected[short]).astype(float), np.zeros(nbins))
+            hist.Write()
+        fout.Close()
+
+
+if not os.path.isdir(args.outdir):
+    os.makedirs(args.outdir)
+
+systematics = make_systematics(np.random.RandomState(args.seed))
+
+for mass in [int(mass) for mass in args.masses.split(",")]:
+    rng = np.random.RandomState([args.seed, mass])
+
+    # HistFactory writes intermediate files next to the output prefix
+    tmpdir = tempfile.mkdtemp(prefix="synthetic_ws_")
+    try:
+        expected = {}
+        ws = build_workspace(mass, systematics, rng, tmpdir, expected)
+        ws.writeToFile(os.path.join(args.outdir, "{}.root".format(mass)))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    write_globs(os.path.join(args.outdir, "toy_globs_{}.root".format(mass)), ws, rng)
+
+    if args.pseudo_data:
+        write_pseudo_data(mass, expected, rng)
+
+    print("Mass {}: {} bins, {} NPs, {} global observables".format(
+        mass, args.bins * 3 + args.cr_bins, args.nps,
+        ws.obj("ModelConfig").GetGlobalObservables().getSize()))
@@ -17,31 +17,45 @@ R.gROOT.SetStyle("ATLAS")
 
 dfs = []
 
-# Guess masses from filename
+# Mass from the mass column (global toys) or guessed from the filename
 for infile in args.infiles:
     basename = path.basename(infile)
 
-    match = re.search(r"(\d{3,})", basename)
-    assert match is not None
+    df = pd.read_csv(infile)
 
-    mass = int(match.group(0))
+    if "mass" in df:
+        df["masspoint"] = df["mass"]
+        print("Got file '{}'".format(basename))
+    else:
+        match = re.search(r"(\d{3,})", basename)
+        assert match is not None
 
-    print("Got file '{}' with mass {}".format(basename, mass))
+        mass = int(match.group(0))
+        df["masspoint"] = mass
+        print("Got file '{}' with mass {}".format(basename, mass))
 
-    df = pd.read_csv(infile)
-    df["masspoint"] = mass
     dfs.append(df)
 
 df = pd.concat(dfs)
-df.status_uncond = df.status_uncond.astype(np.int64)
-df.status_cond = df.status_cond.astype(np.int64)
+df.uncond_status = df.uncond_status.astype(np.int64)
+df.cond_status = df.cond_status.astype(np.int64)
 df.rename(columns={"index": "toyindex"}, inplace=True)
 
-df["fit_failed"] = (df.status_uncond != 0) | (df.status_cond != 0)
+df["fit_failed"] = (df.uncond_status != 0) | (df.cond_status != 0)
 df["fit_success"] = ~df.fit_failed
 
-# Average time per fit
-avg_time = df.groupby("masspoint")["avg_time"].mean()
+# Time per toy: both fits if timed, otherwise the time per toy of the job
+if "uncond_time" in df and "cond_time" in df:
+    df["fit_time"] = df.uncond_time + df.cond_time
+else:
+    df["fit_time"] = df.avg_time
+
+# Median / 95th percentile of the fit latency
+fit_time = df.groupby("masspoint")["fit_time"]
+p50_time = fit_time.quantile(0.5)
+p95_time = fit_time.quantile(0.95)
+for mass in p50_time.index:
+    print("m = {}: p50 = {:.2f} s, p95 = {:.2f} s".format(mass, p50_time[mass], p95_time[mass]))
 # Fraction of failed fits
 failure_rate = df.groupby("masspoint")["fit_failed"].mean()
 #
@@ -51,18 +65,22 @@ print(max_muhat)
 p_success_all = df.groupby("masspoint")["fit_success"].mean().product()
 print("Probability of having a successfully fitted toy for all points: {:.1f} %".format(100 * p_success_all))
 
-# Average time histogram / barchart
-h_avg_time = R.TH1F("h_avg_time", "", len(avg_time), 0, len(avg_time))
-for idx, (mass, time) in enumerate(zip(avg_time.index, avg_time), start=1):
-    h_avg_time.SetBinContent(idx, time)
-    h_avg_time.GetXaxis().SetBinLabel(idx, "{}".format(mass))
-
-h_avg_time.SetMinimum(0)
-h_avg_time.SetMaximum(1.2 * avg_time.max())
-h_avg_time.GetXaxis().SetTitle("Masspoint [GeV]")
-h_avg_time.GetYaxis().SetTitle("Time per fit [s]")
-h_avg_time.GetXaxis().SetLabelFont(43)
-h_avg_time.GetXaxis().SetLabelSize(14)
+# Fit latency histograms / barcharts
+h_p50_time = R.TH1F("h_p50_time", "", len(p50_time), 0, len(p50_time))
+h_p95_time = R.TH1F("h_p95_time", "", len(p95_time), 0, len(p95_time))
+for idx, mass in enumerate(p50_time.index, start=1):
+    h_p50_time.SetBinContent(idx, p50_time[mass])
+    h_p95_time.SetBinContent(idx, p95_time[mass])
+    h_p95_time.GetXaxis().SetBinLabel(idx, "{}".format(mass))
+
+h_p95_time.SetMinimum(0)
+h_p95_time.SetMaximum(1.3 * p95_time.max())
+h_p95_time.GetXaxis().SetTitle("Masspoint [GeV]")
+h_p95_time.GetYaxis().SetTitle("Time per fit [s]")
+h_p95_time.GetXaxis().SetLabelFont(43)
+h_p95_time.GetXaxis().SetLabelSize(14)
+h_p95_time.SetLineColor(R.kRed)
+h_p50_time.SetLineColor(R.kBlue)
 
 # Failure rate histogram / barchart
 h_failure_rate = R.TH1F("h_failure_rate", "", len(failure_rate), 0, len(failure_rate))
@@ -78,8 +96,15 @@ h_failure_rate.GetXaxis().SetLabelFont(43)
 h_failure_rate.GetXaxis().SetLabelSize(14)
 
 c = R.TCanvas("c", "", 800, 600)
-h_avg_time.Draw("HIST")
-c.SaveAs("fit_avg_time.pdf")
+h_p95_time.Draw("HIST")
+h_p50_time.Draw("HIST SAME")
+
+legend = R.TLegend(0.65, 0.8, 0.9, 0.9)
+legend.SetBorderSize(0)
+legend.AddEntry(h_p50_time, "Median", "l")
+legend.AddEntry(h_p95_time, "95th percentile", "l")
+legend.Draw()
+c.SaveAs("fit_latency.pdf")
 
 c.Clear()
 h_failure_rate.Draw("HIST")
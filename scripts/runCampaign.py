@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+import argparse
+import multiprocessing
+import os
+import shlex
+import sys
+
+from campaign import Campaign, CondorBackend, LocalBackend, Unit
+from common import masses, mu_ranges
+from ledger import parse_range
+from toystore import formats, is_store, read_rows
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Default command per backend: the toy script on this machine, the
+# batch wrapper on HTCondor
+commands = {
+    "local": "{python} {scripts}/runDiscoveryTestStatToys.py {workspace} -s {seed} -n {ntoys} "
+             "-o {outfile} --mu-range {mu_range} --optimizer-strategy 1 --format {format} "
+             "--resume",
+    "condor": "{scripts}/../batch_submission/wrapper_toys_local.sh {workspace} {outdir} {ntoys} "
+              "{seed}",
+}
+
+parser = argparse.ArgumentParser(
+    description="Runs a campaign of q0 sampling distribution toys: all (mass, seed) units are "
+    "scheduled at once on a local process pool or HTCondor with a limit of concurrent jobs. "
+    "Failed units are retried, the progress is recorded in a job ledger (jobLedger.py) and "
+    "units that are done are skipped when the campaign is restarted.")
+parser.add_argument("workspace",
+                    help="Workspace per mass, {mass} is replaced (e.g. ws/{mass}.root)")
+parser.add_argument("outdir", help="Output directory per mass, {mass} is replaced "
+                    "(e.g. toys/comb_{mass}); outputs are toy_<seed>.csv")
+parser.add_argument("--mass", default=",".join(str(mass) for mass in masses),
+                    help="Comma-separated masses (default: all mass points)")
+parser.add_argument("--seeds", default="0-999", help="Seeds (jobs) per mass, e.g. 0-999")
+parser.add_argument("-n", "--ntoys", type=int, default=100, help="Toys per job")
+parser.add_argument("--backend", choices=["local", "condor"], default="local")
+parser.add_argument("-j", "--max-jobs", type=int, default=multiprocessing.cpu_count(),
+                    help="Maximum number of concurrent jobs (default: number of CPUs)")
+parser.add_argument("--max-attempts", type=int, default=3, help="Attempts per unit")
+parser.add_argument("--ledger", default="ledger.sqlite", help="Job ledger of the campaign")
+parser.add_argument("--logdir", default="logs", help="Directory of the job logs")
+parser.add_argument("--format", choices=formats, default="csv",
+                    help="Output format of the local backend (the batch wrapper writes CSV)")
+parser.add_argument("--command", default=None,
+                    help="Command template of a unit with {workspace}, {outdir}, {outfile}, "
+                    "{mass}, {seed}, {ntoys}, {mu_range}, {format}, {python}, {scripts} "
+                    "(default: toy script for local, wrapper_toys_local.sh for condor)")
+parser.add_argument("--condor-option", action="append", default=[],
+                    help="Additional line of the HTCondor submit description, e.g. "
+                    "'Request_memory = 2GB' (repeatable)")
+args = parser.parse_args()
+
+if not os.path.isdir(args.logdir):
+    os.makedirs(args.logdir)
+
+fmt = args.format if args.backend == "local" else "csv"
+command = args.command or commands[args.backend]
+
+units = []
+for mass in [int(mass) for mass in args.mass.split(",")]:
+    outdir = args.outdir.format(mass=mass)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    for seed in parse_range(args.seeds):
+        outfile = os.path.join(outdir, "toy_{}{}".format(seed, ".csv" if fmt == "csv" else ""))
+        units.append(Unit(mass, seed, shlex.split(command.format(
+            workspace=args.workspace.format(mass=mass), outdir=outdir, outfile=outfile,
+            mass=mass, seed=seed, ntoys=args.ntoys, mu_range=mu_ranges.get(mass, 15.),
+            format=fmt, python=sys.executable, scripts=script_dir)), outfile))
+
+
+# A unit is done if its output has all toys
+def validate(unit):
+    if not (os.path.isfile(unit.outfile) or is_store(unit.outfile)):
+        return False
+
+    return len(read_rows(unit.outfile)) == args.ntoys
+
+
+if args.backend == "local":
+    backend = LocalBackend(args.logdir)
+else:
+    backend = CondorBackend(args.logdir, args.condor_option)
+
+campaign = Campaign(backend, args.ledger, max_jobs=args.max_jobs,
+                    max_attempts=args.max_attempts, validate=validate)
+failed = campaign.run(units)
+
+if failed:
+    print("{} units failed: {}".format(len(failed), ", ".join(unit.name for unit in failed)))
+    sys.exit(1)
@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 import argparse
-import csv
-import os
+import atexit
 import sys
+import time
+
+from common import (PhaseProfile, add_pseudo_data_sources, fit_fieldnames, load_macro,
+                    make_fit_row, make_retry_rows, mu_ranges, print_fit_result)
+from toystore import formats, open_output
+
+start_time = time.time()
 
 parser = argparse.ArgumentParser()
 parser.add_argument("infile")
@@ -10,11 +16,20 @@ parser.add_argument("--workspace-name", default="combined")
 parser.add_argument("--model-config", default="ModelConfig")
 parser.add_argument("--data-name", default="obsData")
 
-parser.add_argument("--mu-range", default=15., type=float)
+parser.add_argument("--mu-range", default=None, type=float,
+                    help="Range of the POI (default: from the mass point, otherwise 15)")
 parser.add_argument("--optimizer-strategy", type=int, default=2)
 parser.add_argument("--optimizer", choices=["Minuit2", "Minuit"], default="Minuit2")
+parser.add_argument("--num-cpu", type=int, default=1,
+                    help="Evaluate the likelihood in N parallel processes (RooFit NumCPU). "
+                    "The NLL is then rebuilt for every fit.")
+parser.add_argument("--batch-mode", action="store_true",
+                    help="Evaluate the likelihood in RooFit's vectorised batch mode")
 
 parser.add_argument("-o", "--outfile", default=None)
+parser.add_argument("--format", choices=formats, default="csv",
+                    help="Output format: CSV file or toy store directory "
+                    "(typed .npy columns, see toystore.py) (default: %(default)s)")
 parser.add_argument("-m", "--mass", type=int, default=None)
 parser.add_argument("-i", "--index", type=int, default=None)
 
@@ -25,78 +40,221 @@ parser.add_argument("--globs-tree", default="",
 parser.add_argument("--globs-index", default=0, type=int,
                     help="Index in the tree that contains the values of the global observables")
 
+parser.add_argument("--pseudo-data", action="append", default=[], metavar="[CHANNEL=]FILE",
+                    help="File with pseudo-data histograms replacing the observed data, "
+                    "optionally only for channels matching the regex CHANNEL (can be repeated)")
+parser.add_argument("--pseudo-data-hist", default="pseudodata_{index}",
+                    help="Name of the pseudo-data histograms ('{index}' is replaced by the toy index)")
+
+parser.add_argument("--jobs", default=None,
+                    help="Run many fits on the same workspace. File with one job per line "
+                    "'index,globs_index[,optimizer,strategy[,mu_range]]' ('-' reads from stdin). "
+                    "Omitted fields default to the command line options.")
+
+parser.add_argument("--warm-start", action="store_true",
+                    help="Start the fits of a job from the post-fit values of the previous job "
+                    "(--jobs only). Falls back to a cold start if the fit fails.")
+
+parser.add_argument("--retry", action="store_true",
+                    help="Fit with the retry ladder instead of the nominal optimizer settings "
+                    "(the nominal fit is not run): try the retry methods in order of priority, "
+                    "starting with minuit2strat2, until --retry-min-good fits are good")
+parser.add_argument("--retry-methods", default="",
+                    help="Comma-separated retry methods (default: all in order of priority). "
+                    "Implies --retry.")
+parser.add_argument("--retry-min-good", default=3, type=int, metavar="N",
+                    help="Stop the retry ladder after N good fits (converged, q0 >= -0.1). "
+                    "evaluateRetries.py keeps only toys with three good fits.")
+
+parser.add_argument("--profile", default=None, metavar="FILE",
+                    help="Write wall/CPU time and memory of the phases of the job "
+                    "(startup, compile, workspace load, NLL build, fits, output) to a JSON file")
+parser.add_argument("--profile-python", action="store_true",
+                    help="Also run the job in cProfile (stats in <profile>.prof)")
+parser.add_argument("--profile-rootrace", action="store_true",
+                    help="Also print the RooTrace object counts at the end of the job")
+
 args = parser.parse_args()
 
-# Get macro directory to load needed ROOT macros
-macro_path = os.path.join(os.path.dirname(__file__), "..", "macros")
-macro_path = os.path.abspath(macro_path)
+if args.retry_methods:
+    args.retry = True
+
+if args.retry and args.retry_min_good < 3:
+    print("Warning: the retry ladder stops after {} good fits, evaluateRetries.py keeps only "
+          "toys with three good fits".format(args.retry_min_good))
+
+if args.mu_range is None:
+    args.mu_range = mu_ranges.get(args.mass, 15.)
+
+profile = PhaseProfile(args.profile, args.profile_python)
+profile.info = {"script": "runDiscoveryTestStat.py", "infile": args.infile,
+                "mass": args.mass, "index": args.index}
+
+with profile.phase("import_root"):
+    import ROOT as R
+    R.gROOT.SetBatch(True)
+
+with profile.phase("compile"):
+    load_macro("DiscoveryTestStat.C")
 
+profile.enable_root(args.profile_rootrace)
+# Also written if the job fails
+atexit.register(profile.write)
 
-import ROOT as R
-R.gROOT.SetBatch(True)
-R.gROOT.ProcessLine(".L {}/DiscoveryTestStat.C+".format(macro_path))
+print("Startup time: {:.2f} s".format(time.time() - start_time))
 
 R.Math.MinimizerOptions.SetDefaultMinimizer(args.optimizer)
 R.Math.MinimizerOptions.SetDefaultStrategy(args.optimizer_strategy)
+R.DiscoveryProfileLikelihood.SetDefaultNumCPU(args.num_cpu)
+R.DiscoveryProfileLikelihood.SetDefaultBatchMode(args.batch_mode)
 
-ret = R.DiscoveryTestStat(
-    args.infile,
-    args.workspace_name,
-    args.model_config,
-    args.data_name,
-    args.mu_range,
-    args.globs_tree,
-    args.globs_index,
-    args.verbose)
-
-# Warning: test statistic is the likelihood ratio and not q0: q0 = 2 * LLR
-print("Likelihood-ratio: {:.5f}".format(ret.ts))
-print("q0: {:.5f}".format(2 * ret.ts))
-print("muhat: {:.5f}".format(ret.muhat))
-print("muhat pull: {:.5f}".format(ret.muhat_pull))
-print("uncond_status: {}".format(ret.uncond_status))
-print("uncond_minNLL: {}".format(ret.uncond_minNLL))
-print("cond_status: {}".format(ret.cond_status))
-print("cond_minNLL: {}".format(ret.cond_minNLL))
-print("cond_zhf: {}".format(ret.cond_zhf))
-print("uncond_zhf: {}".format(ret.uncond_zhf))
-print("cond_ttbar: {}".format(ret.cond_ttbar))
-print("uncond_ttbar: {}".format(ret.uncond_ttbar))
-print("cond_covQual: {}".format(ret.cond_covQual))
-print("uncond_covQual: {}".format(ret.uncond_covQual))
-
-
-if args.outfile:
-    with open(args.outfile, "w") as f:
-        fieldnames = [
-            "index", "mass", "q0", "muhat",
-            "muhat_pull",
-            "uncond_status", "uncond_minNLL",
-            "cond_status", "cond_minNLL",
-            "cond_zhf", "uncond_zhf",
-            "cond_ttbar", "uncond_ttbar",
-            "mu_range",
-            "uncond_covQual", "cond_covQual",
-        ]
-
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-
-        writer.writerow({
-            "index": args.index,
-            "mass": args.mass,
-            "q0": 2 * ret.ts,
-            "muhat": ret.muhat,
-            "muhat_pull": ret.muhat_pull,
-            "uncond_status": ret.uncond_status,
-            "uncond_minNLL": ret.uncond_minNLL,
-            "cond_status": ret.cond_status,
-            "cond_minNLL": ret.cond_minNLL,
-            "cond_zhf": ret.cond_zhf,
-            "uncond_zhf": ret.uncond_zhf,
-            "cond_ttbar": ret.cond_ttbar,
-            "uncond_ttbar": ret.uncond_ttbar,
+
+def make_row(ret, index, mu_range, retry_method=""):
+    return make_fit_row(ret, index, args.mass, mu_range, retry_method)
+
+
+# Parses the job stream of the fit-server mode
+def read_jobs(f):
+    for line in iter(f.readline, ""):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+
+        fields = [field.strip() for field in line.split(",")]
+        if len(fields) not in (2, 4, 5):
+            raise RuntimeError("Cannot parse job: '{}'".format(line))
+
+        job = {
+            "index": int(fields[0]),
+            "globs_index": int(fields[1]),
+            "optimizer": args.optimizer,
+            "optimizer_strategy": args.optimizer_strategy,
             "mu_range": args.mu_range,
-            "uncond_covQual": ret.uncond_covQual,
-            "cond_covQual": ret.cond_covQual,
-        })
+        }
+
+        if len(fields) >= 4:
+            job["optimizer"] = fields[2]
+            job["optimizer_strategy"] = int(fields[3])
+        if len(fields) == 5:
+            job["mu_range"] = float(fields[4])
+
+        yield job
+
+
+def run_jobs(jobs):
+    with profile.phase("setup"):
+        fitter = R.DiscoveryTestStatFitter(
+            args.infile,
+            args.workspace_name,
+            args.model_config,
+            args.data_name,
+            args.verbose)
+
+    if not fitter.IsValid():
+        sys.exit("Cannot set up fit for {}".format(args.infile))
+
+    if args.retry and not fitter.SetRetryLadder(args.retry_methods):
+        sys.exit("Unknown retry methods: {}".format(args.retry_methods))
+
+    fitter.SetWarmStart(args.warm_start)
+    if not add_pseudo_data_sources(fitter, args.pseudo_data):
+        sys.exit("Cannot read pseudo-data")
+
+    output = open_output(args.outfile, fit_fieldnames, args.format) if args.outfile else None
+
+    for job in jobs:
+        print("Fitting index {} (globs index {}) with {} strategy {}, mu range {}".format(
+            job["index"], job["globs_index"], job["optimizer"],
+            job["optimizer_strategy"], job["mu_range"]))
+
+        with profile.phase("job_setup"):
+            if args.pseudo_data and not fitter.SetPseudoData(args.pseudo_data_hist, job["index"]):
+                sys.exit("Cannot set pseudo-data for index {}".format(job["index"]))
+
+            fitter.SetOptimizer(job["optimizer"], job["optimizer_strategy"])
+            fitter.SetGlobs(args.globs_tree, job["globs_index"])
+            fitter.SetMuRange(job["mu_range"])
+
+        with profile.phase("fit"):
+            if args.retry:
+                rows = make_retry_rows(
+                    fitter.FitWithRetries(job["mu_range"], args.retry_min_good),
+                    job["index"], args.mass)
+            else:
+                ret = fitter.Fit()
+                print_fit_result(ret)
+                rows = [make_row(ret, job["index"], job["mu_range"])]
+
+        with profile.phase("output"):
+            if output:
+                output.writerows(rows)
+
+    fitter.PrintGlobsTiming()
+
+    if output:
+        output.close()
+
+
+if args.jobs:
+    fin = sys.stdin if args.jobs == "-" else open(args.jobs)
+    run_jobs(read_jobs(fin))
+    sys.exit(0)
+
+if args.pseudo_data:
+    # Pseudo-data are only supported by the fitter: run as a single job
+    if args.index is None:
+        sys.exit("Pseudo-data requires the toy index (-i)")
+
+    run_jobs([{
+        "index": args.index,
+        "globs_index": args.globs_index,
+        "optimizer": args.optimizer,
+        "optimizer_strategy": args.optimizer_strategy,
+        "mu_range": args.mu_range,
+    }])
+    sys.exit(0)
+
+
+# Fit with the workspace loaded by the macro
+def run_single():
+    if args.retry:
+        results = R.DiscoveryTestStatRetries(
+            args.infile,
+            args.workspace_name,
+            args.model_config,
+            args.data_name,
+            args.mu_range,
+            args.globs_tree,
+            args.globs_index,
+            args.retry_methods,
+            args.retry_min_good,
+            args.verbose)
+
+        if results.empty():
+            sys.exit("Retry ladder failed for {}".format(args.infile))
+
+        return make_retry_rows(results, args.index, args.mass)
+
+    ret = R.DiscoveryTestStat(
+        args.infile,
+        args.workspace_name,
+        args.model_config,
+        args.data_name,
+        args.mu_range,
+        args.globs_tree,
+        args.globs_index,
+        args.verbose)
+
+    print_fit_result(ret)
+    return [make_row(ret, args.index, args.mu_range)]
+
+
+# Setup and fit in one phase (split up by the phases of the macro)
+with profile.phase("fit"):
+    rows = run_single()
+
+with profile.phase("output"):
+    if args.outfile:
+        output = open_output(args.outfile, fit_fieldnames, args.format)
+        output.writerows(rows)
+        output.close()
@@ -1,15 +1,26 @@
 #!/usr/bin/env python
 import argparse
 import csv
+import hashlib
+import math
+import multiprocessing
 import os
 import sys
 import time
 
+import numpy as np
+
+from common import PhaseProfile, load_macro
+from toystore import ToyStore, formats, is_store, open_output, remove
+
 parser = argparse.ArgumentParser()
 parser.add_argument("infile")
 parser.add_argument("-s", "--seed", type=int, required=True)
 parser.add_argument("-o", "--outfile", default="toys.csv")
 parser.add_argument("-n", "--ntoys", type=int, default=10)
+parser.add_argument("--format", choices=formats, default="csv",
+                    help="Output format: CSV file or toy store directory "
+                    "(typed .npy columns, see toystore.py) (default: %(default)s)")
 
 parser.add_argument("--workspace-name", default="combined")
 parser.add_argument("--model-config", default="ModelConfig")
@@ -19,110 +30,434 @@ parser.add_argument("--mu-range", default=15., type=float)
 
 parser.add_argument("--optimizer-strategy", type=int, default=1)
 parser.add_argument("--optimizer", choices=["Minuit2", "Minuit"], default="Minuit2")
+parser.add_argument("--num-cpu", type=int, default=1,
+                    help="Evaluate the likelihood in N parallel processes (RooFit NumCPU). "
+                    "The NLL is then rebuilt for every fit.")
+parser.add_argument("--batch-mode", action="store_true",
+                    help="Evaluate the likelihood in RooFit's vectorised batch mode")
 parser.add_argument("-v", "--verbose", action="store_true")
+parser.add_argument("--warm-start", action="store_true",
+                    help="Start the fits of a toy from the post-fit values of the previous toy "
+                    "in the same process. Falls back to a cold start if the fit fails.")
+
+parser.add_argument("-j", "--workers", type=int, default=1,
+                    help="Number of processes generating toys in parallel. With more than one "
+                    "worker (or the toys missing for --resume) every toy gets its own seed "
+                    "derived from --seed and the toy index, a single worker reproduces the toys "
+                    "of older versions (one random sequence seeded with 10000 + seed).")
+parser.add_argument("--resume", action="store_true",
+                    help="Keep the toys already in the output file and only generate the missing ones")
+
+parser.add_argument("--details", default=None,
+                    help="Write the detailed output of the sampler (fitted parameters with "
+                    "errors and pulls, fit status, ...) as columns to this .npz file")
+parser.add_argument("--details-include", default="",
+                    help="Regex selecting the detailed output columns (default: all)")
+parser.add_argument("--details-exclude", default="",
+                    help="Regex of detailed output columns to drop")
+
+parser.add_argument("--profile", default=None, metavar="FILE",
+                    help="Write wall/CPU time and memory of the phases of the job "
+                    "(startup, compile, workspace load, NLL build, toys, output) to a JSON file "
+                    "(one file per worker with --workers)")
+parser.add_argument("--profile-python", action="store_true",
+                    help="Also run the job in cProfile (stats in <profile>.prof)")
+parser.add_argument("--profile-rootrace", action="store_true",
+                    help="Also print the RooTrace object counts at the end of the job")
 
 args = parser.parse_args()
 
-# Get macro directory to load needed ROOT macros
-macro_path = os.path.join(os.path.dirname(__file__), "..", "macros")
-macro_path = os.path.abspath(macro_path)
-
-import ROOT as R
-R.gROOT.SetBatch(True)
-R.gROOT.ProcessLine(".L {}/DiscoveryTestStatToys.C++".format(macro_path))
-
-
-# Retrieves value of a RooRealVar from RooArgSet
-# Returns None if it does not exist
-def retrieve_arg(argset, argname):
-    if isinstance(argset.find(argname), R.RooRealVar):
-        return argset.find(argname).getVal()
-
-    return None
-
-
-R.RooRandom.randomGenerator().SetSeed(10000 + args.seed)
-R.Math.MinimizerOptions.SetDefaultMinimizer(args.optimizer)
-R.Math.MinimizerOptions.SetDefaultStrategy(args.optimizer_strategy)
-
-if args.verbose:
-    # Doesn't really do anything...
-    R.Math.MinimizerOptions.SetDefaultPrintLevel(3)
-
-start_time = time.time()
-
-htr = R.DiscoveryTestStatToys(
-    args.infile,
-    args.workspace_name,
-    args.model_config,
-    args.data_name,
-    args.ntoys,
-    args.mu_range,
-    args.verbose)
-
-end_time = time.time()
-
-results = []
-null_details = htr.GetNullDetailedOutput()
-for i in range(null_details.numEntries()):
-    argset = null_details.get(i)
-
-    ts = retrieve_arg(argset, "ModelConfigB_only_TS0")
-    muhat = retrieve_arg(argset, "ModelConfigB_only_TS0_fitUncond_SigXsecOverSM")
-
-    uncond_status = retrieve_arg(argset, "ModelConfigB_only_TS0_fitUncond_fitStatus")
-    uncond_minNLL = retrieve_arg(argset, "ModelConfigB_only_TS0_fitUncond_minNLL")
-
-    cond_status = retrieve_arg(argset, "ModelConfigB_only_TS0_fitCond_fitStatus")
-    cond_minNLL = retrieve_arg(argset, "ModelConfigB_only_TS0_fitCond_minNLL")
-
-    cond_zhf = retrieve_arg(argset, "ModelConfigB_only_TS0_fitCond_ATLAS_norm_Zhf")
-    uncond_zhf = retrieve_arg(argset, "ModelConfigB_only_TS0_fitUncond_ATLAS_norm_Zhf")
-
-    cond_ttbar = retrieve_arg(argset, "ModelConfigB_only_TS0_fitCond_ATLAS_norm_ttbar")
-    uncond_ttbar = retrieve_arg(argset, "ModelConfigB_only_TS0_fitUncond_ATLAS_norm_ttbar")
-
-    uncond_covQual = retrieve_arg(argset, "ModelConfigB_only_TS0_fitUncond_covQual")
-    cond_covQual = retrieve_arg(argset, "ModelConfigB_only_TS0_fitCond_covQual")
-
-    results.append({
-        "index": i,
-        "seed": args.seed,
-        "q0": 2 * ts,
-        "muhat": muhat,
-        "uncond_status": uncond_status,
-        "uncond_minNLL": uncond_minNLL,
-        "cond_status": cond_status,
-        "cond_minNLL": cond_minNLL,
-        "zhf_norm_cond": cond_zhf,
-        "zhf_norm_uncond": uncond_zhf,
-        "ttbar_norm_cond": cond_ttbar,
-        "ttbar_norm_uncond": uncond_ttbar,
-        "uncond_covQual": uncond_covQual,
-        "cond_covQual": cond_covQual,
-    })
-
-
-total_time = end_time - start_time
-time_per_toy = total_time / args.ntoys
-
-print("Total time: {:2f} s".format(total_time))
-print("Time per toy: {:2f} s/toy".format(time_per_toy))
-
-with open(args.outfile, "w") as csvfile:
-    fieldnames = [
-        "q0", "muhat",
-        "uncond_status", "uncond_minNLL",
-        "cond_status", "cond_minNLL",
-        "seed", "index",
-        "avg_time", "mu_range",
-        "zhf_norm_cond", "zhf_norm_uncond",
-        "ttbar_norm_cond", "ttbar_norm_uncond",
-        "uncond_covQual", "cond_covQual"]
-
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-    writer.writeheader()
-    for row in results:
-        row["avg_time"] = time_per_toy
-        row["mu_range"] = args.mu_range
-        writer.writerow(row)
+
+fieldnames = [
+    "q0", "muhat",
+    "uncond_status", "uncond_minNLL",
+    "cond_status", "cond_minNLL",
+    "seed", "index",
+    "avg_time", "mu_range",
+    "zhf_norm_cond", "zhf_norm_uncond",
+    "ttbar_norm_cond", "ttbar_norm_uncond",
+    "uncond_covQual", "cond_covQual",
+    "uncond_nllEvals", "cond_nllEvals", "warm_start",
+    "uncond_time", "cond_time",
+    "uncond_edm", "cond_edm",
+    "uncond_minuitCalls", "cond_minuitCalls",
+    "uncond_strategy", "cond_strategy"]
+
+
+# Seed of the random number generator for a toy. Every toy has its own
+# seed so that the result does not depend on how the toys are split
+# between processes or on interruptions.
+def toy_seed(seed, index):
+    digest = hashlib.sha256("{}:{}".format(seed, index).encode("utf-8")).hexdigest()
+    return 1 + int(digest[:8], 16) % (2**31 - 2)
+
+
+# Columns of the detailed output (without the sampler prefix, cf.
+# DetailedOutputExporter) written to the CSV file
+detail_columns = [
+    ("q0", "ts"),
+    ("muhat", "fitUncond_SigXsecOverSM"),
+    ("uncond_status", "fitUncond_fitStatus"),
+    ("uncond_minNLL", "fitUncond_minNLL"),
+    ("cond_status", "fitCond_fitStatus"),
+    ("cond_minNLL", "fitCond_minNLL"),
+    ("zhf_norm_cond", "fitCond_ATLAS_norm_Zhf"),
+    ("zhf_norm_uncond", "fitUncond_ATLAS_norm_Zhf"),
+    ("ttbar_norm_cond", "fitCond_ATLAS_norm_ttbar"),
+    ("ttbar_norm_uncond", "fitUncond_ATLAS_norm_ttbar"),
+    ("uncond_covQual", "fitUncond_covQual"),
+    ("cond_covQual", "fitCond_covQual"),
+    ("uncond_nllEvals", "fitUncond_nllEvals"),
+    ("cond_nllEvals", "fitCond_nllEvals"),
+    ("warm_start", "warmStart"),
+    ("uncond_time", "fitUncond_time"),
+    ("cond_time", "fitCond_time"),
+    ("uncond_edm", "fitUncond_edm"),
+    ("cond_edm", "fitCond_edm"),
+    ("uncond_minuitCalls", "fitUncond_minuitCalls"),
+    ("cond_minuitCalls", "fitCond_minuitCalls"),
+    ("uncond_strategy", "fitUncond_strategy"),
+    ("cond_strategy", "fitCond_strategy"),
+]
+
+
+# CSV row of a toy from the values of detail_columns
+def make_row(values, index, toy_time):
+    row = dict((field, None if math.isnan(value) else value)
+               for (field, _), value in zip(detail_columns, values))
+    row["q0"] = 2 * row["q0"]
+    row["index"] = index
+    row["seed"] = args.seed
+    row["avg_time"] = toy_time
+    row["mu_range"] = args.mu_range
+
+    return row
+
+
+# CSV row of a toy without test statistic (NaN, no entry in the detailed
+# output). The status -1 marks the fits as failed, so the toy counts as
+# done for --resume and as failed fit in the evaluation.
+def make_failed_row(index, toy_time):
+    row = dict((field, None) for field, _ in detail_columns)
+    row["uncond_status"] = row["cond_status"] = -1
+    row["index"] = index
+    row["seed"] = args.seed
+    row["avg_time"] = toy_time
+    row["mu_range"] = args.mu_range
+
+    return row
+
+
+# Loads the detailed output columns of a .npz file
+def load_details(fn):
+    with np.load(fn) as f:
+        return dict((name, f[name]) for name in f.files)
+
+
+# Writes the detailed output columns (index and seed as integers, all
+# other columns as float) to a .npz file. The columns of existing files
+# are merged, columns missing in one of them are filled with NaN.
+def write_details(fn, columns, merge=()):
+    tables = [load_details(other) for other in merge if os.path.exists(other)]
+    if columns:
+        tables.append(columns)
+
+    nrows = [len(table["index"]) for table in tables]
+    names = []
+    for table in tables:
+        for name in table:
+            if name not in names:
+                names.append(name)
+
+    merged = {}
+    for name in names:
+        dtype = np.int64 if name in ("index", "seed") else np.float64
+        merged[name] = np.concatenate([
+            table[name].astype(dtype) if name in table else np.full(n, np.nan)
+            for table, n in zip(tables, nrows)])
+
+    # np.savez appends .npz to other names
+    with open(fn + ".tmp", "wb") as f:
+        np.savez(f, **merged)
+    os.rename(fn + ".tmp", fn)
+
+
+# The details of every toy are appended to a toy store next to the
+# details file (<details>.rows) as soon as the toy is finished, so that
+# a killed job keeps the details of its toys in the CSV file. The rows
+# are merged into the .npz file when the worker finishes or by the next
+# --resume.
+def journal_name(fn):
+    return fn + ".rows"
+
+
+def flush_details(fn):
+    journal = journal_name(fn)
+    if is_store(journal):
+        columns = ToyStore(journal).read(mmap_mode=None)
+
+        # Toys that were already merged (interrupted before the journal
+        # was removed)
+        done = load_details(fn)["index"] if os.path.exists(fn) else []
+        keep = ~np.isin(columns["index"], done)
+        if keep.any():
+            write_details(fn, dict((name, values[keep]) for name, values in columns.items()),
+                          merge=[fn])
+    remove(journal)
+
+
+class DetailsJournal(object):
+    def __init__(self, fn):
+        self.fn = fn
+        self.store = None
+
+    def append(self, index, columns, values):
+        names = ["index", "seed"] + columns
+        # New columns (variables first seen in this toy) start a new store
+        if self.store is not None and self.store.columns != names:
+            flush_details(self.fn)
+            self.store = None
+        if self.store is None:
+            self.store = ToyStore.create(journal_name(self.fn), names)
+
+        row = dict(zip(columns, values))
+        row["index"] = index
+        row["seed"] = args.seed
+        self.store.append([row])
+
+
+# Drops an incomplete last line (e.g. from a job that was killed while
+# writing) and returns the complete rows of a toy CSV file. Stores
+# only return the committed rows.
+def repair_rows(fn):
+    if args.format == "npy":
+        return ToyStore(fn).rows() if is_store(fn) else []
+
+    if not os.path.exists(fn):
+        return []
+
+    with open(fn, "rb+") as f:
+        content = f.read()
+        complete = content[:content.rfind(b"\n") + 1]
+        if len(complete) != len(content):
+            print("Dropping incomplete line in {}".format(fn))
+            f.seek(0)
+            f.truncate(len(complete))
+
+    with open(fn) as f:
+        return list(csv.DictReader(f))
+
+
+# Appends rows to a toy CSV file (writing the header for new files) or
+# store
+def append_rows(fn, rows):
+    output = open_output(fn, fieldnames, args.format, append=True)
+    output.writerows(rows)
+    output.close()
+
+
+# Generates and fits the toys with the given indices. The row of every
+# toy is appended to the output file as soon as it is finished. ROOT
+# is only imported here so that every worker process gets its own
+# instance. With sequential the random number generator is seeded once
+# (10000 + seed, as before the per-toy seeds) so that the toys of older
+# campaigns are reproduced.
+def generate_toys(indices, outfile, detailsfile, profile, sequential=False):
+    start_time = time.time()
+
+    with profile.phase("import_root"):
+        import ROOT as R
+        R.gROOT.SetBatch(True)
+
+    if sequential:
+        R.RooRandom.randomGenerator().SetSeed(10000 + args.seed)
+
+    with profile.phase("compile"):
+        load_macro("DiscoveryTestStatToys.C")
+
+    profile.enable_root(args.profile_rootrace)
+
+    print("Startup time: {:.2f} s".format(time.time() - start_time))
+
+    R.Math.MinimizerOptions.SetDefaultMinimizer(args.optimizer)
+    R.Math.MinimizerOptions.SetDefaultStrategy(args.optimizer_strategy)
+    R.DiscoveryProfileLikelihood.SetDefaultNumCPU(args.num_cpu)
+    R.DiscoveryProfileLikelihood.SetDefaultBatchMode(args.batch_mode)
+
+    if args.verbose:
+        # Doesn't really do anything...
+        R.Math.MinimizerOptions.SetDefaultPrintLevel(3)
+
+    with profile.phase("setup"):
+        generator = R.DiscoveryTestStatToysGenerator(
+            args.infile,
+            args.workspace_name,
+            args.model_config,
+            args.data_name,
+            args.mu_range,
+            args.verbose)
+
+    if not generator.IsValid():
+        sys.exit("Cannot set up toys for {}".format(args.infile))
+
+    generator.SetWarmStart(args.warm_start)
+    generator.SetDetailedErrorsAndPulls(detailsfile is not None)
+
+    exporter = R.DetailedOutputExporter(
+        "{}B_only_TS0".format(args.model_config), args.details_include, args.details_exclude)
+    csv_columns = R.std.vector("std::string")()
+    for _, column in detail_columns:
+        exporter.AddRequired(column)
+        csv_columns.push_back(column)
+
+    journal = None
+    if detailsfile is not None:
+        flush_details(detailsfile)
+        journal = DetailsJournal(detailsfile)
+
+    start_time = time.time()
+
+    # Written directly (not via append_rows) to keep the file open
+    output = open_output(outfile, fieldnames, args.format, append=True)
+    try:
+        for index in indices:
+            if not sequential:
+                R.RooRandom.randomGenerator().SetSeed(toy_seed(args.seed, index))
+
+            toy_start = time.time()
+            with profile.phase("generate"):
+                null_details = generator.Generate(1)
+                R.SetOwnership(null_details, True)
+            toy_time = time.time() - toy_start
+
+            with profile.phase("output"):
+                # Only the last toy is needed
+                exporter.Clear()
+
+                # One entry per toy (none if the test statistic is NaN).
+                # The details are written first, a toy in the CSV file
+                # always has its details.
+                if exporter.Fill(null_details):
+                    if journal is not None:
+                        columns = exporter.GetColumns()
+                        journal.append(index, [str(name) for name in columns],
+                                       list(exporter.GetLastRow(columns)))
+                    output.writerows([make_row(exporter.GetLastRow(csv_columns), index,
+                                               toy_time)])
+                else:
+                    output.writerows([make_failed_row(index, toy_time)])
+    finally:
+        output.close()
+
+    if detailsfile is not None:
+        with profile.phase("output"):
+            flush_details(detailsfile)
+
+    total_time = time.time() - start_time
+    time_per_toy = total_time / max(len(indices), 1)
+
+    print("Total time: {:2f} s".format(total_time))
+    print("Time per toy: {:2f} s/toy".format(time_per_toy))
+
+
+# Runs generate_toys, writing the profile (--profile) also if it fails
+def run_toys(indices, outfile, detailsfile=None, profilefile=None, sequential=False):
+    profile = PhaseProfile(profilefile, args.profile_python)
+    profile.info = {"script": "runDiscoveryTestStatToys.py", "infile": args.infile,
+                    "seed": args.seed, "ntoys": len(indices)}
+    try:
+        generate_toys(indices, outfile, detailsfile, profile, sequential)
+    finally:
+        profile.write()
+
+
+# Toys of a worker are written to a part file next to the output file
+# and merged into the output file when the worker has finished (or by
+# the next --resume if the job was interrupted). journals selects the
+# journals of the details part files instead.
+def part_files(outfile, journals=False):
+    dirname = os.path.dirname(os.path.abspath(outfile))
+    prefix = os.path.basename(outfile) + ".part"
+    return sorted(os.path.join(dirname, fn) for fn in os.listdir(dirname)
+                  if fn.startswith(prefix) and not fn.endswith(".tmp")
+                  and fn.endswith(".rows") == journals)
+
+
+def merge_part_files():
+    repair_rows(args.outfile)
+    for fn in part_files(args.outfile):
+        append_rows(args.outfile, repair_rows(fn))
+        remove(fn)
+
+    if args.details:
+        flush_details(args.details)
+        for journal in part_files(args.details, journals=True):
+            flush_details(journal[:-len(journal_name(""))])
+        parts = part_files(args.details)
+        if parts:
+            write_details(args.details, None, merge=[args.details] + parts)
+            for fn in parts:
+                remove(fn)
+
+
+# Runs the toys in forked processes, every worker taking every n-th
+# remaining index
+def run_parallel(indices):
+    # Fork explicitly: the workers rely on inheriting the parsed arguments
+    if hasattr(multiprocessing, "get_context"):
+        ctx = multiprocessing.get_context("fork")
+    else:
+        ctx = multiprocessing
+
+    workers = []
+    for worker in range(args.workers):
+        block = indices[worker::args.workers]
+        if not block:
+            continue
+
+        fn = "{}.part{}".format(args.outfile, worker)
+        detailsfile = "{}.part{}".format(args.details, worker) if args.details else None
+        profilefile = None
+        if args.profile:
+            profilefile = "{}.worker{}.json".format(os.path.splitext(args.profile)[0], worker)
+        proc = ctx.Process(target=run_toys, args=(block, fn, detailsfile, profilefile))
+        proc.start()
+        workers.append(proc)
+
+    failed = 0
+    for proc in workers:
+        proc.join()
+        if proc.exitcode != 0:
+            failed += 1
+
+    merge_part_files()
+
+    if failed:
+        sys.exit("{} worker(s) failed".format(failed))
+
+
+if args.resume:
+    merge_part_files()
+else:
+    stale = [args.outfile] + part_files(args.outfile)
+    if args.details:
+        stale += [args.details, journal_name(args.details)] + part_files(args.details)
+        stale += part_files(args.details, journals=True)
+    for fn in stale:
+        remove(fn)
+
+done = set()
+for row in repair_rows(args.outfile):
+    if int(row["seed"]) != args.seed:
+        sys.exit("Output file {} contains toys for seed {}".format(args.outfile, row["seed"]))
+    done.add(int(row["index"]))
+
+indices = [index for index in range(args.ntoys) if index not in done]
+print("Generating {} toys ({} already done)".format(len(indices), args.ntoys - len(indices)))
+
+if args.workers > 1:
+    run_parallel(indices)
+elif indices:
+    # A complete single-process run uses the sequential seeding of older
+    # campaigns, the toys missing after an interruption their own seeds
+    run_toys(indices, args.outfile, args.details, args.profile, sequential=not done)
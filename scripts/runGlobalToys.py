@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from collections import OrderedDict
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from common import (add_pseudo_data_sources, fit_fieldnames, load_macro, make_fit_row,
+                    make_retry_rows, masses, mu_ranges, parse_toys, print_fit_result)
+from toystore import formats, write_rows
+
+parser = argparse.ArgumentParser(
+    description="Fits all mass points of a range of global toys in parallel and writes "
+    "one merged toys_<toy>.csv per toy")
+parser.add_argument("workspace",
+                    help="Workspace file, '{mass}' and '{toy}' are replaced by the mass and "
+                    "toy index (e.g. 'ws/{mass}.root')")
+parser.add_argument("-t", "--toys", required=True,
+                    help="Toy index 'N' or inclusive range 'A-B'")
+parser.add_argument("-m", "--masses", default=",".join(str(m) for m in masses),
+                    help="Comma-separated mass points (default: all)")
+parser.add_argument("-o", "--outdir", default=".")
+parser.add_argument("--format", choices=formats, default="csv",
+                    help="Output format: toys_<toy>.csv or toy store directories toys_<toy> "
+                    "(see toystore.py) (default: %(default)s)")
+parser.add_argument("-j", "--workers", type=int, default=1,
+                    help="Number of processes fitting in parallel")
+parser.add_argument("--workspace-cache", type=int, default=1,
+                    help="Number of workspaces (fitters) kept per worker. The fits run toy by "
+                    "toy, so up to the number of masses avoids reloading prebuilt workspaces "
+                    "at the cost of memory (default: %(default)s)")
+
+parser.add_argument("--workspace-name", default="combined")
+parser.add_argument("--model-config", default="ModelConfig")
+parser.add_argument("--data-name", default="obsData")
+
+parser.add_argument("--mu-range", default=None, type=float,
+                    help="Range of the POI (default: from the mass point)")
+parser.add_argument("--optimizer-strategy", type=int, default=1)
+parser.add_argument("--optimizer", choices=["Minuit2", "Minuit"], default="Minuit2")
+parser.add_argument("--num-cpu", type=int, default=1,
+                    help="Evaluate the likelihood in N parallel processes (RooFit NumCPU). "
+                    "The NLL is then rebuilt for every fit.")
+parser.add_argument("--batch-mode", action="store_true",
+                    help="Evaluate the likelihood in RooFit's vectorised batch mode")
+parser.add_argument("-v", "--verbose", action="store_true")
+
+parser.add_argument("--globs-tree", default="",
+                    help="Tree containing the global observables ('{mass}' is replaced), "
+                    "the toy index is used as globs index")
+parser.add_argument("--pseudo-data", action="append", default=[], metavar="[CHANNEL=]FILE",
+                    help="Pseudo-data replacing the observed data as in runDiscoveryTestStat.py "
+                    "('{mass}' is replaced)")
+parser.add_argument("--pseudo-data-hist", default="pseudodata_{index}",
+                    help="Name of the pseudo-data histograms ('{index}' is replaced by the toy index)")
+
+parser.add_argument("--warm-start", action="store_true",
+                    help="Start the fits from the post-fit values of the previous toy of the "
+                    "same mass in the same process")
+parser.add_argument("--retry", action="store_true",
+                    help="Fit with the retry ladder instead of the nominal optimizer settings "
+                    "(see runDiscoveryTestStat.py)")
+parser.add_argument("--retry-methods", default="",
+                    help="Comma-separated retry methods (default: all). Implies --retry.")
+parser.add_argument("--retry-min-good", default=3, type=int, metavar="N",
+                    help="Stop the retry ladder after N good fits (evaluateRetries.py keeps "
+                    "only toys with three good fits)")
+
+args = parser.parse_args()
+
+if args.retry_methods:
+    args.retry = True
+
+if args.retry and args.retry_min_good < 3:
+    print("Warning: the retry ladder stops after {} good fits, evaluateRetries.py keeps only "
+          "toys with three good fits".format(args.retry_min_good))
+
+
+# Fit results plus the resources used by the fit
+fieldnames = fit_fieldnames + ["setup_time", "fit_time", "peak_rss_mb"]
+
+
+# Peak resident memory of this process in MB (ru_maxrss is in kB on Linux)
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def init_worker():
+    import ROOT as R
+    R.gROOT.SetBatch(True)
+    load_macro("DiscoveryTestStat.C")
+
+    R.Math.MinimizerOptions.SetDefaultMinimizer(args.optimizer)
+    R.Math.MinimizerOptions.SetDefaultStrategy(args.optimizer_strategy)
+    R.DiscoveryProfileLikelihood.SetDefaultNumCPU(args.num_cpu)
+    R.DiscoveryProfileLikelihood.SetDefaultBatchMode(args.batch_mode)
+
+
+# Fitters of the workspaces used last by this worker (least recently
+# used first). Toys of the same mass sharing a prebuilt workspace only
+# load it once while it is cached.
+_fitters = OrderedDict()
+
+
+def get_fitter(infile, mass):
+    import ROOT as R
+
+    if infile in _fitters:
+        fitter = _fitters.pop(infile)
+        _fitters[infile] = fitter
+        return fitter
+
+    # Free the least recently used workspaces first
+    while _fitters and len(_fitters) >= args.workspace_cache:
+        _fitters.popitem(last=False)
+
+    fitter = R.DiscoveryTestStatFitter(
+        infile,
+        args.workspace_name,
+        args.model_config,
+        args.data_name,
+        args.verbose)
+
+    if not fitter.IsValid():
+        raise RuntimeError("Cannot set up fit for {}".format(infile))
+
+    if args.retry and not fitter.SetRetryLadder(args.retry_methods):
+        raise RuntimeError("Unknown retry methods: {}".format(args.retry_methods))
+
+    fitter.SetWarmStart(args.warm_start)
+
+    sources = [source.format(mass=mass) for source in args.pseudo_data]
+    if not add_pseudo_data_sources(fitter, sources):
+        raise RuntimeError("Cannot read pseudo-data for mass {}".format(mass))
+
+    _fitters[infile] = fitter
+
+    return fitter
+
+
+# Fits one mass point of one toy. Errors are returned instead of raised
+# so that the remaining fits continue.
+def run_fit(task):
+    toy, mass = task
+
+    try:
+        start_time = time.time()
+        fitter = get_fitter(args.workspace.format(mass=mass, toy=toy), mass)
+        setup_time = time.time() - start_time
+
+        mu_range = args.mu_range if args.mu_range is not None else mu_ranges[mass]
+
+        start_time = time.time()
+        if args.pseudo_data and not fitter.SetPseudoData(args.pseudo_data_hist, toy):
+            raise RuntimeError("Cannot set pseudo-data for toy {}".format(toy))
+
+        fitter.SetOptimizer(args.optimizer, args.optimizer_strategy)
+        fitter.SetGlobs(args.globs_tree.format(mass=mass), toy)
+        fitter.SetMuRange(mu_range)
+
+        if args.retry:
+            rows = make_retry_rows(
+                fitter.FitWithRetries(mu_range, args.retry_min_good), toy, mass)
+        else:
+            ret = fitter.Fit()
+            print_fit_result(ret)
+            rows = [make_fit_row(ret, toy, mass, mu_range)]
+        fit_time = time.time() - start_time
+    except Exception as e:
+        return toy, mass, None, str(e)
+
+    for row in rows:
+        row["setup_time"] = setup_time
+        row["fit_time"] = fit_time
+        row["peak_rss_mb"] = peak_rss_mb()
+
+    return toy, mass, rows, None
+
+
+# Worker process: fits the tasks of the task queue until it gets None.
+# The task is kept in shared memory (current) during the fit, so that
+# the fit is known if the worker dies (e.g. killed for its memory).
+def work(task_queue, result_queue, current):
+    init_worker()
+    for task in iter(task_queue.get, None):
+        current[:] = task
+        result_queue.put(run_fit(task))
+
+
+# Written to a temporary file first so that an existing toys_<n>.csv
+# is always complete
+def write_toy(toy, rows):
+    fn = os.path.join(args.outdir, "toys_{}".format(toy))
+    if args.format == "csv":
+        fn += ".csv"
+    write_rows(fn, fieldnames, sorted(rows, key=lambda row: row["mass"]), args.format)
+
+
+toys = parse_toys(args.toys)
+fit_masses = [int(mass) for mass in args.masses.split(",")]
+
+unknown = [mass for mass in fit_masses if mass not in mu_ranges]
+if unknown and args.mu_range is None:
+    sys.exit("No mu range for mass {}".format(", ".join(str(m) for m in unknown)))
+
+if not os.path.isdir(args.outdir):
+    os.makedirs(args.outdir)
+
+# Sorted by toy so that the toys are written as soon as all their masses
+# are fitted
+tasks = [(toy, mass) for toy in toys for mass in fit_masses]
+
+print("Fitting {} toys x {} masses with {} workers".format(
+    len(toys), len(fit_masses), args.workers))
+
+# Fork explicitly: the workers rely on inheriting the parsed arguments
+if hasattr(multiprocessing, "get_context"):
+    ctx = multiprocessing.get_context("fork")
+else:
+    ctx = multiprocessing
+
+start_time = time.time()
+
+task_queue = ctx.Queue()
+result_queue = ctx.Queue()
+for task in tasks:
+    task_queue.put(task)
+for _ in range(args.workers):
+    task_queue.put(None)
+
+# Worker processes and their current tasks
+workers = []
+
+
+def start_worker():
+    current = ctx.Array("i", [-1, -1], lock=False)
+    process = ctx.Process(target=work, args=(task_queue, result_queue, current))
+    process.daemon = True
+    process.start()
+    workers.append((process, current))
+
+
+for _ in range(args.workers):
+    start_worker()
+
+remaining = set(tasks)
+pending = dict((toy, len(fit_masses)) for toy in toys)
+results = dict((toy, []) for toy in toys)
+failed = []
+fit_times = []
+max_rss = 0.
+
+
+def finish(toy, mass, rows, error):
+    global max_rss
+
+    if (toy, mass) not in remaining:
+        return
+    remaining.remove((toy, mass))
+
+    if error is not None:
+        print("Fit of toy {} mass {} failed: {}".format(toy, mass, error))
+        failed.append((toy, mass))
+    else:
+        results[toy].extend(rows)
+        fit_times.append(rows[0]["fit_time"])
+        max_rss = max(max_rss, rows[0]["peak_rss_mb"])
+
+    pending[toy] -= 1
+    if pending[toy] == 0:
+        if not any(t == toy for t, _ in failed):
+            write_toy(toy, results[toy])
+        del results[toy]
+
+
+while remaining:
+    try:
+        finish(*result_queue.get(timeout=5))
+        continue
+    except Empty:
+        pass
+
+    # Results sent by the workers before they exited
+    dead = [worker for worker in workers if not worker[0].is_alive()]
+    try:
+        while True:
+            finish(*result_queue.get_nowait())
+    except Empty:
+        pass
+
+    # A dead worker loses the fit it was running: the fit fails and a
+    # new worker continues with the remaining tasks
+    for worker in dead:
+        workers.remove(worker)
+        process, current = worker
+        task = tuple(current)
+        if task in remaining:
+            finish(task[0], task[1], None,
+                   "worker died (exit code {})".format(process.exitcode))
+            start_worker()
+
+    # All workers exited, e.g. failed in the setup or died before their
+    # last result was sent
+    if not workers:
+        for toy, mass in sorted(remaining):
+            finish(toy, mass, None, "no worker left")
+
+for process, _ in workers:
+    process.join()
+
+print("Total time: {:.2f} s".format(time.time() - start_time))
+if fit_times:
+    fit_times.sort()
+    print("Time per fit: median {:.2f} s, max {:.2f} s".format(
+        fit_times[len(fit_times) // 2], fit_times[-1]))
+    print("Peak RSS per worker: {:.0f} MB".format(max_rss))
+
+if failed:
+    sys.exit("{} fit(s) failed, toys {} not written".format(
+        len(failed), ", ".join(str(t) for t in sorted(set(t for t, _ in failed)))))
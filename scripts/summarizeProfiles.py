@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import re
+
+import pandas as pd
+
+parser = argparse.ArgumentParser(
+    description="Summarizes the phase profiles (--profile) of many jobs per mass point")
+parser.add_argument("inputs", nargs="+", help="Profile JSON files or directories containing them")
+parser.add_argument("-o", "--outfile", default=None, help="Write the summary to a CSV file")
+args = parser.parse_args()
+
+
+def find_profiles(inputs):
+    for path in inputs:
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for dirpath, _, filenames in os.walk(path):
+            for fn in sorted(filenames):
+                if fn.endswith(".json"):
+                    yield os.path.join(dirpath, fn)
+
+
+# Mass of the job: from the profile if known, otherwise guessed from
+# the workspace filename
+def get_mass(profile):
+    mass = profile["info"].get("mass")
+    if mass is not None:
+        return mass
+
+    match = re.search(r"(\d{3,})", os.path.basename(profile["info"].get("infile", "")))
+    return int(match.group(0)) if match else -1
+
+
+rows = []
+for fn in find_profiles(args.inputs):
+    with open(fn) as f:
+        profile = json.load(f)
+
+    mass = get_mass(profile)
+    script = profile["info"].get("script", "")
+    rows.append({"script": script, "mass": mass, "phase": "total", "count": 1,
+                 "wall": profile["total"]["wall"], "cpu": profile["total"]["cpu"],
+                 "rss_mb": profile["total"]["peak_rss_mb"]})
+
+    # Phases of the macros are prefixed by 'root:'
+    for prefix, phases in (("", profile["phases"]), ("root:", profile["root_phases"])):
+        for phase in phases:
+            rows.append({"script": script, "mass": mass, "phase": prefix + phase["name"],
+                         "count": phase["count"], "wall": phase["wall"], "cpu": phase["cpu"],
+                         "rss_mb": phase["rss_mb"]})
+
+if not rows:
+    parser.error("No profiles found")
+
+df = pd.DataFrame(rows)
+df["wall_per_call"] = df.wall / df["count"]
+
+# Per job: median / maximum of the time of a phase, maximum of the memory
+grouped = df.groupby(["script", "mass", "phase"], sort=False)
+summary = pd.DataFrame({
+    "jobs": grouped.size(),
+    "calls": grouped["count"].sum(),
+    "wall_p50": grouped.wall.median(),
+    "wall_max": grouped.wall.max(),
+    "cpu_p50": grouped.cpu.median(),
+    "wall_per_call_p50": grouped.wall_per_call.median(),
+    "rss_mb_max": grouped.rss_mb.max(),
+})
+
+# Share of the phase in the wall time of the job
+total = summary.xs("total", level="phase").wall_p50
+summary["wall_fraction"] = summary.wall_p50 / total.reindex(
+    summary.index.droplevel("phase")).values
+
+summary = summary.sort_index(level=["script", "mass"], sort_remaining=False)
+
+with pd.option_context("display.max_rows", None, "display.max_columns", None,
+                       "display.width", 200):
+    print(summary.round(3))
+
+if args.outfile:
+    summary.to_csv(args.outfile)
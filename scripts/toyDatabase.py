@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+import argparse
+import glob
+
+from toydb import ToyDatabase, views
+
+parser = argparse.ArgumentParser(
+    description="Append-only SQLite database of toy fits (see toydb.py). Replaces the merging "
+    "of the per-job outputs and retries with CSV tools.")
+parser.add_argument("database", help="SQLite database (created if it does not exist)")
+subparsers = parser.add_subparsers(dest="command")
+
+ingest_parser = subparsers.add_parser(
+    "ingest", help="Ingest toy CSV files, toy stores or retry tarballs. Files that were "
+    "ingested before (same content) are skipped, as fits that are already in the database.")
+ingest_parser.add_argument("infiles", nargs="+",
+                           help="Inputs, glob patterns are expanded (for long lists of files)")
+ingest_parser.add_argument("--mass", type=int, default=None,
+                           help="Mass of inputs without mass column (toys of the q0 sampling "
+                           "distributions)")
+
+export_parser = subparsers.add_parser(
+    "export", help="Write a view to a CSV file (ending with .csv) or toy store")
+export_parser.add_argument("outfile")
+export_parser.add_argument("--view", choices=sorted(views), default="best",
+                           help="best: best converged fit per toy and mass (as "
+                           "mergeRetriedToys.py), priority: good retry of the highest priority "
+                           "of the toys with three good retries (as evaluateRetries.py), all: "
+                           "every fit")
+export_parser.add_argument("--columns", default=None,
+                           help="Comma-separated columns to write (default: the columns of "
+                           "the inputs in their order)")
+
+subparsers.add_parser("summary", help="Print the number of fits per mass")
+
+args = parser.parse_args()
+
+db = ToyDatabase(args.database)
+
+if args.command == "ingest":
+    num_rows = num_skipped = num_invalid = 0
+    for pattern in args.infiles:
+        for fn in sorted(glob.glob(pattern)) or [pattern]:
+            try:
+                rows = db.ingest(fn, mass=args.mass)
+            except ValueError as e:
+                print("Skipping {}: {}".format(fn, e))
+                num_invalid += 1
+                continue
+            num_rows += rows
+            num_skipped += rows == 0
+
+    print("Ingested {} fits ({} inputs without new fits, {} invalid)".format(
+        num_rows, num_skipped, num_invalid))
+elif args.command == "export":
+    num_rows = db.export(args.outfile, view=args.view,
+                         columns=args.columns.split(",") if args.columns else None)
+    print("{} rows in {}".format(num_rows, args.outfile))
+elif args.command == "summary":
+    print("{:>6} {:>8} {:>8} {:>8} {:>8}".format("mass", "fits", "toys", "failed", "retried"))
+    for row in db.db.execute(
+            "SELECT best_fits.mass, all_fits.num, COUNT(*), SUM(best_fits.failed), "
+            "SUM(best_fits.retry_method != '') FROM best_fits JOIN "
+            "(SELECT mass, COUNT(*) AS num FROM fits GROUP BY mass) AS all_fits "
+            "ON best_fits.mass = all_fits.mass GROUP BY best_fits.mass ORDER BY best_fits.mass"):
+        print("{:>6} {:>8} {:>8} {:>8} {:>8}".format(*row))
+else:
+    parser.print_usage()
+
+db.close()
@@ -0,0 +1,347 @@
+import csv
+import hashlib
+import os
+import re
+import sqlite3
+import tarfile
+import time
+
+import toystore
+
+
+# Append-only SQLite database of fit results. Every fit is one row of
+# the table 'fits', identified by its content: (toyindex, mass, seed,
+# retry_method); seed is -1 for the global toys and retry_method '' for
+# the nominal fit. The nominal fit and all retries are kept, a fit that
+# is already in the database is ignored (e.g. from a resumed
+# toy_<seed>.csv or a re-created retry tarball).
+#
+# Every ingested file is recorded in 'sources' with the digest of its
+# content and its columns. A file is ingested in one transaction
+# together with its source entry, so ingesting is idempotent and only
+# adds the new fits. The views select one fit per toy and mass:
+#
+# - best_fits: the converged fit of the highest priority (nominal fit
+#   first, then the retry methods in the order of the retry ladder),
+#   the highest priority failed fit if none converged
+# - priority_fits: the good fit (converged, q0 >= -0.1) of the highest
+#   priority of the toys with at least min_good good fits, with the
+#   number of good fits (good_count) as in evaluateRetries.py
+#
+# The views do not use window functions so that they also work with
+# the old SQLite versions of the batch nodes.
+
+# Retry methods from highest to lowest priority (kRetryMethods in
+# DiscoveryTestStat.C), the nominal fit has priority -1
+retry_priorities = dict((method, priority) for priority, method in enumerate([
+    "minuit2strat2",
+    "minuit2strat1mu2",
+    "minuit2strat1mu0p5",
+    "minuitstrat2",
+    "minuitstrat1",
+    "minuitstrat1mu2",
+    "minuitstrat1mu0p5",
+]))
+retry_priorities[""] = -1
+unknown_priority = 99
+
+# Good fits required to keep a toy in priority_fits (as in
+# evaluateRetries.py)
+min_good = 3
+
+schema = """
+CREATE TABLE IF NOT EXISTS sources (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    digest TEXT NOT NULL UNIQUE,
+    rows INTEGER NOT NULL,
+    ingested REAL NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    columns TEXT
+);
+
+CREATE TABLE IF NOT EXISTS fits (
+    toyindex INTEGER NOT NULL,
+    mass INTEGER NOT NULL,
+    seed INTEGER NOT NULL DEFAULT -1,
+    retry_method TEXT NOT NULL DEFAULT '',
+    retry_priority INTEGER NOT NULL,
+    failed INTEGER NOT NULL,
+    source INTEGER NOT NULL REFERENCES sources(id)
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS fits_key ON fits (toyindex, mass, seed, retry_method);
+
+CREATE VIEW IF NOT EXISTS best_fits AS
+SELECT fits.* FROM fits WHERE fits.rowid = (
+    SELECT other.rowid FROM fits AS other
+    WHERE other.toyindex = fits.toyindex AND other.mass = fits.mass AND other.seed = fits.seed
+    ORDER BY other.failed, other.retry_priority, other.retry_method LIMIT 1
+);
+
+CREATE VIEW IF NOT EXISTS priority_fits AS
+SELECT fits.*, good.good_count AS good_count FROM fits JOIN (
+    SELECT toyindex, mass, seed, COUNT(*) AS good_count
+    FROM fits WHERE failed = 0 AND q0 >= -0.1 GROUP BY toyindex, mass, seed
+    HAVING COUNT(*) >= {min_good}
+) AS good
+ON fits.toyindex = good.toyindex AND fits.mass = good.mass AND fits.seed = good.seed
+WHERE fits.rowid = (
+    SELECT other.rowid FROM fits AS other
+    WHERE other.toyindex = fits.toyindex AND other.mass = fits.mass AND other.seed = fits.seed
+    AND other.failed = 0 AND other.q0 >= -0.1
+    ORDER BY other.retry_priority, other.retry_method LIMIT 1
+);
+"""
+
+views = {"all": "fits", "best": "best_fits", "priority": "priority_fits"}
+
+# Columns of the database that are not in the inputs, only exported if
+# requested
+bookkeeping_columns = ["retry_priority", "failed", "source", "good_count"]
+
+# Columns identifying a fit besides the toy index, set by ingest for
+# inputs without the column
+key_columns = ["mass", "seed", "retry_method"]
+
+# Retry outputs in tarballs: one file per retry method
+# (retry_<method>_idx<n>_m<mass>.csv) or one file of the retry ladder
+# with a retry_method column
+retry_pattern = re.compile(r"^retry_(?:(.*)_)?idx\d+_m\d+.csv$")
+
+
+def sql_type(name):
+    if name == "retry_method":
+        return "TEXT"
+
+    return "INTEGER" if toystore.column_dtype(name).kind in "iu" else "REAL"
+
+
+# Conversion of the values of a column for the insert (CSV values are
+# strings), missing values become NULL
+def to_sql(name):
+    if sql_type(name) == "TEXT":
+        return lambda value: "" if value is None else str(value)
+
+    convert = (lambda value: int(float(value))) if sql_type(name) == "INTEGER" else float
+    return lambda value: None if toystore._is_missing(value) else convert(value)
+
+
+def digest(path):
+    h = hashlib.sha1()
+    if os.path.isdir(path):
+        for fn in sorted(os.listdir(path)):
+            h.update(fn.encode("utf-8"))
+            with open(os.path.join(path, fn), "rb") as f:
+                h.update(f.read())
+    else:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+
+    return h.hexdigest()
+
+
+# Size and modification time of a file or toy store (meta.json)
+def stat(path):
+    st = os.stat(os.path.join(path, toystore.meta_name) if os.path.isdir(path) else path)
+    return st.st_size, st.st_mtime
+
+
+required_columns = ["toyindex", "uncond_status", "cond_status", "q0"]
+
+
+# Checks that the rows of an input are complete (e.g. not a CSV file
+# that is still being written), optionally the number of rows
+def check_rows(rows, path, num_rows=None):
+    if not rows:
+        raise ValueError("No rows in {}".format(path))
+    if num_rows is not None and len(rows) != num_rows:
+        raise ValueError("{} instead of {} rows in {}".format(len(rows), num_rows, path))
+
+    for i, row in enumerate(rows):
+        missing = [name for name in required_columns if name not in row]
+        if missing:
+            raise ValueError("No column {} in {}".format(", ".join(missing), path))
+        if any(value is None for value in row.values()) or None in row:
+            raise ValueError("Incomplete row {} in {}".format(i + 1, path))
+
+
+# Rows (dictionaries) of a toy CSV file, toy store or retry tarball
+def read_source(path):
+    if toystore.is_store(path):
+        return toystore.ToyStore(path).rows()
+
+    if not path.endswith((".tar.gz", ".tgz")):
+        with open(path) as f:
+            return list(csv.DictReader(f))
+
+    rows = []
+    with tarfile.open(path, "r") as tar:
+        for name in tar.getnames():
+            m = retry_pattern.match(os.path.basename(name))
+            if not m:
+                raise RuntimeError("Cannot parse: " + name)
+
+            content = tar.extractfile(name).read().decode("utf-8").splitlines()
+            for row in csv.DictReader(content):
+                if m.group(1) is not None:
+                    row["retry_method"] = m.group(1)
+                rows.append(row)
+
+    return rows
+
+
+def is_database(path):
+    if not os.path.isfile(path):
+        return False
+
+    with open(path, "rb") as f:
+        return f.read(16) == b"SQLite format 3\x00"
+
+
+# Fits without status (missing value) count as failed
+def is_failed(row):
+    return any(toystore._is_missing(row.get(name)) or float(row[name]) != 0
+               for name in ["uncond_status", "cond_status"])
+
+
+class ToyDatabase(object):
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(schema.format(min_good=min_good))
+        self.columns = [row[1] for row in self.db.execute("PRAGMA table_info(fits)")]
+
+    def close(self):
+        self.db.close()
+
+    def add_columns(self, names):
+        for name in names:
+            if name in self.columns:
+                continue
+            if not re.match(r"^\w+$", name):
+                raise ValueError("Invalid column name: {}".format(name))
+
+            self.db.execute('ALTER TABLE fits ADD COLUMN "{}" {}'.format(name, sql_type(name)))
+            self.columns.append(name)
+
+    # Size and modification time of the ingested inputs by path
+    def sources(self):
+        return dict((path, (size, mtime)) for path, size, mtime in self.db.execute(
+            "SELECT path, size, mtime FROM sources ORDER BY id"))
+
+    # Ingests a file unless a file with the same content was ingested
+    # before. Returns the number of new fits, fits that are already in
+    # the database are ignored. mass is used for files
+    # without mass column (toys of the q0 sampling distributions).
+    # Incomplete inputs (or not num_rows rows) raise a ValueError.
+    def ingest(self, path, mass=None, num_rows=None):
+        size, mtime = stat(path)
+        path_digest = digest(path)
+        if self.db.execute("SELECT 1 FROM sources WHERE digest = ?", (path_digest,)).fetchone():
+            return 0
+
+        rows = read_source(path)
+        input_columns = []
+        for row in rows:
+            input_columns.extend(name for name in row if name not in input_columns)
+        for row in rows:
+            if "index" in row:
+                row["toyindex"] = row.pop("index")
+            if row.get("mass") in (None, ""):
+                if mass is None:
+                    raise RuntimeError("No mass for {}".format(path))
+                row["mass"] = mass
+            if row.get("seed") in (None, ""):
+                row["seed"] = -1
+            row["retry_method"] = row.get("retry_method") or ""
+        check_rows(rows, path, num_rows)
+
+        # New columns are added first, ALTER TABLE would commit the
+        # transaction of the rows
+        names = []
+        for row in rows:
+            for name in row:
+                if name not in names:
+                    names.append(name)
+        self.add_columns(names)
+        self.db.commit()
+
+        changes = self.db.total_changes
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT INTO sources (path, digest, rows, ingested, size, mtime, columns) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (os.path.abspath(path), path_digest, len(rows), time.time(), size, mtime,
+                 ",".join(input_columns)))
+            source = cursor.lastrowid
+
+            converters = [to_sql(name) for name in self.columns]
+            values = []
+            for row in rows:
+                row["toyindex"] = int(row["toyindex"])
+                row["mass"] = int(float(row["mass"]))
+                row["seed"] = int(row["seed"])
+                row["retry_priority"] = retry_priorities.get(row["retry_method"],
+                                                             unknown_priority)
+                row["failed"] = int(is_failed(row))
+                row["source"] = source
+                values.append([convert(row.get(name))
+                               for name, convert in zip(self.columns, converters)])
+
+            self.db.executemany("INSERT OR IGNORE INTO fits ({}) VALUES ({})".format(
+                ", ".join('"{}"'.format(name) for name in self.columns),
+                ", ".join("?" * len(self.columns))), values)
+
+        # Minus the source entry
+        return self.db.total_changes - changes - 1
+
+    # Column names and rows (tuples) of a view ordered by toyindex, mass,
+    # seed and priority
+    def read(self, view="best", columns=None):
+        cursor = self.db.execute(
+            "SELECT {} FROM {} ORDER BY toyindex, mass, seed, retry_priority, retry_method".format(
+                ", ".join('"{}"'.format(name) for name in columns) if columns else "*",
+                views[view]))
+
+        return [description[0] for description in cursor.description], cursor.fetchall()
+
+    # Columns of the ingested inputs in the order of their first
+    # occurrence (toy index as toyindex)
+    def input_columns(self):
+        names = []
+        for (columns,) in self.db.execute("SELECT columns FROM sources ORDER BY id"):
+            for name in (columns or "").split(","):
+                name = "toyindex" if name == "index" else name
+                if name and name not in names:
+                    names.append(name)
+
+        return names
+
+    # Writes a view to a CSV file (outfile ending with .csv) or toy
+    # store. The toy index is written as 'index' as in the outputs of
+    # the fit scripts. By default the columns of the inputs are written
+    # in their order (as a merge of the input files), without the
+    # bookkeeping columns. The mass, seed and retry method are only
+    # added if they are not in the inputs and vary (e.g. not the mass of
+    # the toys of the q0 sampling distributions ingested with --mass).
+    def export(self, outfile, view="best", columns=None):
+        names, rows = self.read(view, columns)
+        rows = [dict(zip(names, row)) for row in rows]
+
+        if columns is None:
+            order = self.input_columns()
+            names = [name for name in order if name in names] + [
+                name for name in names if name not in order and name not in bookkeeping_columns
+                and (name not in key_columns or len(set(row[name] for row in rows)) > 1)]
+
+        fieldnames = ["index" if name == "toyindex" else name for name in names]
+        rows = [dict((fieldname, row[name]) for fieldname, name in zip(fieldnames, names))
+                for row in rows]
+
+        toystore.write_rows(outfile, fieldnames, rows,
+                            "csv" if outfile.endswith(".csv") else "npy")
+
+        return len(rows)
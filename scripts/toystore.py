@@ -0,0 +1,292 @@
+import csv
+import json
+import os
+import shutil
+import struct
+
+import numpy as np
+
+
+# Columnar store of toy results: a directory with one .npy file per
+# column (memory-mappable, readable with np.load) and meta.json with
+# the schema and the number of committed rows.
+#
+# Rows are appended by writing the new values to the end of every
+# column file and then replacing meta.json. Values behind the number
+# of rows in meta.json (e.g. from a job killed while appending) are
+# ignored by the readers and dropped by the next append.
+#
+# Categorical columns store int16 codes, the categories are kept in
+# meta.json. Missing values are NaN in float columns and -1 in integer
+# columns, missing categories are -1 (e.g. the mass of a fit without
+# -m) or ''.
+
+meta_name = "meta.json"
+
+# Size of the .npy headers, leaves room for the shape to grow in place
+header_size = 128
+
+# Type of the categories of categorical columns
+categorical_columns = {"mass": int, "retry_method": str}
+
+column_dtypes = {
+    "index": np.int32,
+    "toyindex": np.int32,
+    "seed": np.int32,
+    "uncond_status": np.int16,
+    "cond_status": np.int16,
+    "uncond_covQual": np.int8,
+    "cond_covQual": np.int8,
+    "uncond_strategy": np.int8,
+    "cond_strategy": np.int8,
+    "warm_start": np.int8,
+    # Bookkeeping of the toy database (toydb.py)
+    "retry_priority": np.int8,
+    "failed": np.int8,
+    "source": np.int32,
+    "good_count": np.int16,
+}
+
+
+def column_dtype(name):
+    if name in categorical_columns:
+        return np.dtype(np.int16)
+
+    return np.dtype(column_dtypes.get(name, np.float64))
+
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, meta_name))
+
+
+def _write_header(f, dtype, nrows):
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({},), }}".format(
+        np.lib.format.dtype_to_descr(dtype), nrows)
+    # Magic string, version 1.0, length of the header
+    header = header.ljust(header_size - 10 - 1) + "\n"
+    f.seek(0)
+    f.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1"))
+
+
+def _is_missing(value):
+    return value is None or value == "" or (isinstance(value, float) and np.isnan(value))
+
+
+class ToyStore(object):
+    def __init__(self, path):
+        self.path = path
+
+        with open(os.path.join(path, meta_name)) as f:
+            meta = json.load(f)
+
+        self.nrows = meta["nrows"]
+        self.columns = meta["columns"]
+        self.categories = meta["categories"]
+
+    @classmethod
+    def create(cls, path, columns):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        for name in columns:
+            with open(os.path.join(path, name + ".npy"), "wb") as f:
+                _write_header(f, column_dtype(name), 0)
+
+        meta = {"nrows": 0, "columns": list(columns),
+                "categories": dict((name, []) for name in columns
+                                   if name in categorical_columns)}
+        with open(os.path.join(path, meta_name), "w") as f:
+            json.dump(meta, f)
+
+        return cls(path)
+
+    def _write_meta(self):
+        meta = {"nrows": self.nrows, "columns": self.columns, "categories": self.categories}
+        fn = os.path.join(self.path, meta_name)
+        with open(fn + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.rename(fn + ".tmp", fn)
+
+    # Column as array, memory-mapped with mmap_mode 'r' / 'r+'.
+    # Categorical columns are decoded unless codes=True.
+    def column(self, name, mmap_mode="r", codes=False):
+        if name not in self.columns:
+            raise KeyError("No column {} in {}".format(name, self.path))
+
+        # Only the committed rows are read (the header of the .npy file
+        # can be ahead after an interrupted append)
+        fn = os.path.join(self.path, name + ".npy")
+        dtype = column_dtype(name)
+        if self.nrows == 0:
+            values = np.zeros(0, dtype=dtype)
+        elif mmap_mode:
+            values = np.memmap(fn, dtype=dtype, mode=mmap_mode, offset=header_size,
+                               shape=(self.nrows,))
+        else:
+            with open(fn, "rb") as f:
+                f.seek(header_size)
+                values = np.fromfile(f, dtype=dtype, count=self.nrows)
+
+        if name in self.categories and not codes:
+            categories = np.array(self.categories[name])
+            if len(categories) == 0:
+                return np.zeros(0, dtype=column_dtype(name))
+            return categories[values]
+
+        return values
+
+    # Dictionary of the selected columns (default: all)
+    def read(self, columns=None, mmap_mode="r"):
+        return dict((name, self.column(name, mmap_mode))
+                    for name in (columns or self.columns))
+
+    def rows(self, columns=None):
+        data = self.read(columns, mmap_mode=None)
+        names = columns or self.columns
+        return [dict((name, data[name][i].item()) for name in names)
+                for i in range(self.nrows)]
+
+    def _encode(self, name, values):
+        if name in categorical_columns:
+            value_type = categorical_columns[name]
+            categories = self.categories[name]
+            lookup = dict((category, code) for code, category in enumerate(categories))
+            codes = np.empty(len(values), dtype=np.int16)
+            for i, value in enumerate(values):
+                if value_type is int:
+                    value = -1 if _is_missing(value) else int(float(value))
+                else:
+                    value = "" if _is_missing(value) else str(value)
+                if value not in lookup:
+                    lookup[value] = len(categories)
+                    categories.append(value)
+                codes[i] = lookup[value]
+            return codes
+
+        dtype = column_dtype(name)
+        if isinstance(values, np.ndarray) and values.dtype.kind in "biuf":
+            if dtype.kind != "f" and values.dtype.kind == "f":
+                values = np.where(np.isnan(values), -1, values)
+            return values.astype(dtype)
+
+        if dtype.kind == "f":
+            return np.array([np.nan if _is_missing(value) else float(value)
+                             for value in values], dtype=dtype)
+
+        return np.array([-1 if _is_missing(value) else int(float(value))
+                         for value in values], dtype=dtype)
+
+    # Appends the columns (lists or arrays of equal length, strings are
+    # converted) and commits them. Columns of the store that are not
+    # given are filled with missing values.
+    def append_columns(self, data):
+        unknown = set(data) - set(self.columns)
+        if unknown:
+            raise KeyError("Columns {} not in {}".format(", ".join(sorted(unknown)), self.path))
+
+        nrows = set(len(values) for values in data.values())
+        if len(nrows) > 1:
+            raise ValueError("Columns of different length")
+        nrows = nrows.pop() if nrows else 0
+        if nrows == 0:
+            return
+
+        for name in self.columns:
+            values = data.get(name, [None] * nrows)
+            values = self._encode(name, values)
+
+            with open(os.path.join(self.path, name + ".npy"), "r+b") as f:
+                # Drop uncommitted values
+                offset = header_size + self.nrows * values.itemsize
+                f.truncate(offset)
+                f.seek(offset)
+                f.write(values.tobytes())
+                _write_header(f, values.dtype, self.nrows + nrows)
+
+        self.nrows += nrows
+        self._write_meta()
+
+    def append(self, rows):
+        self.append_columns(dict((name, [row.get(name) for row in rows])
+                                 for name in self.columns))
+
+    def to_csv(self, fn, columns=None):
+        names = columns or self.columns
+        with open(fn, "w") as f:
+            writer = csv.DictWriter(f, fieldnames=names)
+            writer.writeheader()
+            writer.writerows(self.rows(names))
+
+
+# Output of the fit scripts: CSV file (header written when the file is
+# created) or toy store, flushed / committed after every writerows
+class CsvOutput(object):
+    def __init__(self, path, fieldnames, append=False):
+        self.f = open(path, "a" if append else "w")
+        self.writer = csv.DictWriter(self.f, fieldnames=fieldnames)
+        if self.f.tell() == 0:
+            self.writer.writeheader()
+            self.f.flush()
+
+    def writerows(self, rows):
+        self.writer.writerows(rows)
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class StoreOutput(object):
+    def __init__(self, path, fieldnames, append=False):
+        if append and is_store(path):
+            self.store = ToyStore(path)
+        else:
+            remove(path)
+            self.store = ToyStore.create(path, fieldnames)
+
+    def writerows(self, rows):
+        self.store.append(rows)
+
+    def close(self):
+        pass
+
+
+formats = ["csv", "npy"]
+
+
+def open_output(path, fieldnames, fmt="csv", append=False):
+    if fmt == "npy":
+        return StoreOutput(path, fieldnames, append)
+
+    return CsvOutput(path, fieldnames, append)
+
+
+# Writes all rows at once. The output is written next to the final
+# path first so that it is always complete.
+def write_rows(path, fieldnames, rows, fmt="csv"):
+    tmp = path + ".tmp"
+    remove(tmp)
+
+    output = open_output(tmp, fieldnames, fmt)
+    output.writerows(rows)
+    output.close()
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+
+# Rows of a toy CSV file or store as dictionaries (CSV values are strings)
+def read_rows(path):
+    if is_store(path):
+        return ToyStore(path).rows()
+
+    with open(path) as f:
+        return list(csv.DictReader(f))
+
+
+def remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+import argparse
+import csv
+import os
+import re
+import tarfile
+import time
+
+from toydb import ToyDatabase, stat
+
+parser = argparse.ArgumentParser(
+    description="Merges finished job outputs into the toy database (see toyDatabase.py) while "
+    "a campaign is running. The directories are scanned for toy_<seed>.csv, toys_<n>.csv and "
+    "retry_idx<n>_m<mass>.tar.gz (and toy stores toy_<seed> / toys_<n>). An output is "
+    "ingested once it has not changed for --settle seconds and is complete. Outputs are never "
+    "ingested twice, so the watcher can be stopped and restarted at any time.")
+parser.add_argument("database", help="SQLite toy database")
+parser.add_argument("indirs", nargs="+",
+                    help="Output directories. The mass of the toy_<seed> outputs is taken from "
+                    "the directory name (e.g. comb_500)")
+parser.add_argument("--settle", type=float, default=60.,
+                    help="Seconds without modification before an output counts as finished")
+parser.add_argument("--ntoys", type=int, default=None,
+                    help="Number of toys of the toy_<seed> outputs (incomplete outputs are "
+                    "skipped)")
+parser.add_argument("--interval", type=float, default=30., help="Seconds between scans")
+parser.add_argument("--once", action="store_true", help="Scan only once (e.g. from cron)")
+parser.add_argument("--export", default=None,
+                    help="Export the best view to this CSV file / toy store after new rows "
+                    "were ingested")
+args = parser.parse_args()
+
+
+pattern = re.compile(r"^(toy_\d+(\.csv)?|toys_\d+(\.csv)?|retry_idx\d+_m\d+\.tar\.gz)$")
+mass_pattern = re.compile(r"(\d+)$")
+
+db = ToyDatabase(args.database)
+
+# Inputs that were checked without adding a source (invalid or same
+# content as an ingested input), checked again when they change
+checked = {}
+
+
+def scan():
+    sources = db.sources()
+    num_rows = 0
+
+    for indir in args.indirs:
+        m = mass_pattern.search(os.path.basename(os.path.normpath(indir)))
+        mass = int(m.group(1)) if m else None
+
+        for fn in sorted(os.listdir(indir)):
+            path = os.path.abspath(os.path.join(indir, fn))
+            if not pattern.match(fn):
+                continue
+
+            try:
+                size, mtime = stat(path)
+            except OSError:
+                continue
+
+            # Unchanged since ingested or checked
+            if sources.get(path) == (size, mtime) or checked.get(path) == (size, mtime):
+                continue
+            if time.time() - mtime < args.settle:
+                continue
+
+            try:
+                rows = db.ingest(path, mass=mass if fn.startswith("toy_") else None,
+                                 num_rows=args.ntoys if fn.startswith("toy_") else None)
+            except (ValueError, RuntimeError, EnvironmentError, EOFError, csv.Error,
+                    tarfile.TarError) as e:
+                print("Skipping {}: {}".format(path, e))
+                checked[path] = (size, mtime)
+                continue
+
+            if rows:
+                print("Ingested {} rows from {}".format(rows, path))
+            else:
+                checked[path] = (size, mtime)
+            num_rows += rows
+
+    return num_rows
+
+
+try:
+    while True:
+        if scan() and args.export:
+            print("{} rows in {}".format(db.export(args.export), args.export))
+        if args.once:
+            break
+        time.sleep(args.interval)
+except KeyboardInterrupt:
+    pass
+finally:
+    db.close()